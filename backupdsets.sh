@@ -1,10 +1,51 @@
-#!/bin/sh
+#!/bin/bash
+
+# Sends the objects stored since the last backup, and every manifest, as
+# one tar. Objects are compressed already and never change, so unpacking
+# the tars in order gets every dataset back. Datasets from before the
+# object store have no manifest; their files go in whole, again whenever
+# they change.
+
+set -o pipefail
 
 cd datasets
 
-for dir in ./*/
+stamp=.backedup
+list=.backup-list
+now=$(date +%Y%m%d%H%M%S)
+
+newer=""
+if [ -f $stamp ]
+then
+    newer="-newer $stamp"
+fi
+
+# Anything stored from here on goes in the next backup as well
+touch $stamp.new
+: > $list
+if [ -d objects ]
+then
+    find objects -type f ! -name 'tmp-*' $newer >> $list
+fi
+for dir in dataset*/
 do
-    dir=${dir%*/}
-	echo $dir
-	tar -zcv $dir | ssh 192.168.1.128 "cat > /mnt/backup/Programming/rpc_datasets/${dir##*/}.tar.gz"
+    dir=${dir%/}
+    if [ -f $dir/manifest.json ]
+    then
+        echo $dir/manifest.json >> $list
+    else
+        find $dir -type f $newer >> $list
+    fi
 done
+echo $(wc -l < $list) files
+
+# Only a tar that got there in full moves the stamp on
+if tar -cv -T $list | ssh 192.168.1.128 "cat > /mnt/backup/Programming/rpc_datasets/objects-$now.tar"
+then
+    mv $stamp.new $stamp
+else
+    echo "Backup failed, nothing marked as sent" >&2
+    rm -f $stamp.new $list
+    exit 1
+fi
+rm -f $list
@@ -0,0 +1,157 @@
+"""
+Compact binary encoding for the GM and LB protocol messages.
+
+A message is a one byte type tag and a one byte module tag followed by the
+fields of that message type in a fixed order. Membership lists are a 16 bit
+count followed by 16 bit uuids. Messages without any fields never change, so
+their encoding is built once and reused.
+
+Several messages for the same destination can travel in one envelope: the
+ENVELOPE tag, a 16 bit count, and then each message encoded as above. A
+broadcast is the BROADCAST tag, the uuids it is meant for, and then one
+message encoded as above.
+"""
+
+import struct
+
+MODULES = ['gm', 'lb', 'all']
+MODULE_TAGS = dict([ (m, i) for (i, m) in enumerate(MODULES) ])
+
+HEADER = struct.Struct("!BB")
+U8 = struct.Struct("!B")
+U16 = struct.Struct("!H")
+U32 = struct.Struct("!I")
+F64 = struct.Struct("!d")
+
+def _pack_fixed(fmt):
+    def pack(out, v):
+        out.append(fmt.pack(v))
+    def unpack(data, off):
+        return fmt.unpack_from(data, off)[0], off+fmt.size
+    return pack, unpack
+
+def _pack_bool(out, v):
+    out.append(U8.pack(1 if v else 0))
+
+def _unpack_bool(data, off):
+    return bool(U8.unpack_from(data, off)[0]), off+1
+
+def _pack_uuids(out, v):
+    out.append(struct.pack("!H{}H".format(len(v)), len(v), *v))
+
+def _unpack_uuids(data, off):
+    (n,) = U16.unpack_from(data, off)
+    off += 2
+    return list(struct.unpack_from("!{}H".format(n), data, off)), off+2*n
+
+FALLBACK = struct.Struct("!BHI")
+
+def _pack_fallback(out, v):
+    if v is None:
+        out.append(U8.pack(0))
+        return
+    out.append(FALLBACK.pack(1, v['leader'], v['groupid']))
+    _pack_uuids(out, v['group'])
+
+def _unpack_fallback(data, off):
+    if U8.unpack_from(data, off)[0] == 0:
+        return None, off+1
+    (_, leader, groupid) = FALLBACK.unpack_from(data, off)
+    group, off = _unpack_uuids(data, off+FALLBACK.size)
+    return {'leader': leader, 'group': group, 'groupid': groupid}, off
+
+KINDS = {
+    'u8': _pack_fixed(U8),
+    'u16': _pack_fixed(U16),
+    'u32': _pack_fixed(U32),
+    'f64': _pack_fixed(F64),
+    'bool': (_pack_bool, _unpack_bool),
+    'uuids': (_pack_uuids, _unpack_uuids),
+    'fallback': (_pack_fallback, _unpack_fallback),
+}
+
+# (tag, msg, [(field, kind), ...])
+MESSAGES = [
+    # gm
+    (1, 'AreYouCoordinator', []),
+    (2, 'AYCResponse', [('resp', 'bool'), ('leader', 'u16')]),
+    (3, 'AreYouThere', [('groupid', 'u32')]),
+    (4, 'AYTResponse', [('resp', 'bool'), ('groupid', 'u32'), ('members', 'uuids')]),
+    (5, 'Invite', [('pendingid', 'u32'), ('leader', 'u16')]),
+    (6, 'Accept', []),
+    (7, 'Ready', [('groupid', 'u32'), ('members', 'uuids'), ('leader', 'u16'),
+                  ('split', 'bool'), ('fallback', 'fallback'), ('fallback2', 'fallback')]),
+    (8, 'ReadyAck', [('groupid', 'u32')]),
+    (9, 'Fallback', []),
+    (10, 'Peerlist', [('members', 'uuids'), ('leader', 'u16'), ('congestion', 'u8')]),
+    # lb
+    (16, 'StateChange', [('state', 'u8')]),
+    (17, 'DraftRequest', [('counter', 'u32')]),
+    (18, 'DraftAge', [('age', 'f64'), ('counter', 'u32')]),
+    (19, 'DraftSelect', [('step', 'f64'), ('counter', 'u32')]),
+    (20, 'DraftAccept', [('counter', 'u32')]),
+    (21, 'TooLate', [('counter', 'u32')]),
+]
+
+ENVELOPE = 0
+BROADCAST = 255
+
+TAGS = dict([ (name, tag) for (tag, name, _) in MESSAGES ])
+NAMES = dict([ (tag, name) for (tag, name, _) in MESSAGES ])
+LAYOUTS = dict([ (tag, fields) for (tag, _, fields) in MESSAGES ])
+FIELDS = dict([ (tag, [ (f, KINDS[k]) for (f, k) in fields ]) for (tag, _, fields) in MESSAGES ])
+
+_constant_cache = {}
+
+def encode(msg):
+    tag = TAGS[msg['msg']]
+    fields = FIELDS[tag]
+    if not fields:
+        key = (tag, msg['module'])
+        try:
+            return _constant_cache[key]
+        except KeyError:
+            data = HEADER.pack(tag, MODULE_TAGS[msg['module']])
+            _constant_cache[key] = data
+            return data
+    out = [HEADER.pack(tag, MODULE_TAGS[msg['module']])]
+    for (f, (pack, _)) in fields:
+        pack(out, msg[f])
+    return "".join(out)
+
+def encode_envelope(msgs):
+    if len(msgs) == 1:
+        return encode(msgs[0])
+    out = [HEADER.pack(ENVELOPE, MODULE_TAGS['all']), U16.pack(len(msgs))]
+    out.extend(map(encode, msgs))
+    return "".join(out)
+
+def encode_broadcast(dests, msg):
+    out = [HEADER.pack(BROADCAST, MODULE_TAGS['all'])]
+    _pack_uuids(out, dests)
+    out.append(encode(msg))
+    return "".join(out)
+
+def decode(data, off=0):
+    msg, _ = decode_from(data, off)
+    return msg
+
+def decode_from(data, off):
+    (tag, mod) = HEADER.unpack_from(data, off)
+    off += HEADER.size
+    if tag == ENVELOPE:
+        (n,) = U16.unpack_from(data, off)
+        off += U16.size
+        msgs = []
+        for _ in range(n):
+            m, off = decode_from(data, off)
+            msgs.append(m)
+        return {'msg': 'Envelope', 'module': MODULES[mod], 'messages': msgs}, off
+    if tag == BROADCAST:
+        dests, off = _unpack_uuids(data, off)
+        m, off = decode_from(data, off)
+        return {'msg': 'Broadcast', 'module': MODULES[mod], 'to': dests, 'message': m}, off
+    msg = {'msg': NAMES[tag], 'module': MODULES[mod]}
+    for (f, (_, unpack)) in FIELDS[tag]:
+        msg[f], off = unpack(data, off)
+    return msg, off
@@ -1,8 +1,16 @@
-import logging
 import json
 import base64
 
-cm_logging = logging.getLogger('cm_logging')
+from collections import deque
+
+import codec
+from tracing import ProtocolTrace, SEND, BCAST, EVERYONE
+
+# UdpPy joins this group and the router forwards it between the two LANs,
+# so one datagram reaches every DGI.
+BROADCAST_GROUP = "224.1.1.2"
+# Fewer recipients than this just get unicasts.
+BROADCAST_MIN_RECIPIENTS = 2
 
 def trans_uuid2nid(nid2uuid, uuid):
     for nid,v in enumerate(nid2uuid):
@@ -13,21 +21,56 @@ class ConnectionManager(object):
     def __init__(self, ecns = []):
         self.connections = {}
         self.peers = set()
-        self.oqueue = []
+        self.oqueues = {}
         self.sim_time = 0
-        self.troll_queue = []
+        self.troll_queues = {}
         self.trolls = []
-        
+
     def channel(self, uuida, uuidb):
-        t1 = min(uuida,uuidb)
-        t2 = max(uuida,uuidb)
-        if (t1,t2) not in self.connections:
+        """
+        The endpoint uuida sends through. Every pair used to get its own
+        Connection; now there is one per sender, since the sender is all a
+        Connection ever needed to know.
+        """
+        try:
+            c = self.connections[uuida]
+        except KeyError:
             self.add_peer(uuida)
-            self.add_peer(uuidb)
-            c = Connection(self.oqueue, t1, t2)
-            self.connections[(t1,t2)] = c
-        return self.connections[(t1,t2)]
-        
+            c = Connection(self, uuida)
+            self.connections[uuida] = c
+        self.add_peer(uuidb)
+        return c
+
+    def send(self, sender, dest, msg):
+        if ProtocolTrace.enabled:
+            ProtocolTrace.record(SEND, self.sim_time, sender, dest, msg)
+        self.peers.add(dest)
+        try:
+            self.oqueues[sender].append((dest, msg))
+        except KeyError:
+            self.peers.add(sender)
+            self.oqueues[sender] = deque([(dest, msg)])
+
+    def broadcast(self, sender, dests, msg):
+        """
+        Sends msg to every uuid in dests. Large fan-outs go out as a single
+        broadcast datagram that receivers not in dests ignore.
+        """
+        dests = tuple([ d for d in dests if d != sender ])
+        if len(dests) < BROADCAST_MIN_RECIPIENTS:
+            for d in dests:
+                self.send(sender, d, msg)
+            return
+        # A tuple of uuids in place of the destination marks a broadcast.
+        if ProtocolTrace.enabled:
+            ProtocolTrace.record(BCAST, self.sim_time, sender, EVERYONE, msg)
+        self.peers.update(dests)
+        try:
+            self.oqueues[sender].append((dests, msg))
+        except KeyError:
+            self.peers.add(sender)
+            self.oqueues[sender] = deque([(dests, msg)])
+
     def add_peer(self, uuid):
         self.peers.add(uuid)
 
@@ -35,25 +78,55 @@ class ConnectionManager(object):
         self.trolls.append({'ip':ip, 'port': port})
         
     def notify_trolls(self, leader, group):
-        self.troll_queue.append({'leader': leader, 'group':group})
+        try:
+            self.troll_queues[leader].append({'leader': leader, 'group':group})
+        except KeyError:
+            self.troll_queues[leader] = deque([{'leader': leader, 'group':group}])
 
-    def make_commands(self, nid2ip):
+    def make_commands(self, registry, sender):
+        """
+        Turns everything sender has queued into send actions, one per
+        destination. Only the sender's own traffic goes out, since these
+        commands are executed by the sender's UdpPy.
+        """
         o = []
-        while self.oqueue:
-            (f, t, msg) = self.oqueue.pop(0)
-            ip = nid2ip[t].ip if f != t else "127.0.0.1"
-            dbg = "{}s: SEND F: {} T: {} -- {}".format(self.sim_time, f, t, msg),
-            cm_logging.debug(dbg)
-            c = {
-                u'action': u'send',
-                u'destination_ipv4': nid2ip[t].ip,
-                u'destination_port': 9,
-                u'packet': base64.b64encode(json.dumps(msg))
-            }
+        uuid2ip = registry.uuid2ip
+        oqueue = self.oqueues.get(sender)
+        # Everything for the same destination travels in one datagram, which
+        # goes out where the first of those messages was queued. Broadcasts
+        # keep their place in the queue.
+        bydest = {}
+        order = []
+        while oqueue:
+            (t, msg) = oqueue.popleft()
+            if type(t) is tuple:
+                order.append((t, msg))
+                continue
+            try:
+                bydest[t].append(msg)
+            except KeyError:
+                bydest[t] = [msg]
+                order.append((t, None))
+        for (t, msg) in order:
+            if msg is None:
+                c = {
+                    u'action': u'send',
+                    u'destination_ipv4': uuid2ip[t],
+                    u'destination_port': 9,
+                    u'packet': base64.b64encode(codec.encode_envelope(bydest[t]))
+                }
+            else:
+                c = {
+                    u'action': u'broadcast',
+                    u'destination_ipv4': BROADCAST_GROUP,
+                    u'destination_port': 9,
+                    u'packet': base64.b64encode(codec.encode_broadcast(t, msg))
+                }
             o.append(c)
-        while self.troll_queue:
-            config = self.troll_queue.pop(0)
-            msg = {'leader': nid2ip[config['leader']].ip, 'group': map(lambda x: nid2ip[x].ip, config['group'])}
+        troll_queue = self.troll_queues.get(sender)
+        while troll_queue:
+            config = troll_queue.popleft()
+            msg = {'leader': uuid2ip[config['leader']], 'group': [ uuid2ip[x] for x in config['group'] ]}
             for troll in self.trolls:
                 c = {
                     u'action': u'send',
@@ -65,14 +138,9 @@ class ConnectionManager(object):
         return o
 
 class Connection(object):
-    def __init__(self, oqueue, uuida, uuidb):
-        self.uuida = min(uuida,uuidb)
-        self.uuidb = max(uuida,uuidb)
-        self.oqueue = oqueue
+    def __init__(self, connmgr, sender):
+        self.connmgr = connmgr
+        self.sender = sender
 
     def send(self, dest, msg):
-        if self.uuida == dest:
-            sender = self.uuidb
-        else:
-            sender = self.uuida
-        self.oqueue.append((sender, dest, msg))
+        self.connmgr.send(self.sender, dest, msg)
@@ -0,0 +1,87 @@
+"""
+Everything one simulation keeps in process-wide state, in one object.
+
+The protocol code keeps its state where it always has: module globals,
+static class attributes, the random module and settings. A
+SimulationContext holds its own copy of all of it and swaps it in while
+it's active, so each context behaves like a fresh process and several can
+take turns in one:
+
+    with SimulationContext(SCHEDULING_SIGMA=2.0):
+        simulator.simulate()
+"""
+
+import random
+
+import gm
+import lb
+import main as rpc
+import settings
+
+from schedule import ScheduleCommand
+from tracing import ProtocolTrace
+
+# (owner, attribute, makes a fresh value)
+STATE = [
+    (gm, 'GROUPCOUNTER', lambda: 0),
+    (gm.GlobalGMTrace, 'sizes', dict),
+    (gm.GlobalGMTrace, 'ecns', dict),
+    (lb.GlobalLBTrace, 'traces', dict),
+    (lb.GlobalLBTrace, 'losses', dict),
+    (ScheduleCommand, 'scheduled', dict),
+    (ScheduleCommand, 'sid_counter', lambda: 10000),
+    (ScheduleCommand, 'log', list),
+    (ProtocolTrace, 'enabled', lambda: False),
+    (ProtocolTrace, 'capacity', lambda: 0),
+    (ProtocolTrace, 'buf', lambda: None),
+    (ProtocolTrace, 'count', lambda: 0),
+    (ProtocolTrace, 'wrapped', lambda: False),
+    (ProtocolTrace, 'fp', lambda: None),
+]
+
+# Built by main.make_state once everything above is in place
+MAIN_STATE = ['CM', 'DGIs', 'UUIDs', 'REG', 'WHEEL']
+
+class SimulationContext(object):
+    def __init__(self, **overrides):
+        """
+        overrides are settings to use instead of those in settings.py while
+        the context is active.
+        """
+        for k in overrides:
+            if not hasattr(settings, k):
+                raise AttributeError("settings has no {}".format(k))
+        self.settings = overrides
+        self.state = dict([ ((owner, name), fresh()) for (owner, name, fresh) in STATE ])
+        self.random_state = random.Random(overrides.get('SEED', settings.SEED)).getstate()
+        self.saved = None
+        with self:
+            for (name, value) in zip(MAIN_STATE, rpc.make_state()):
+                setattr(rpc, name, value)
+
+    def _keys(self):
+        return [ (owner, name) for (owner, name, _) in STATE ] + \
+               [ (rpc, name) for name in MAIN_STATE ] + \
+               [ (settings, name) for name in self.settings ]
+
+    def __enter__(self):
+        if self.saved is not None:
+            raise RuntimeError("SimulationContext is already active")
+        self.saved = dict([ (key, getattr(*key)) for key in self._keys() ])
+        self.saved_random = random.getstate()
+        for ((owner, name), value) in self.state.iteritems():
+            setattr(owner, name, value)
+        for (name, value) in self.settings.iteritems():
+            setattr(settings, name, value)
+        random.setstate(self.random_state)
+        return self
+
+    def __exit__(self, *exc):
+        for (owner, name) in self._keys():
+            if owner is not settings:
+                self.state[(owner, name)] = getattr(owner, name)
+            setattr(owner, name, self.saved[(owner, name)])
+        self.random_state = random.getstate()
+        random.setstate(self.saved_random)
+        self.saved = None
+        return False
@@ -1,3 +1,21 @@
+"""
+Splits N+M processes into two groups of N and M, scoring each group with
+score_group, and looks for the split whose worse group scores lowest.
+
+A group's leader is its smallest process. Every other member that sits on
+the far side of the router from its leader costs alpha, and every member
+costs beta times its power value. configurations() lists every split, which
+is only usable for a handful of processes; solve() finds the same optimum
+by branch and bound, or with dp=True by dynamic programming over power
+value sums:
+
+    python cut.py [N] [M] [dp]
+"""
+
+import sys
+import math
+import time
+import bisect
 import random
 import itertools
 
@@ -12,17 +30,14 @@ def configurations(n_side, m_side):
     l.sort()
     p0 = l.pop(0)
     l = set(l)
-    
+
     s = itertools.combinations(l, N-1)
-    
+
     for g in s:
         g1 = set(list(g) + [p0])
         g2 = l - g1
         yield (g1, g2)
 
-for x in configurations(range(N), range(N,N+M)):
-    print x
-
 def score_group(group, n_side, m_side, pvs):
     l = min(group)
     l_side, o_side = (n_side, m_side) if l in n_side else (m_side, n_side)
@@ -31,15 +46,324 @@ def score_group(group, n_side, m_side, pvs):
 
     score = beta * pvs[l]
     for proc in g:
-        uses_router = proc in o_side 
+        uses_router = proc in o_side
         score += alpha * uses_router + beta * pvs[proc]
-    
+
     return score
 
+def score_split(g1, g2, n_side, m_side, pvs):
+    return max(score_group(g1, n_side, m_side, pvs), score_group(g2, n_side, m_side, pvs))
+
+def brute_force(n_side, m_side, pvs):
+    best = None
+    for (g1, g2) in configurations(n_side, m_side):
+        s = score_split(g1, g2, n_side, m_side, pvs)
+        if best is None or s < best[0]:
+            best = (s, g1, g2)
+    return best
+
+def smallest_sums(values):
+    """
+    table[j][k] is the sum of the k smallest of values[j:].
+    """
+    table = [None] * (len(values) + 1)
+    table[-1] = [0]
+    seen = []
+    for j in xrange(len(values) - 1, -1, -1):
+        bisect.insort(seen, values[j])
+        table[j] = prefix_sums(seen)
+    return table
+
+def prefix_sums(values):
+    sums = [0]
+    for v in values:
+        sums.append(sums[-1] + v)
+    return sums
+
+def bits(mask):
+    """
+    The set bits of mask, lowest first.
+    """
+    return [ i for (i, b) in enumerate(reversed(bin(mask)[2:])) if b == '1' ]
+
+class Instance(object):
+    """
+    The processes in order, as indices: the first group is the one holding
+    process 0 and needs n members. If the second group's leader is lead,
+    processes 0..lead-1 are all in the first group and only those after
+    lead are left to place.
+    """
+    def __init__(self, n_side, m_side, pvs):
+        self.procs = sorted(n_side + m_side)
+        n_side = set(n_side)
+        self.n = len(n_side)
+        self.m = len(self.procs) - self.n
+        self.side = [ 0 if p in n_side else 1 for p in self.procs ]
+        self.pv = [ pvs[p] for p in self.procs ]
+        self.integral = all([ isinstance(x, (int, long)) for x in self.pv + [alpha, beta] ])
+
+    def leads(self):
+        return range(1, min(self.n, len(self.procs) - 1) + 1)
+
+    def least(self, c, e, lo, hi):
+        """
+        The least max(c + beta*P, e - beta*P) can be for P between lo and hi.
+        """
+        f = lambda p: max(c + beta * p, e - beta * p)
+        if not beta:
+            return f(lo)
+        p = min(max((e - c) / (2.0 * beta), lo), hi)
+        if self.integral:
+            return min(f(int(math.floor(p))), f(int(math.ceil(p))))
+        return f(p)
+
+    def subproblem(self, lead):
+        """
+        The processes after lead on each side, the side of process 0 first,
+        and every way of filling the first group from them as
+        (bound, a, b, c, e), best bound first. a and b are how many join
+        from each side; the groups then score c + beta*P and e - beta*P,
+        where P is the power value those a+b bring.
+        """
+        a_side = self.side[0]
+        free = ([], [])
+        for i in xrange(lead + 1, len(self.procs)):
+            free[self.side[i] != a_side].append(i)
+        need = self.n - lead
+        base1 = sum([ beta * self.pv[i] + alpha * (self.side[i] != a_side) for i in xrange(lead) ])
+        base2 = beta * self.pv[lead]
+        total = sum([ self.pv[i] for i in free[0] + free[1] ])
+        low = []
+        high = []
+        for f in free:
+            pv = sorted([ self.pv[i] for i in f ])
+            low.append(prefix_sums(pv))
+            high.append(prefix_sums(pv[::-1]))
+        options = []
+        for a in range(max(0, need - len(free[1])), min(need, len(free[0])) + 1):
+            b = need - a
+            c = base1 + alpha * b
+            # Who in the second group is across the router from its leader
+            far = len(free[1]) - b if self.side[lead] == a_side else len(free[0]) - a
+            e = base2 + beta * total + alpha * far
+            bound = self.least(c, e, low[0][a] + low[1][b], high[0][a] + high[1][b])
+            options.append((bound, a, b, c, e))
+        options.sort()
+        return (free, options)
+
+    def groups(self, lead, chosen):
+        g1 = set([ self.procs[i] for i in range(lead) + list(chosen) ])
+        return (g1, set(self.procs) - g1)
+
+def branch_and_bound(inst, lead, best, floor, stats):
+    """
+    For each way of filling the first group, picks the a and b processes
+    one at a time, biggest power value first, keeping their sum P as it
+    goes. A partial pick is dropped once the range of sums it can still
+    reach can't beat best.
+    Returns whether floor was reached.
+    """
+    (free, options) = inst.subproblem(lead)
+    free = [ sorted(f, key=lambda i: -inst.pv[i]) for f in free ]
+    pv = [ [ inst.pv[i] for i in f ] for f in free ]
+    low = [ smallest_sums(v) for v in pv ]
+    high = [ [ [ -x for x in sums ] for sums in smallest_sums([ -x for x in v ]) ] for v in pv ]
+    chosen = []
+
+    for (bound, a, b, c, e) in options:
+        if bound >= best[0]:
+            stats['pruned'] += 1
+            break
+
+        def reach(s, j, k, p):
+            lo = p + low[s][j][k]
+            hi = p + high[s][j][k]
+            if s == 0:
+                lo += low[1][0][b]
+                hi += high[1][0][b]
+            return inst.least(c, e, lo, hi)
+
+        def search(s, j, k, p):
+            """
+            k more of side s from position j on, with P at p so far.
+            Returns whether this way of filling can't do any better.
+            """
+            stats['nodes'] += 1
+            if s == 2:
+                stats['leaves'] += 1
+                v = max(c + beta * p, e - beta * p)
+                if v < best[0]:
+                    best[:] = [v, inst.groups(lead, chosen)]
+                return best[0] <= bound
+            left = len(pv[s]) - j
+            if k == 0 or k == left:
+                taken = free[s][j:] if k else []
+                chosen.extend(taken)
+                done = search(s + 1, 0, b, p + low[s][j][k])
+                del chosen[len(chosen) - len(taken):]
+                return done
+            take = (reach(s, j + 1, k - 1, p + pv[s][j]), True)
+            skip = (reach(s, j + 1, k, p), False)
+            for (child, taking) in sorted([take, skip]):
+                if child >= best[0]:
+                    stats['pruned'] += 1
+                    continue
+                if taking:
+                    chosen.append(free[s][j])
+                    done = search(s, j + 1, k - 1, p + pv[s][j])
+                    chosen.pop()
+                else:
+                    done = search(s, j + 1, k, p)
+                if done:
+                    return True
+            return False
+
+        search(0, 0, a, 0)
+        if best[0] <= floor:
+            return True
+    return False
+
+class SumTable(object):
+    """
+    Which power value sums each count of processes from one side can make,
+    for every suffix of the processes: masks[lead][s][k] has bit x set if k
+    of the processes after lead on side s have power values summing to
+    k*lo + x. cap bounds k.
+    """
+    def __init__(self, inst, cap):
+        self.inst = inst
+        self.lo = min(inst.pv)
+        masks = [None] * len(inst.procs)
+        reach = [ [1] + [0] * cap for _ in range(2) ]
+        for i in xrange(len(inst.procs) - 1, -1, -1):
+            masks[i] = [ list(reach[0]), list(reach[1]) ]
+            shift = inst.pv[i] - self.lo
+            r = reach[inst.side[i]]
+            for k in xrange(cap, 0, -1):
+                if r[k - 1]:
+                    r[k] |= r[k - 1] << shift
+        self.masks = masks
+
+    def pick(self, lead, s, k, x):
+        """
+        k processes after lead on side s whose shifted power values sum to x.
+        """
+        inst = self.inst
+        chosen = []
+        for i in xrange(lead + 1, len(inst.procs)):
+            if inst.side[i] != s or k == 0:
+                continue
+            if (self.masks[i][s][k] >> x) & 1:
+                continue
+            chosen.append(i)
+            k -= 1
+            x -= inst.pv[i] - self.lo
+        return chosen
+
+def nearest(xs, ys, target):
+    """
+    The pairs from xs and ys (both sorted) whose sums come closest to target
+    from either side.
+    """
+    pairs = []
+    for x in xs:
+        j = bisect.bisect_left(ys, target - x)
+        if j < len(ys):
+            pairs.append((x, ys[j]))
+        if j > 0:
+            pairs.append((x, ys[j - 1]))
+    return pairs
+
+def dynamic(inst, table, lead, best, floor, stats):
+    """
+    Solves lead exactly: for each way of filling the first group the only
+    sums worth trying are the achievable ones either side of where the two
+    scores cross.
+    Returns whether floor was reached.
+    """
+    (free, options) = inst.subproblem(lead)
+    lo = table.lo
+    a_side = inst.side[0]
+    masks = table.masks[lead]
+    for (bound, a, b, c, e) in options:
+        if bound >= best[0]:
+            stats['pruned'] += 1
+            break
+        stats['nodes'] += 1
+        xs = bits(masks[a_side][a])
+        ys = bits(masks[1 - a_side][b])
+        swapped = len(xs) > len(ys)
+        if swapped:
+            (xs, ys) = (ys, xs)
+        target = (e - c) / (2.0 * beta) - (a + b) * lo if beta else 0
+        for (x, y) in nearest(xs, ys, target):
+            stats['leaves'] += 1
+            p = x + y + (a + b) * lo
+            v = max(c + beta * p, e - beta * p)
+            if v < best[0]:
+                (xa, xb) = (y, x) if swapped else (x, y)
+                chosen = table.pick(lead, a_side, a, xa) + table.pick(lead, 1 - a_side, b, xb)
+                best[:] = [v, inst.groups(lead, chosen)]
+            if best[0] <= bound:
+                break
+        if best[0] <= floor:
+            return True
+    return False
+
+def solve(n_side, m_side, pvs, dp=False):
+    """
+    The best split, as (score, g1, g2, stats). g1 has len(n_side) members
+    including the smallest process. dp needs integer power values.
+
+    Every choice of leader for the second group is a separate search,
+    taken in order of how well it could possibly do, and none of them is
+    started once the best split found is as good as the bound.
+    """
+    start = time.time()
+    inst = Instance(n_side, m_side, pvs)
+    stats = {'leads': 0, 'skipped': 0, 'nodes': 0, 'pruned': 0, 'leaves': 0}
+    if inst.m == 0:
+        g1 = set(inst.procs)
+        stats['time'] = time.time() - start
+        return (score_group(g1, n_side, m_side, pvs), g1, set(), stats)
+    bounds = sorted([ (inst.subproblem(lead)[1][0][0], lead) for lead in inst.leads() ])
+    floor = bounds[0][0]
+    stats['bound'] = floor
+    if dp:
+        if not inst.integral:
+            raise ValueError("dp needs integer power values, alpha and beta")
+        table = SumTable(inst, inst.n)
+    best = [float('inf'), None]
+    for (bound, lead) in bounds:
+        if bound >= best[0]:
+            stats['skipped'] += 1
+            continue
+        stats['leads'] += 1
+        if dp:
+            done = dynamic(inst, table, lead, best, floor, stats)
+        else:
+            done = branch_and_bound(inst, lead, best, floor, stats)
+        if done:
+            stats['skipped'] += len(bounds) - stats['leads'] - stats['skipped']
+            break
+    stats['time'] = time.time() - start
+    (g1, g2) = best[1]
+    return (best[0], g1, g2, stats)
+
 def main():
-    all_procs = range(N+M)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else N
+    m = int(sys.argv[2]) if len(sys.argv) > 2 else M
+    dp = len(sys.argv) > 3 and sys.argv[3] == 'dp'
+    all_procs = range(n+m)
     random.shuffle(all_procs)
-    n_side = all_procs[:N]
-    m_side = all_procs[:M]
-    powervalues = dict([ (i,random.randint(-30,30)) for i in range(N+M) ])
-    
+    n_side = all_procs[:n]
+    m_side = all_procs[n:]
+    powervalues = dict([ (i,random.randint(-30,30)) for i in range(n+m) ])
+    (score, g1, g2, stats) = solve(n_side, m_side, powervalues, dp)
+    print "Score: {}".format(score)
+    print "G1: {}".format(sorted(g1))
+    print "G2: {}".format(sorted(g2))
+    print stats
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,318 @@
+"""
+Improves a partition of processes by swapping them between groups,
+Fiduccia-Mattheyses style.
+
+Each pass swaps the best pair it can find, locks both, and carries on
+even through swaps that make things worse, then rolls back to the best
+point it passed, or gives up after PATIENCE swaps without a new best.
+Passes repeat until one doesn't help. What a swap is worth only depends
+on the groups' totals and on each process's power value and side, so
+unlocked processes sit in buckets keyed by those, and the best swap is
+found by looking at the buckets around the value that would even the two
+groups out rather than at every pair. The swaps found for a pair of
+groups are kept until a swap changes one of them.
+
+The criterion says what the groups are scored on: BALANCE is what cut()
+has always aimed for, RouterCost is cut.py's score_group.
+"""
+
+import bisect
+
+import numpy as np
+
+import cut as groups
+
+PATIENCE = 100
+
+class Balance(object):
+    """
+    No group below zero if it can be helped, then groups as even as
+    possible: the spread between the best and worst first, and with more
+    than two groups the sum of squares between those.
+    """
+    leaders = False
+
+    def weight(self):
+        return 1
+
+    def score(self, total, counts, leader):
+        return total
+
+    def cost(self, scores):
+        return (-sum([ min(s, 0) for s in scores ]), max(scores) - min(scores),
+                sum([ s * s for s in scores ]))
+
+BALANCE = Balance()
+
+class RouterCost(object):
+    """
+    score_group from cut.py: every member costs beta times its power
+    value, and those across the router from their leader, the group's
+    smallest process, alpha more. The worst group comes first, then the
+    next worst, and so on.
+    """
+    def __init__(self, alpha=None, beta=None):
+        self.alpha = groups.alpha if alpha is None else alpha
+        self.beta = groups.beta if beta is None else beta
+        self.leaders = bool(self.alpha)
+
+    def weight(self):
+        return self.beta
+
+    def score(self, total, counts, leader):
+        far = sum(counts) - counts[leader] if leader is not None else 0
+        return self.beta * total + self.alpha * far
+
+    def cost(self, scores):
+        return tuple(sorted(scores, reverse=True))
+
+class Refiner(object):
+    def __init__(self, values, parts, criterion=BALANCE, sides=None):
+        """
+        values are the power values, parts the group each process starts
+        in and sides which side of the router it is on, all indexed by
+        process. Sides only matter to criteria that look at leaders.
+        """
+        self.values = np.asarray(values)
+        self.parts = np.array(parts, dtype=np.intp)
+        if sides is None or not criterion.leaders:
+            sides = np.zeros(len(self.values), dtype=np.intp)
+        self.sides = np.asarray(sides, dtype=np.intp)
+        self.criterion = criterion
+        self.k = int(self.parts.max()) + 1 if len(self.parts) else 0
+        self.nsides = int(self.sides.max()) + 1 if len(self.sides) else 1
+        self.totals = [ self.values[self.parts == p].sum().item() for p in range(self.k) ]
+        self.counts = [ np.bincount(self.sides[self.parts == p], minlength=self.nsides).tolist()
+                        for p in range(self.k) ]
+        self.members = [ np.flatnonzero(self.parts == p).tolist() for p in range(self.k) ]
+        self.scores = [ self.score(p) for p in range(self.k) ]
+        self.stats = {'passes': 0, 'swaps': 0, 'kept': 0, 'candidates': 0}
+
+    def leader_side(self, members):
+        return int(self.sides[members[0]]) if members else None
+
+    def score(self, p):
+        return self.criterion.score(self.totals[p], self.counts[p], self.leader_side(self.members[p]))
+
+    def cost(self):
+        return self.criterion.cost(self.scores)
+
+    def swapped_score(self, p, u, v):
+        """
+        What group p would score with u swapped out for v.
+        """
+        members = self.members[p]
+        rest = members[0] if members[0] != u else (members[1] if len(members) > 1 else None)
+        leader = v if rest is None or v < rest else rest
+        counts = list(self.counts[p])
+        counts[self.sides[u]] -= 1
+        counts[self.sides[v]] += 1
+        total = self.totals[p] - self.values[u] + self.values[v]
+        return self.criterion.score(total, counts, int(self.sides[leader]))
+
+    def swap(self, u, v):
+        (a, b) = (self.parts[u], self.parts[v])
+        for (p, out, into) in ((a, u, v), (b, v, u)):
+            self.counts[p][self.sides[out]] -= 1
+            self.counts[p][self.sides[into]] += 1
+            members = self.members[p]
+            del members[bisect.bisect_left(members, out)]
+            bisect.insort(members, into)
+            # Summed afresh, the same way as to start with, so rounding
+            # can't pass for an improvement and keep the passes going
+            self.totals[p] = self.values[members].sum().item()
+            self.scores[p] = self.score(p)
+        self.parts[u] = b
+        self.parts[v] = a
+
+    def buckets(self):
+        """
+        buckets[p][s] maps each power value to the unlocked processes with
+        it in group p on side s. keys[p][s] is those values, sorted.
+        """
+        buckets = [ [ {} for _ in range(self.nsides) ] for _ in range(self.k) ]
+        for i in xrange(len(self.values)):
+            buckets[self.parts[i]][self.sides[i]].setdefault(self.values[i].item(), set()).add(i)
+        keys = [ [ sorted(b) for b in bs ] for bs in buckets ]
+        return (buckets, keys)
+
+    def rest(self, p, out):
+        """
+        The smallest process left in p without out.
+        """
+        members = self.members[p]
+        if members[0] != out:
+            return members[0]
+        return members[1] if len(members) > 1 else None
+
+    def target(self, a, b, su, sv, lead_a, lead_b):
+        """
+        How much more power value the process coming from b should have
+        than the one leaving a to even the two out, if their leaders end
+        up on sides lead_a and lead_b.
+        """
+        w = self.criterion.weight()
+        if not w:
+            return 0
+        counts_a = list(self.counts[a])
+        counts_a[su] -= 1
+        counts_a[sv] += 1
+        counts_b = list(self.counts[b])
+        counts_b[sv] -= 1
+        counts_b[su] += 1
+        sa = self.criterion.score(self.totals[a], counts_a, lead_a)
+        sb = self.criterion.score(self.totals[b], counts_b, lead_b)
+        return (sb - sa) / (2.0 * w)
+
+    def unlocked(self, buckets, i):
+        return i in buckets[self.parts[i]][self.sides[i]].get(self.values[i].item(), ())
+
+    def nearest(self, xs, ys, t):
+        """
+        The (x, y) pairs whose y - x is closest to t from below and from
+        above.
+        """
+        (xs, ys) = (np.asarray(xs), np.asarray(ys))
+        j = np.searchsorted(ys, xs + t)
+        for (i, step, pick) in ((np.flatnonzero(j > 0), -1, np.argmax),
+                                (np.flatnonzero(j < len(ys)), 0, np.argmin)):
+            if len(i):
+                m = i[pick(ys[j[i] + step] - xs[i])]
+                yield (xs[m].item(), ys[j[m] + step].item())
+
+    def candidates(self, a, b, su, sv, buckets, keys):
+        """
+        The swaps between side su of a and side sv of b worth scoring.
+        Without leaders a swap is only worth the difference in power value
+        it moves, so the pairs nearest the target from either side are
+        enough. With them, the processes of b that would lead either
+        group are tried one by one, and from the rest, which only differ
+        in power value, the nearest on either side of the target.
+        """
+        (xs, ys) = (keys[a][su], keys[b][sv])
+        if not self.criterion.leaders:
+            for (x, y) in self.nearest(xs, ys, self.target(a, b, su, sv, None, None)):
+                yield (next(iter(buckets[a][su][x])), next(iter(buckets[b][sv][y])))
+            return
+        for u in self.stand_ins(a, b, su, buckets, keys):
+            x = self.values[u].item()
+            rest_a = self.rest(a, u)
+            lead = self.members[b][0]
+            # Those that would take over a, and b's leader, are tried one
+            # by one; the others only differ in power value
+            for v in self.members[b]:
+                if v != lead and rest_a is not None and v > rest_a:
+                    break
+                if self.sides[v] == sv and self.unlocked(buckets, v):
+                    yield (u, v)
+            if rest_a is None:
+                continue
+            lead_b = su if u < lead else int(self.sides[lead])
+            j = bisect.bisect_left(ys, x + self.target(a, b, su, sv, int(self.sides[rest_a]), lead_b))
+            for js in (xrange(j - 1, -1, -1), xrange(j, len(ys))):
+                for y in js:
+                    v = max(buckets[b][sv][ys[y]])
+                    if v > rest_a and v != lead:
+                        yield (u, v)
+                        break
+
+    def stand_ins(self, a, b, su, buckets, keys):
+        """
+        The processes on side su of a whose swaps with b get scored: a's
+        leader and those that could take over b one by one, and the
+        largest of each bucket for the rest, which all score the same.
+        """
+        members = self.members[b]
+        low = members[1] if len(members) > 1 else members[0]
+        us = set([ max(buckets[a][su][x]) for x in keys[a][su] ])
+        for u in self.members[a]:
+            if u > low and u != self.members[a][0]:
+                break
+            if self.sides[u] == su and self.unlocked(buckets, u):
+                us.add(u)
+        return sorted(us)
+
+    def best_swap(self, buckets, keys, cache):
+        """
+        The best swap left and its cost. Which swaps between two groups
+        are worth scoring only depends on those two, so cache keeps them
+        per pair of groups until either changes.
+        """
+        best = None
+        for a in range(self.k):
+            for b in range(a + 1, self.k):
+                if (a, b) not in cache:
+                    cache[(a, b)] = [ swap for su in range(self.nsides) for sv in range(self.nsides)
+                                      if keys[a][su] and keys[b][sv]
+                                      for swap in self.candidates(a, b, su, sv, buckets, keys) ]
+                for (u, v) in cache[(a, b)]:
+                    scores = list(self.scores)
+                    scores[a] = self.swapped_score(a, u, v)
+                    scores[b] = self.swapped_score(b, v, u)
+                    self.stats['candidates'] += 1
+                    cost = self.criterion.cost(scores)
+                    if best is None or cost < best[0]:
+                        best = (cost, u, v)
+        return best
+
+    def forget(self, cache, a, b):
+        for pair in [ pair for pair in cache if a in pair or b in pair ]:
+            del cache[pair]
+
+    def lock(self, buckets, keys, i):
+        (p, s, x) = (self.parts[i], self.sides[i], self.values[i].item())
+        bucket = buckets[p][s][x]
+        bucket.remove(i)
+        if not bucket:
+            del buckets[p][s][x]
+            del keys[p][s][bisect.bisect_left(keys[p][s], x)]
+
+    def run_pass(self, patience=None):
+        """
+        One pass. patience stops it after that many swaps without a new
+        best, None lets it run until every process is locked. Returns
+        whether it improved on where it started.
+        """
+        (buckets, keys) = self.buckets()
+        cache = {}
+        start = best = self.cost()
+        swaps = []
+        kept = 0
+        while patience is None or len(swaps) - kept < patience:
+            found = self.best_swap(buckets, keys, cache)
+            if found is None:
+                break
+            (_, u, v) = found
+            self.lock(buckets, keys, u)
+            self.lock(buckets, keys, v)
+            self.forget(cache, self.parts[u], self.parts[v])
+            self.swap(u, v)
+            swaps.append((u, v))
+            cost = self.cost()
+            if cost < best:
+                best = cost
+                kept = len(swaps)
+        for (u, v) in reversed(swaps[kept:]):
+            self.swap(u, v)
+        self.stats['passes'] += 1
+        self.stats['swaps'] += len(swaps)
+        self.stats['kept'] += kept
+        return best < start
+
+    def run(self, passes=None, patience=PATIENCE):
+        while passes is None or self.stats['passes'] < passes:
+            if not self.run_pass(patience):
+                break
+        return self.parts
+
+def refine(values, parts, criterion=BALANCE, sides=None, passes=None, patience=PATIENCE):
+    """
+    The improved parts, their cost under criterion and the search stats.
+    """
+    r = Refiner(values, parts, criterion, sides)
+    r.run(passes, patience)
+    return (r.parts, r.cost(), r.stats)
+
 def score(side):
     s = 0.0
     for k in side:
@@ -5,45 +320,14 @@ def score(side):
     return s
 
 def cut(left, right):
-    closed = set()
-    ls = score(left)
-    rs = score(right)
+    keys = list(left) + list(right)
+    values = [ left[k] for k in left ] + [ right[k] for k in right ]
+    parts = [0] * len(left) + [1] * len(right)
+    (parts, _, _) = refine(values, parts)
     nl = {}
     nr = {}
-    for k1 in left:
-        v1 = left[k1]
-        for k2 in right:
-            if k2 in closed:
-                continue
-            v2 = right[k2]
-            newleft = ls-v1+v2
-            newright = rs-v2+v1
-            print "{} {} -> {} {}".format(k1,k2,newleft,newright)
-            if ls < 0 and rs < 0:
-                swap = (abs(newleft-newright) < abs(ls-rs))
-            else:
-                btrleft = newleft > ls
-                btrright = newright > rs
-                t1 = btrright or (rs >= 0 and newright >=0 and abs(newleft-newright) < abs(ls-rs))
-                t2 = btrleft or (ls >= 0 and newleft >=0 and abs(newleft-newright) < abs(ls-rs))
-                swap = (btrleft and t1) or (btrright and t2)
-            
-            
-            if swap:
-                tmp1 = (k1, v1)
-                tmp2 = (k2, v2)
-                nl[k2] = v2
-                nr[k1] = v1
-                closed.add(k2)
-                ls = newleft
-                rs = newright
-                break
-        else:
-            nl[k1] = left[k1]
-    for k2 in right:
-        if k2 in closed:
-            continue
-        nr[k2] = right[k2]
+    for (k, v, p) in zip(keys, values, parts):
+        (nl if p == 0 else nr)[k] = v
     return nl, nr
 
 
@@ -65,4 +349,5 @@ def test():
     print "Out right: {}".format(score(r2))
     print r2
 
-test()
+if __name__ == "__main__":
+    test()
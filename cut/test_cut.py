@@ -0,0 +1,53 @@
+import random
+import unittest
+
+import cut
+
+class SolveTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (cut.N, cut.alpha, cut.beta)
+
+    def tearDown(self):
+        (cut.N, cut.alpha, cut.beta) = self.saved
+
+    def check(self, n, m, pvs, dp=False):
+        procs = range(n + m)
+        rand = random.Random(n * 100 + m)
+        rand.shuffle(procs)
+        (n_side, m_side) = (procs[:n], procs[n:])
+        # configurations() splits off N processes
+        cut.N = n
+        want = cut.brute_force(n_side, m_side, pvs)[0]
+        (score, g1, g2, stats) = cut.solve(n_side, m_side, pvs, dp)
+        self.assertEqual(score, want, (n, m, pvs, dp))
+        self.assertEqual(len(g1), n)
+        self.assertIn(0, g1)
+        self.assertEqual(sorted(g1 | g2), range(n + m))
+        self.assertEqual(cut.score_split(g1, g2, n_side, m_side, pvs), score)
+
+    def test_branch_and_bound(self):
+        rand = random.Random(1)
+        for _ in range(150):
+            (n, m) = (rand.randint(1, 6), rand.randint(1, 6))
+            (cut.alpha, cut.beta) = (rand.randint(0, 8), rand.randint(1, 3))
+            pvs = dict([ (i, rand.randint(-30, 30)) for i in range(n + m) ])
+            self.check(n, m, pvs)
+
+    def test_dynamic(self):
+        rand = random.Random(2)
+        for _ in range(150):
+            (n, m) = (rand.randint(1, 6), rand.randint(1, 6))
+            (cut.alpha, cut.beta) = (rand.randint(0, 8), rand.randint(1, 3))
+            pvs = dict([ (i, rand.randint(-30, 30)) for i in range(n + m) ])
+            self.check(n, m, pvs, dp=True)
+
+    def test_fractional(self):
+        rand = random.Random(3)
+        for _ in range(50):
+            (n, m) = (rand.randint(1, 6), rand.randint(1, 6))
+            pvs = dict([ (i, rand.randint(-60, 60) / 4.0) for i in range(n + m) ])
+            self.check(n, m, pvs)
+            self.assertRaises(ValueError, cut.solve, range(n), range(n, n + m), pvs, True)
+
+if __name__ == "__main__":
+    unittest.main()
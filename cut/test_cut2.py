@@ -0,0 +1,83 @@
+import random
+import unittest
+
+import cut2
+
+def exhaustive(r, locked):
+    """
+    The cost of the best swap between unlocked processes, trying them all.
+    """
+    best = None
+    n = len(r.values)
+    for u in range(n):
+        for v in range(u + 1, n):
+            (a, b) = (r.parts[u], r.parts[v])
+            if a == b or u in locked or v in locked:
+                continue
+            scores = list(r.scores)
+            scores[a] = r.swapped_score(a, u, v)
+            scores[b] = r.swapped_score(b, v, u)
+            cost = r.criterion.cost(scores)
+            if best is None or cost < best:
+                best = cost
+    return best
+
+class BestSwapTest(unittest.TestCase):
+    def check(self, values, parts, sides, criterion, steps=3):
+        r = cut2.Refiner(values, parts, criterion, sides)
+        (buckets, keys) = r.buckets()
+        cache = {}
+        locked = set()
+        for _ in range(steps):
+            found = r.best_swap(buckets, keys, cache)
+            self.assertEqual(exhaustive(r, locked), found[0] if found else None,
+                             (values, parts, sides, criterion.__dict__, sorted(locked)))
+            if found is None:
+                return
+            (_, u, v) = found
+            r.lock(buckets, keys, u)
+            r.lock(buckets, keys, v)
+            r.forget(cache, r.parts[u], r.parts[v])
+            r.swap(u, v)
+            locked |= set([u, v])
+
+    def test_leader_leaving(self):
+        # b's leader is the one leaving, so whether u takes over b depends
+        # on the next smallest in b
+        self.check([10, -6, -4, 2, 3, -4], [0, 1, 0, 1, 1, 0], [1, 1, 0, 1, 0, 0],
+                   cut2.RouterCost(alpha=3, beta=2))
+
+    def test_random(self):
+        rand = random.Random(1)
+        for _ in range(1500):
+            n = rand.randint(2, 10)
+            k = rand.randint(2, min(4, n))
+            parts = range(k) + [ rand.randrange(k) for _ in range(n - k) ]
+            rand.shuffle(parts)
+            # Halves add up exactly, so costs tie when they should
+            values = [ rand.randint(-12, 20) / 2.0 if rand.random() < 0.3 else rand.randint(-6, 10)
+                       for _ in range(n) ]
+            sides = [ rand.randrange(3) for _ in range(n) ]
+            criterion = rand.choice([cut2.BALANCE, cut2.RouterCost(rand.randint(0, 4), rand.randint(1, 3))])
+            self.check(values, parts, sides, criterion)
+
+class RefineTest(unittest.TestCase):
+    def test_keeps_sizes(self):
+        rand = random.Random(2)
+        values = [ rand.uniform(-10, 10) for _ in range(400) ]
+        parts = [ rand.randrange(4) for _ in range(400) ]
+        start = cut2.Refiner(values, parts).cost()
+        (refined, cost, stats) = cut2.refine(values, parts)
+        self.assertEqual(sorted(refined.tolist()), sorted(parts))
+        self.assertLessEqual(cost, start)
+        self.assertEqual(cost, cut2.Refiner(values, refined).cost())
+
+    def test_cut(self):
+        left = dict(zip(range(4), [5, 5, 5, 5]))
+        right = dict(zip(range(4, 8), [-5, -5, -5, -5]))
+        (l, r) = cut2.cut(left, right)
+        self.assertEqual(len(l), 4)
+        self.assertEqual(cut2.score(l), cut2.score(r))
+
+if __name__ == "__main__":
+    unittest.main()
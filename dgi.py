@@ -15,7 +15,15 @@ class DGI(object):
         self.sigma = 0
         
     def receive(self, sender, message, **kwargs):
-        print message
+        if message['msg'] == 'Broadcast':
+            if self.uuid not in message['to']:
+                return []
+            return self.receive(sender, message['message'], **kwargs)
+        if message['msg'] == 'Envelope':
+            r = []
+            for m in message['messages']:
+                r += self.receive(sender, m, **kwargs)
+            return r
         if message['module'] == 'all':
             r = []
             for k in self.modules:
@@ -0,0 +1,83 @@
+"""
+A standalone RPC server for UdpPy that doesn't need Flask.
+
+Every message in either direction is a 4 byte big-endian length followed by
+that many bytes of json. A frame holds either a single call or an array of
+calls, exactly like the body of a PUT to main.rpc_serv, and gets the same
+answer back.
+
+    python framed.py /tmp/ns3-rpc.sock    # unix domain socket
+    python framed.py 127.0.0.1:5000       # loopback tcp
+"""
+
+import os
+import sys
+import socket
+import struct
+
+import main as rpc
+
+HEADER = struct.Struct("!I")
+
+def recv_exactly(conn, n):
+    chunks = []
+    while n > 0:
+        chunk = conn.recv(n)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return "".join(chunks)
+
+def read_frame(conn):
+    header = recv_exactly(conn, HEADER.size)
+    if header is None:
+        return None
+    (length,) = HEADER.unpack(header)
+    if length == 0:
+        return ""
+    return recv_exactly(conn, length)
+
+def write_frame(conn, data):
+    conn.sendall(HEADER.pack(len(data)) + data)
+
+def handle(conn):
+    while True:
+        data = read_frame(conn)
+        if data is None:
+            break
+        write_frame(conn, rpc.handle_rpc(data))
+    conn.close()
+
+def parse_address(addr):
+    if ':' in addr and not addr.startswith('/'):
+        host, port = addr.rsplit(':', 1)
+        return (host, int(port))
+    return addr
+
+def serve(address):
+    if isinstance(address, tuple):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(address)
+    sock.listen(1)
+    # ns-3 is single threaded and every UdpPy shares one connection, so
+    # there's never more than one client to talk to at a time.
+    while True:
+        conn, _ = sock.accept()
+        if isinstance(address, tuple):
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handle(conn)
+
+def main():
+    address = parse_address(sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1:5000")
+    rpc.save_net_layout()
+    rpc.setup_logging()
+    serve(address)
+
+if __name__ == "__main__":
+    main()
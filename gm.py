@@ -3,6 +3,7 @@ import logging
 import settings
 
 from schedule import ScheduleCommand
+from tracing import ProtocolTrace, RECV
 
 GROUPCOUNTER = 0
 
@@ -119,16 +120,18 @@ class GM(object):
         self.send(self.uuid, message, dest_mod='lb')
 
     def send(self, peer, msg, dest_mod='gm'):
-        dbg = "{}s: SEND F: {} T: {} -- {}".format(self.sim_time, self.uuid, peer, msg)
-        gm_logging.debug(dbg)
         msg['module'] = dest_mod
-        self.connmgr.channel(self.uuid,peer).send(peer, msg)
+        self.connmgr.send(self.uuid, peer, msg)
+
+    def broadcast(self, peers, msg, dest_mod='gm'):
+        msg['module'] = dest_mod
+        self.connmgr.broadcast(self.uuid, peers, msg)
 
     def check(self):
         self.step = 1
-        gm_logging.debug("{}s: DGI({}).check MNT={}".format(self.sim_time, self.uuid, self.maintain))
+        gm_logging.debug("%ss: DGI(%s).check MNT=%s", self.sim_time, self.uuid, self.maintain)
         if self.splitting:
-            gm_logging.debug("Check exit@{}: splitting".format(self.uuid))
+            gm_logging.debug("Check exit@%s: splitting", self.uuid)
             return []
         #self.sawayc = False
         self.expected = []
@@ -138,23 +141,18 @@ class GM(object):
         self.pendingid = 0
         if self.is_leader():
             checklist = self.connmgr.peers if not self.maintain else self.group
-            for peer in checklist:
-                if self.uuid == peer:
-                    continue
-                self.send(peer, {'msg': "AreYouCoordinator"})
-                self.expected.append(peer)
+            checklist = [ peer for peer in checklist if peer != self.uuid ]
+            self.broadcast(checklist, {'msg': "AreYouCoordinator"})
+            self.expected += checklist
         else:
             if not self.maintain:
-                for peer in self.connmgr.peers:
-                    if peer >= self.uuid:
-                        continue
-                    if peer == self.leader:
-                        continue
-                    self.send(peer, {'msg': "AreYouCoordinator"})
-                    self.expected.append(peer)
+                checklist = [ peer for peer in self.connmgr.peers
+                              if peer < self.uuid and peer != self.leader ]
+                self.broadcast(checklist, {'msg': "AreYouCoordinator"})
+                self.expected += checklist
             self.expected.append(self.leader)
             self.send(self.leader, {'msg':"AreYouThere", 'groupid': self.groupid})
-            gm_logging.debug("Member {} expects {}".format(self.uuid, self.expected))
+            gm_logging.debug("Member %s expects %s", self.uuid, self.expected)
 
         return []
 
@@ -164,11 +162,11 @@ class GM(object):
         self.step = 2
         self.coordinators.sort()
         self.expected.sort()
-        gm_logging.debug("{}s: DGI({}).merge: {}".format(self.sim_time, self.uuid,self.coordinators))
+        gm_logging.debug("%ss: DGI(%s).merge: %s", self.sim_time, self.uuid, self.coordinators)
         if self.maintain:
             return []
         if self.expected:
-            gm_logging.debug("{}s DGI({}) still expects {}".format(self.sim_time, self.uuid, self.expected))
+            gm_logging.debug("%ss DGI(%s) still expects %s", self.sim_time, self.uuid, self.expected)
         self.pending = []
         groupchange = False
         if self.is_leader() and self.pendingldr >= self.uuid:
@@ -202,7 +200,7 @@ class GM(object):
         if self.splitting:
             return []
         self.step = 3
-        gm_logging.debug("{}s: DGI({}).ready".format(self.sim_time, self.uuid))
+        gm_logging.debug("%ss: DGI(%s).ready", self.sim_time, self.uuid)
         if self.maintain:
             return []
         # Always send ready
@@ -246,16 +244,16 @@ class GM(object):
                 self.fallback = None
                 g1 = []
 
-            for peer in self.group:
-                fbd = dict(fallback1 if peer in g1 else fallback2) if fallback1 else None
-                self.send(peer, {
-                    'msg': "Ready",
-                    'groupid': self.groupid,
-                    'members': list(self.group),
-                    'leader': self.leader,
-                    'split': False,
-                    'fallback': fbd,
-                })
+            # Everyone gets both halves of the split and keeps their own.
+            self.broadcast(self.group, {
+                'msg': "Ready",
+                'groupid': self.groupid,
+                'members': list(self.group),
+                'leader': self.leader,
+                'split': False,
+                'fallback': fallback1,
+                'fallback2': fallback2,
+            })
             self.new_group(self.leader,self.group,self.groupid)
         return []
 
@@ -263,7 +261,7 @@ class GM(object):
         if self.is_leader():
             self.connmgr.notify_trolls(self.uuid, self.group)
         self.step = 0
-        gm_logging.debug("{}s: DGI({}).cleanup".format(self.sim_time, self.uuid))
+        gm_logging.debug("%ss: DGI(%s).cleanup", self.sim_time, self.uuid)
         if self.is_leader() and not self.splitting:
             for p in self.expected:
                 if p in self.group:
@@ -281,19 +279,17 @@ class GM(object):
         if not self.splitting and self.maintain > 0:
             self.maintain -= 1
         self.splitting = False
-        dbg = "{}s END OF CLEAN {}".format(self.sim_time, self)
-        gm_logging.debug(dbg)
+        gm_logging.debug("%ss END OF CLEAN %s", self.sim_time, self)
         return []
 
     def is_leader(self):
         return self.leader == self.uuid
 
     def receive(self, sender, message):
-        prnt = False #self.uuid == 0 or sender == 0
-        dbg = "{}s: RECV F: {} T: {} -- {}".format(self.sim_time, sender, self.uuid, message)
-        gm_logging.debug(dbg)
         if 'msg' not in message:
             raise KeyError("Bad message {}".format(message))
+        if ProtocolTrace.enabled:
+            ProtocolTrace.record(RECV, self.sim_time, sender, self.uuid, message)
         if message['msg'] == "AreYouCoordinator":
             if self.is_leader():
                 resp = True
@@ -329,7 +325,7 @@ class GM(object):
             if (self.pendingldr == sender or self.leader == sender) and sender != self.uuid:
                 self.new_group(message['leader'], message['members'], message['groupid'])
                 self.sawayc = True
-                self.fallback = message['fallback']
+                self.fallback = self.pick_fallback(message)
                 #assert(not self.is_leader() or self.groupid == self.pendingid)
                 self.send(sender, {'msg': "ReadyAck", 'groupid': self.groupid})
             else:
@@ -340,9 +336,9 @@ class GM(object):
             self.use_fallback()
 
         elif message['msg'] == "AYCResponse":
-            print "{} r-expects {}".format(self.uuid, self.expected)
+            gm_logging.debug("%s r-expects %s", self.uuid, self.expected)
             if self.step != 1:
-                gm_logging.debug("Discard AYC Response @{}: Too late".format(self.uuid))
+                gm_logging.debug("Discard AYC Response @%s: Too late", self.uuid)
             else:
                 if sender in self.expected:
                     self.expected.remove(sender)
@@ -353,7 +349,7 @@ class GM(object):
 
         elif message['msg'] == "AYTResponse":
             if self.step != 1:
-                gm_logging.debug("Discard AYT Response @{}: Too late".format(self.uuid))
+                gm_logging.debug("Discard AYT Response @%s: Too late", self.uuid)
             else:
                 if sender in self.expected:
                     self.expected.remove(sender)
@@ -373,36 +369,38 @@ class GM(object):
         return []
 
     def use_fallback(self):
-        dbg = "{}s: Fallback triggered @{} using {}".format(self.sim_time, self.uuid, self.fallback)
-        gm_logging.debug(dbg)
+        gm_logging.debug("%ss: Fallback triggered @%s using %s", self.sim_time, self.uuid, self.fallback)
         if self.fallback:
             if self.step != 0:
                 self.splitting = True
             self.maintain = 1
             if self.leader == self.uuid:
-                for peer in self.group:
-                    self.send(peer, {
-                        'msg': "Fallback"
-                    })
+                self.broadcast(self.group, {'msg': "Fallback"})
             elif self.fallback['leader'] == self.uuid:
-                for peer in self.fallback['group']:
-                    self.send(peer, {
-                        'msg': "Fallback"
-                    })
+                self.broadcast(self.fallback['group'], {'msg': "Fallback"})
             self.new_group(self.fallback['leader'],
                 list(self.fallback['group']), self.fallback['groupid'])
             self.expected = []
             self.fallback = None
             self.announce_to_lb()
 
+    def pick_fallback(self, message):
+        """
+        Ready carries the fallback for both halves of the split. The second
+        half is the one led by fallback2's leader.
+        """
+        fb2 = message['fallback2']
+        if fb2 and (fb2['leader'] == self.uuid or self.uuid in fb2['group']):
+            return dict(fb2)
+        return dict(message['fallback']) if message['fallback'] else None
+
     def ecn(self, kind):
         GlobalGMTrace.ecnevent(self.uuid, self.sim_time, kind)
-        dbg = "{}s: ECN@{} of type {}".format(self.sim_time, self.uuid, kind)
-        gm_logging.debug(dbg)
+        gm_logging.debug("%ss: ECN@%s of type %s", self.sim_time, self.uuid, kind)
         if (settings.ENABLE_SOFT_ECN and kind == "soft") or ((settings.ENABLE_SOFT_ECN and not settings.ENABLE_HARD_ECN) and kind == "hard"):
             self.maintain = 2
         if settings.ENABLE_HARD_ECN and kind == "hard":
-            gm_logging.debug("ECN@{} Splitting group".format(self.uuid))
+            gm_logging.debug("ECN@%s Splitting group", self.uuid)
             self.use_fallback()
         return []
 
@@ -3,6 +3,7 @@ import logging
 import settings
 
 from schedule import ScheduleCommand
+from tracing import ProtocolTrace, RECV
 
 STEP_SIZE = 1
 
@@ -152,18 +153,17 @@ class LB(object):
 
     def send(self,peer, msg, dest_mod='lb'):
         msg['module'] = dest_mod
-        self.connmgr.channel(self.uuid,peer).send(peer, msg)
+        self.connmgr.send(self.uuid, peer, msg)
 
     def phase_start(self):
         gap = settings.MESSAGE_DELIVERY_GAP
         rounds = self.ROUNDS
         if self.congested:
-            dbg = "{}s: CONGESTED@{}, things are looking nasty.".format(self.sim_time,self.uuid)
+            lb_logging.debug("%ss: CONGESTED@%s, things are looking nasty.", self.sim_time, self.uuid)
             gap = int(gap*settings.CONGESTION_ADJUST)
             rounds = int(rounds/settings.CONGESTION_ADJUST)
         else:
-            dbg = "{}s: NORMAL@{}, no congestion right now".format(self.sim_time,self.uuid)
-        lb_logging.debug(dbg)
+            lb_logging.debug("%ss: NORMAL@%s, no congestion right now", self.sim_time, self.uuid)
         round = 2*gap
         start = int(self.sim_time*1000)
         r = []
@@ -219,12 +219,12 @@ class LB(object):
             self.normal.add(peer)
 
     def receive(self, sender, message):
-        dbg = "{}s: RECV F: {} T: {} -- {}".format(self.sim_time, sender, self.uuid, message),
-        lb_logging.debug(dbg)
         if 'msg' not in message:
             raise KeyError("Bad message {}".format(message))
+        if ProtocolTrace.enabled:
+            ProtocolTrace.record(RECV, self.sim_time, sender, self.uuid, message)
         if sender not in self.group and message['msg'] != "Peerlist":
-            lb_logging.info("Rejected {} from {}: not in group".format(message['msg'], sender))
+            lb_logging.info("Rejected %s from %s: not in group", message['msg'], sender)
             return []
 
         if message['msg'] == 'StateChange':
@@ -1,19 +1,19 @@
-from flask import Flask, request
-
 import json
 import base64
 import logging
 import random
 
+import codec
 import dgi
 import lb
 import gm
 import connectionmanager as cm
+import registry
+import timerwheel
 import settings
 
 from schedule import ScheduleCommand
-
-app = Flask(__name__)
+from tracing import ProtocolTrace
 
 random.seed(settings.SEED)
 
@@ -42,30 +42,87 @@ class Ipv4Node(object):
     def __repr__(self):
         return str(self)
 
-def to_rpcs(objs):
-    return map(lambda x: x.to_rpc(), objs)
-
-def print_state(nid):
+def schedule_rpcs(nid, objs, sim_time):
+    """
+    ScheduleCommands go into the timer wheel and only the first one in each
+    bucket becomes an ns-3 event. Anything else (cancels) passes through.
+    """
+    r = []
+    for obj in objs:
+        if isinstance(obj, ScheduleCommand):
+            obj = WHEEL.add(nid, obj, sim_time)
+            if obj is None:
+                continue
+        r.append(obj.to_rpc())
+    return r
+
+def fire_bucket(wcmd, sim_time):
+    """
+    Runs every command in the bucket for whichever node it belongs to. Each
+    node's sends are tagged with its node id so UdpPy sends them from the
+    right socket.
+    """
+    r = []
+    for (nid, sched) in WHEEL.pop(wcmd):
+        if sched.sid not in ScheduleCommand.scheduled:
+            # Cancelled while it sat in the wheel
+            continue
+        uuid = REG.uuid(nid)
+        if uuid is not None:
+            DGIs[uuid].sim_time(sim_time)
+        r += schedule_rpcs(nid, sched.do(), sim_time)
+        if uuid is not None:
+            for c in CM.make_commands(REG, uuid):
+                c[u'node_id'] = nid
+                r.append(c)
+    return r
+
+def print_state(uuid):
     print "--------------------"
-    print DGIs[nid]
+    print DGIs[uuid]
     return []
 
+def describe(name, uuid):
+    """
+    schedule.dat's label for a command: its function as str() shows it at
+    the end of the run.
+    """
+    if uuid is not None:
+        for k in sorted(DGIs[uuid].modules):
+            fn = getattr(DGIs[uuid].modules[k], name, None)
+            if fn is not None:
+                return str(fn)
+    return name
+
 def save_traces():
     lb.GlobalLBTrace.plot_output()
     gm.GlobalGMTrace.plot_output()
     with open("schedule.dat","w+") as fp:
-        fp.write(ScheduleCommand.summarize())
+        fp.write(ScheduleCommand.summarize(describe))
+    ProtocolTrace.close()
     return []
 
 PROCS = 30
-nodes = {}
-CM = cm.ConnectionManager()
-CM.add_troll("10.1.1.2", 9)
-CM.add_troll("10.1.2.2", 9)
-CM.add_troll("10.1.3.2", 9)
-DGIs = [ dgi.DGI(x,CM) for x in range(PROCS) ]
-UUIDs = range(PROCS)
-#random.shuffle(UUIDs)
+
+def make_state():
+    """
+    The connection manager, DGIs, uuids, registry and timer wheel a
+    simulation runs on.
+    """
+    connmgr = cm.ConnectionManager()
+    connmgr.add_troll("10.1.1.2", 9)
+    connmgr.add_troll("10.1.2.2", 9)
+    connmgr.add_troll("10.1.3.2", 9)
+    dgis = [ dgi.DGI(x,connmgr) for x in range(PROCS) ]
+    uuids = range(PROCS)
+    #random.shuffle(uuids)
+    reg = registry.NodeRegistry(uuids)
+    wheel = timerwheel.TimerWheel(settings.TIMER_BUCKET)
+    for troll in connmgr.trolls:
+        reg.add_troll(troll['ip'])
+    return (connmgr, dgis, uuids, reg, wheel)
+
+(CM, DGIs, UUIDs, REG, WHEEL) = make_state()
 
 def save_net_layout():
     cut = len(UUIDs)/2
@@ -74,20 +131,30 @@ def save_net_layout():
         fp.write("\n")
         fp.write(str(UUIDs[cut:]))
 
-@app.route("/", methods=["GET", "PUT"])
 def rpc_serv():
-    rpc = json.loads(request.data)
+    from flask import request
+    return handle_rpc(request.data)
+
+def handle_rpc(data):
+    """
+    Accepts either a single RPC call or a json array of calls. A batch is
+    answered with an array of responses in the same order.
+    """
+    rpc = json.loads(data)
+    if isinstance(rpc, list):
+        return json.dumps(map(dispatch, rpc))
+    return json.dumps(dispatch(rpc))
+
+def dispatch(rpc):
     #print "GOT {}".format(rpc)
     rid = int(rpc[u'id'])
     nid = int(rpc[u'node_id'])
     sim_time = float(rpc[u'simulation_time'])
 
     CM.sim_time = sim_time
-    try:
-        uuid = nid
+    uuid = REG.uuid(nid)
+    if uuid is not None:
         DGIs[uuid].sim_time(sim_time)
-    except IndexError:
-        uuid = None
     command = rpc['method']
     resp = {
         u'id': rpc[u'id'],
@@ -95,28 +162,30 @@ def rpc_serv():
         u'commands': []
     }
 
-    #print nodes
     if command == u'recv':
         contents = base64.b64decode(rpc[u'params'][u'packet'])
-        try:
-            senderid = [ k for (k,v) in nodes.iteritems() if v.ip == rpc[u'params'][u'sender_ipv4'] ][0]
-            senderuuid = senderid #UUIDs[senderid]
-            scheds = DGIs[uuid].receive(senderuuid, json.loads(contents))
-            resp[u'commands'] += to_rpcs(scheds)
-            resp[u'commands'] += CM.make_commands(nodes)
-        except IndexError:
+        sender_ip = rpc[u'params'][u'sender_ipv4']
+        if REG.classify(sender_ip) == registry.PEER:
+            senderuuid = REG.uuid_of_ip(sender_ip)
+            scheds = DGIs[uuid].receive(senderuuid, codec.decode(contents))
+            resp[u'commands'] += schedule_rpcs(nid, scheds, sim_time)
+            resp[u'commands'] += CM.make_commands(REG, uuid)
+        else:
+            # ECN notifications come from the trolls as plain json.
             scheds = DGIs[uuid].ecn(json.loads(contents)["mode"])
-            resp[u'commands'] += to_rpcs(scheds)
+            resp[u'commands'] += schedule_rpcs(nid, scheds, sim_time)
+            # A hard ECN falls back and tells every peer
+            resp[u'commands'] += CM.make_commands(REG, uuid)
 
     elif command == u'start':
         ipv4 = rpc[u'params'][u'ipv4']['addresses']
-        node = Ipv4Node(nid, ipv4)
-        nodes[node.nid] = node
+        REG.add(Ipv4Node(nid, ipv4))
         # Schedule Check
-        resp[u'commands'] += to_rpcs(DGIs[uuid].schedule(1000, 12, scheduling_sigma=settings.SCHEDULING_SIGMA))
-        resp[u'commands'] += to_rpcs([ScheduleCommand(299000, True, lambda: print_state(nid))])
+        scheds = DGIs[uuid].schedule(1000, 12, scheduling_sigma=settings.SCHEDULING_SIGMA)
+        scheds.append(ScheduleCommand(299000, True, lambda: print_state(uuid)))
         if uuid == 0:
-            resp[u'commands'] += to_rpcs([ScheduleCommand(299000, True, lambda: save_traces())])
+            scheds.append(ScheduleCommand(299000, True, lambda: save_traces()))
+        resp[u'commands'] += schedule_rpcs(nid, scheds, sim_time)
         with open("mod_labels.dat","w+") as fp:
             fp.write("{}\n".format(DGIs[0].sigma))
             ms = DGIs[0].module_schedule()
@@ -125,18 +194,15 @@ def rpc_serv():
 
     if command == u'event':
         eid = int(rpc[u'params'][u'eventid'])
-        scheds = ScheduleCommand.get(eid).do()
-        resp[u'commands'] += to_rpcs(scheds)
-        resp[u'commands'] += CM.make_commands(nodes)
+        resp[u'commands'] += fire_bucket(ScheduleCommand.get(eid), sim_time)
 
     else:
         pass
 
     #print "RESP {}".format(resp)
-    return json.dumps(resp)
+    return resp
 
-if __name__ == "__main__":
-    save_net_layout()
+def setup_logging():
     gm_logging = logging.getLogger('gm_logging')
     handler = logging.FileHandler('gm.log', mode='w+')
     gm_logging.setLevel(logging.DEBUG)
@@ -145,5 +211,21 @@ if __name__ == "__main__":
     handler = logging.FileHandler('lb.log', mode='w+')
     lb_logging.setLevel(logging.DEBUG)
     lb_logging.addHandler(handler)
+    if settings.ENABLE_TRACING:
+        ProtocolTrace.open("protocol.trace")
+
+def make_app():
+    from flask import Flask
+    app = Flask(__name__)
+    app.add_url_rule("/", "rpc_serv", rpc_serv, methods=["GET", "PUT"])
+    return app
+
+if __name__ == "__main__":
+    from werkzeug.serving import WSGIRequestHandler
+    save_net_layout()
+    setup_logging()
+    app = make_app()
+    # Speak HTTP/1.1 so UdpPy can keep its connection open between calls.
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(debug=True, host='0.0.0.0')
     app.logger.setLevel(logging.CRITICAL)
@@ -1,151 +1,898 @@
-def observe(obs):
-    d = {}
-    prev = obs[0]
-    for o in obs[1:]:
-        if o == 'X':
-            prev = 'X'
-            continue
-        if prev == 'X':
-            prev = o
-            continue
-        try:
-            d[(prev,o)] += 1
-        except KeyError:
-            d[(prev,o)] = 1
-        prev = o
-    return d
-
-def likely_observe(obs):
-    d = {}
-    prev = obs[0]
-    c = 0
-    for o in obs[1:]:
-        if o == 'X':
-            prev = 'X'
-            continue
-        if prev == 'X':
-            prev = o
-            c = 0
-            continue
-        try:
-            d[(c,prev,o)] += 1
-        except KeyError:
-            d[(c,prev,o)] = 1
-        prev = o
-        c += 1
-    return d
-
-def observe2nd(obs):
-    d = {}
-    p2 = obs[0]
-    p1 = obs[1]
-    for o in obs[2:]:
-        try:
-            d[((p2,p1),o)] += 1
-        except KeyError:
-            d[((p2,p1),o)] = 1
-        p2 = p1
-        p1 = o
-    return d
-
-def chainify(obs):
-    states = []
-    statetot = {}
-    for k,_ in obs:
-        states.append(k)
-        statetot[k] = 0
-    mkov = {}
-    for k,k2 in obs:
-        if k == 'X' or k2 == 'X':
-            continue
-        statetot[k] += obs[(k,k2)]
-    for k,k2 in obs:
-        if k == 'X' or k2 == 'X':
-            continue
-        mkov[(k,k2)] = obs[(k,k2)] / (statetot[k] * 1.0)
-    return mkov
-
-
-def pretty(d):
-    for k in d:
-        print "{} : {}".format(k,d[k])
-
-def applyonce(procs):
-    for p in procs:
-        p.check()
-    readuntilempty(procs)
-    for p in procs:
-        p.merge()
-    readuntilempty(procs)
-    for p in procs:
-        p.ready()
-    readuntilempty(procs)
-    for p in procs:
-        p.cleanup()
-
-def mkv_state(syst):
-    return len(syst[0].group)+1
-
-def sys_state(syst):
-    return tuple([ tuple(x.group) for x in syst])
-
-def make_chain_2(procs, prob, applications=10):
-    cm = ConnectionManager()
-    syst = [ GM(x,cm,p=p) for (x,p) in zip(range(procs),[prob]*procs) ]
-    queue = deque([])
-    states = set()
-    states.add(sys_state(syst))
-    queue.append(pickle.dumps(syst))
-    observations = []
-    c = 0
-    while queue:
-        c += 1
-        if c % 10 == 0:
-            print "c={} q={}".format(c,len(queue))
-        pick = queue.popleft()
-        for _ in range(applications):
-            syst = pickle.loads(pick)
-            ob = mkv_state(syst)
-            observations.append(ob)
-            applyonce(syst)
-            ob = mkv_state(syst)
-            observations.append( ob )
-            observations.append('X')
-            if sys_state(syst) not in states:
-                states.add(sys_state(syst))
-                queue.append(pickle.dumps(syst))
-    o = observe(observations)
-    pretty(o)
-    c = chainify(o)
-    pretty(c)
-    return (o, likely_observe(observations))
-
-def make_chain(procs,prob,sets=1,iters=10000):
-    observations = []
-    for _ in range(sets):
-        cm = ConnectionManager()
-        syst = [ GM(x,cm,p=p) for (x,p) in zip(range(procs),[prob]*procs) ]
-        observations.append(1)
-        for __ in range(iters):
-            logging.info(str(syst))
-            applyonce(syst)
-            ob = len(syst[0].group)+1
-            # if ob == 2 and True:
-                # with open('scenario.pickle','w+') as cfp:
-                    # pickle.dump(syst, cfp)
-                # exit()
-            observations.append( ob )
-        logging.info(str(syst))
-        observations.append('X')
-
-
-    o = observe(observations)
-    pretty(o)
-    c = chainify(o)
-    pretty(c)
-    return (o, likely_observe(observations))
-
-
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
-    make_chain(5,0.75)
+import random
+import logging
+import multiprocessing
+
+from collections import deque
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import spsolve
+
+import codec
+from gm import GM
+from connectionmanager import ConnectionManager
+
+def observe(obs):
+    d = {}
+    prev = obs[0]
+    for o in obs[1:]:
+        if o == 'X':
+            prev = 'X'
+            continue
+        if prev == 'X':
+            prev = o
+            continue
+        try:
+            d[(prev,o)] += 1
+        except KeyError:
+            d[(prev,o)] = 1
+        prev = o
+    return d
+
+def likely_observe(obs):
+    d = {}
+    prev = obs[0]
+    c = 0
+    for o in obs[1:]:
+        if o == 'X':
+            prev = 'X'
+            continue
+        if prev == 'X':
+            prev = o
+            c = 0
+            continue
+        try:
+            d[(c,prev,o)] += 1
+        except KeyError:
+            d[(c,prev,o)] = 1
+        prev = o
+        c += 1
+    return d
+
+def observe2nd(obs):
+    d = {}
+    p2 = obs[0]
+    p1 = obs[1]
+    for o in obs[2:]:
+        try:
+            d[((p2,p1),o)] += 1
+        except KeyError:
+            d[((p2,p1),o)] = 1
+        p2 = p1
+        p1 = o
+    return d
+
+def chainify(obs):
+    states = []
+    statetot = {}
+    for k,_ in obs:
+        states.append(k)
+        statetot[k] = 0
+    mkov = {}
+    for k,k2 in obs:
+        if k == 'X' or k2 == 'X':
+            continue
+        statetot[k] += obs[(k,k2)]
+    for k,k2 in obs:
+        if k == 'X' or k2 == 'X':
+            continue
+        mkov[(k,k2)] = obs[(k,k2)] / (statetot[k] * 1.0)
+    return mkov
+
+
+def pretty(d):
+    for k in d:
+        print "{} : {}".format(k,d[k])
+
+def _resize(arr, shape):
+    if arr.shape == shape:
+        return arr
+    out = np.zeros(shape, dtype=arr.dtype)
+    out[tuple([ slice(0, n) for n in arr.shape ])] = arr
+    return out
+
+class TransitionCounter(object):
+    """
+    Counts what observe, observe2nd and likely_observe would, as the
+    observations are made. States are numbered as they first appear and
+    observations are buffered as those numbers, with -1 for an 'X'; each
+    full buffer is counted into NumPy arrays in one go. Memory depends on
+    the number of states and the longest run, not on how many observations
+    there were.
+
+    Unlike observe2nd, second-order counts don't reach across an 'X'.
+    """
+    CHUNK = 1 << 16
+
+    def __init__(self):
+        self.index = {}
+        self.states = []
+        self.buf = np.empty(self.CHUNK, dtype=np.int64)
+        self.n = 0
+        # The last two observations counted, and how far into its run the
+        # first of them was, so pairs and triples can span buffers.
+        self.carry = np.empty(0, dtype=np.int64)
+        self.carry_pos = 0
+        self.first = np.zeros((0, 0), dtype=np.int64)
+        self.second = np.zeros((0, 0, 0), dtype=np.int64)
+        self.steps = np.zeros((0, 0, 0), dtype=np.int64)
+
+    def add(self, o):
+        if o == 'X':
+            v = -1
+        else:
+            try:
+                v = self.index[o]
+            except KeyError:
+                v = self.index[o] = len(self.states)
+                self.states.append(o)
+        self.buf[self.n] = v
+        self.n += 1
+        if self.n == self.CHUNK:
+            self.flush()
+
+    def extend(self, obs):
+        for o in obs:
+            self.add(o)
+
+    def _grow(self, steps=0):
+        ns = len(self.states)
+        self.first = _resize(self.first, (ns, ns))
+        self.second = _resize(self.second, (ns, ns, ns))
+        self.steps = _resize(self.steps, (max(steps, self.steps.shape[0]), ns, ns))
+
+    def flush(self):
+        if not self.n:
+            return
+        self._grow()
+        ns = len(self.states)
+        k = len(self.carry)
+        seq = np.concatenate((self.carry, self.buf[:self.n]))
+        self.n = 0
+        idx = np.arange(len(seq))
+        last = np.maximum.accumulate(np.where(seq < 0, idx, -1))
+        pos = np.where(last < 0, idx + self.carry_pos, idx - last - 1)
+
+        a = seq[:-1]
+        b = seq[1:]
+        pairs = (a >= 0) & (b >= 0)
+        # Pairs within the carry were counted last time
+        pairs[:max(k-1, 0)] = False
+        a = a[pairs]
+        b = b[pairs]
+        c = pos[:-1][pairs]
+        self.first += np.bincount(a*ns + b, minlength=ns*ns).reshape(ns, ns)
+        if len(c):
+            self._grow(c.max() + 1)
+            self.steps += np.bincount((c*ns + a)*ns + b,
+                minlength=self.steps.size).reshape(self.steps.shape)
+
+        a = seq[:-2]
+        b = seq[1:-1]
+        c = seq[2:]
+        triples = (a >= 0) & (b >= 0) & (c >= 0)
+        triples[:max(k-2, 0)] = False
+        flat = (a[triples]*ns + b[triples])*ns + c[triples]
+        self.second += np.bincount(flat, minlength=ns**3).reshape(ns, ns, ns)
+
+        self.carry = seq[-2:].copy()
+        self.carry_pos = pos[-len(self.carry)]
+
+    def merge(self, other):
+        """
+        Adds other's counts to ours.
+        """
+        self.flush()
+        other.flush()
+        for s in other.states:
+            if s not in self.index:
+                self.index[s] = len(self.states)
+                self.states.append(s)
+        self._grow(other.steps.shape[0])
+        m = np.array([ self.index[s] for s in other.states ], dtype=np.int64)
+        if not len(m):
+            return
+        self.first[np.ix_(m, m)] += other.first
+        self.second[np.ix_(m, m, m)] += other.second
+        self.steps[np.ix_(np.arange(other.steps.shape[0]), m, m)] += other.steps
+
+    def chain(self):
+        """
+        The transition matrix, rows indexed like self.states.
+        """
+        self.flush()
+        tot = self.first.sum(axis=1).astype(np.float64)[:, None]
+        return np.divide(self.first, tot, out=np.zeros(self.first.shape), where=tot > 0)
+
+    def observe(self):
+        self.flush()
+        s = self.states
+        return dict([ ((s[i], s[j]), int(self.first[i, j]))
+                      for (i, j) in zip(*np.nonzero(self.first)) ])
+
+    def observe2nd(self):
+        self.flush()
+        s = self.states
+        return dict([ (((s[i], s[j]), s[k]), int(self.second[i, j, k]))
+                      for (i, j, k) in zip(*np.nonzero(self.second)) ])
+
+    def likely_observe(self):
+        self.flush()
+        s = self.states
+        return dict([ ((int(c), s[i], s[j]), int(self.steps[c, i, j]))
+                      for (c, i, j) in zip(*np.nonzero(self.steps)) ])
+
+    def chainify(self):
+        mkov = self.chain()
+        s = self.states
+        return dict([ ((s[i], s[j]), mkov[i, j])
+                      for (i, j) in zip(*np.nonzero(self.first)) ])
+
+def readuntilempty(procs):
+    """
+    Delivers everything the processes have queued, and everything sent in
+    response, until nothing is left. A message reaches each of its
+    destinations with that process's p. Only GM traffic is delivered.
+    """
+    connmgr = procs[0].connmgr
+    oqueues = connmgr.oqueues
+    busy = True
+    while busy:
+        busy = False
+        for p in procs:
+            oqueue = oqueues.get(p.uuid)
+            while oqueue:
+                busy = True
+                (t, msg) = oqueue.popleft()
+                if msg['module'] != 'gm':
+                    continue
+                dests = t if type(t) is tuple else (t,)
+                for d in dests:
+                    if random.random() < procs[d].p:
+                        procs[d].receive(p.uuid, msg)
+    connmgr.troll_queues.clear()
+
+def applyonce(procs):
+    for p in procs:
+        p.check()
+    readuntilempty(procs)
+    for p in procs:
+        p.merge()
+    readuntilempty(procs)
+    for p in procs:
+        p.ready()
+    readuntilempty(procs)
+    for p in procs:
+        p.cleanup()
+
+def mkv_state(syst):
+    return len(syst[0].group)+1
+
+def sys_state(syst):
+    return tuple([ tuple(x.group) for x in syst])
+
+_pack_uuids = codec.KINDS['uuids'][0]
+
+# What's left of a GM between rounds, packed field by field with the codec.
+SNAPSHOT = [ (f, codec.KINDS[k]) for (f, k) in [
+    ('leader', 'u16'),
+    ('groupid', 'u32'),
+    ('group', 'uuids'),
+    ('maintain', 'u8'),
+    ('fallback', 'fallback'),
+] ]
+
+def state_key(syst):
+    """
+    sys_state packed into one interned string, so visited states hash and
+    compare cheaply.
+    """
+    out = []
+    for p in syst:
+        _pack_uuids(out, p.group)
+    return intern("".join(out))
+
+def canonical(syst):
+    """
+    Each process's (leader, group, maintain), with what can't matter any
+    more left out. GM compares uuids everywhere, so no reordering of the
+    processes maps the protocol onto itself; the symmetry it does have is
+    in what they remember. A follower's group is only read when someone
+    sends it AreYouThere, and only a process that has it as leader does
+    that. Nothing can make a follower anyone's leader, so once nobody
+    follows it its group can be anything.
+    """
+    followed = set([ p.leader for p in syst if p.leader != p.uuid ])
+    return tuple([ (p.leader,
+                    tuple(p.group) if p.leader == p.uuid or p.uuid in followed else (),
+                    p.maintain)
+                   for p in syst ])
+
+def orbit_key(syst):
+    """
+    canonical packed and interned, like state_key. States with the same
+    orbit_key behave the same from here on.
+    """
+    out = []
+    for (leader, group, maintain) in canonical(syst):
+        out.append(codec.U16.pack(leader))
+        _pack_uuids(out, group)
+        out.append(codec.U8.pack(maintain))
+    return intern("".join(out))
+
+def snapshot(syst):
+    out = []
+    for p in syst:
+        for (f, (pack, _)) in SNAPSHOT:
+            pack(out, getattr(p, f))
+    return "".join(out)
+
+def restore(syst, data):
+    """
+    Puts the GMs in syst back the way snapshot found them. Everything else
+    is what cleanup leaves at the end of a round.
+    """
+    off = 0
+    for p in syst:
+        for (f, (_, unpack)) in SNAPSHOT:
+            v, off = unpack(data, off)
+            setattr(p, f, v)
+        p.expected = []
+        p.coordinators = []
+        p.pending = []
+        p.pendingldr = p.uuid
+        p.pendingid = 0
+        p.sawayc = False
+        p.step = 0
+        p.splitting = False
+    connmgr = syst[0].connmgr
+    for oqueue in connmgr.oqueues.itervalues():
+        oqueue.clear()
+    connmgr.troll_queues.clear()
+
+def make_system(procs, prob):
+    cm = ConnectionManager()
+    for x in range(procs):
+        cm.add_peer(x)
+    return [ GM(x,cm,p=p) for (x,p) in zip(range(procs),[prob]*procs) ]
+
+def make_chain_2(procs, prob, applications=10, reduce=True):
+    """
+    With reduce, only one state per orbit_key is queued and expanded. The
+    observations it makes are counted once for every distinct state_key in
+    its orbit, as if each of them had been expanded.
+    """
+    syst = make_system(procs, prob)
+    queue = deque([])
+    states = set()
+    states.add(state_key(syst))
+    queue.append(snapshot(syst))
+    # orbit_key -> [states seen in it, (before, afters) once expanded]
+    orbits = {orbit_key(syst): [1, None]}
+    counter = TransitionCounter()
+    c = 0
+    while queue:
+        c += 1
+        if c % 10 == 0:
+            print "c={} q={}".format(c,len(queue))
+        pick = queue.popleft()
+        restore(syst, pick)
+        orbit = orbits[orbit_key(syst)] if reduce else [1, None]
+        before = mkv_state(syst)
+        afters = []
+        for _ in range(applications):
+            restore(syst, pick)
+            applyonce(syst)
+            afters.append(mkv_state(syst))
+            key = state_key(syst)
+            if key in states:
+                continue
+            states.add(key)
+            if not reduce:
+                queue.append(snapshot(syst))
+                continue
+            okey = orbit_key(syst)
+            try:
+                seen = orbits[okey]
+            except KeyError:
+                orbits[okey] = [1, None]
+                queue.append(snapshot(syst))
+                continue
+            seen[0] += 1
+            if seen[1] is not None:
+                # Already expanded; count it again for this state
+                (b, a) = seen[1]
+                for ob in a:
+                    counter.extend((b, ob, 'X'))
+        orbit[1] = (before, afters)
+        for _ in range(orbit[0]):
+            for ob in afters:
+                counter.extend((before, ob, 'X'))
+    o = counter.observe()
+    pretty(o)
+    pretty(counter.chainify())
+    return (o, counter.likely_observe())
+
+def explore_shard(conn, shard, shards, procs, prob, applications, seed, reduce=True):
+    """
+    One worker of make_chain_parallel. It owns the states whose key hashes
+    to shard: it remembers which of them were seen and expands the new
+    ones. Each round it gets the candidates other shards found for it and
+    sends back, per shard, what it found for them.
+
+    With reduce the key is orbit_key, so a whole orbit lives on one shard,
+    and like make_chain_2 only its first state is expanded; what that
+    observes is counted once for every state_key seen in the orbit.
+    """
+    random.seed(seed + shard)
+    syst = make_system(procs, prob)
+    visited = set()
+    # orbit_key -> [states seen in it, (before, afters) once expanded]
+    orbits = {}
+    local = []
+    counter = TransitionCounter()
+    while True:
+        (cmd, batch) = conn.recv()
+        if cmd == 'finish':
+            counter.flush()
+            conn.send((counter, len(visited)))
+            conn.close()
+            return
+        frontier = []
+        for (okey, key, snap) in local + batch:
+            if key in visited:
+                continue
+            visited.add(key)
+            if not reduce:
+                frontier.append((None, snap))
+                continue
+            seen = orbits.get(okey)
+            if seen is None:
+                seen = orbits[okey] = [1, None]
+                frontier.append((seen, snap))
+                continue
+            seen[0] += 1
+            if seen[1] is not None:
+                # Already expanded; count it again for this state
+                (b, a) = seen[1]
+                for ob in a:
+                    counter.extend((b, ob, 'X'))
+        local = []
+        outgoing = [ [] for _ in range(shards) ]
+        sent = set()
+        for (orbit, pick) in frontier:
+            restore(syst, pick)
+            before = mkv_state(syst)
+            afters = []
+            for _ in range(applications):
+                restore(syst, pick)
+                applyonce(syst)
+                afters.append(mkv_state(syst))
+                key = state_key(syst)
+                if key in visited or key in sent:
+                    continue
+                sent.add(key)
+                okey = orbit_key(syst) if reduce else key
+                owner = hash(okey) % shards
+                if owner == shard:
+                    local.append((okey, key, snapshot(syst)))
+                else:
+                    outgoing[owner].append((okey, key, snapshot(syst)))
+            if orbit is not None:
+                orbit[1] = (before, afters)
+            for _ in range(orbit[0] if orbit is not None else 1):
+                for ob in afters:
+                    counter.extend((before, ob, 'X'))
+        conn.send((outgoing, len(local)))
+
+def make_chain_parallel(procs, prob, applications=10, workers=None, seed=0, reduce=True):
+    """
+    make_chain_2 spread over several processes. States are sharded by the
+    hash of their key, so each worker keeps its part of the visited set and
+    expands its part of the frontier. The workers expand level by level and
+    swap newly found states in one batch per shard per level. reduce is
+    make_chain_2's. Returns the observe and likely_observe counts of the
+    workers' counters, merged.
+    """
+    shards = workers or multiprocessing.cpu_count()
+    syst = make_system(procs, prob)
+    key = state_key(syst)
+    okey = orbit_key(syst) if reduce else key
+    inboxes = [ [] for _ in range(shards) ]
+    inboxes[hash(okey) % shards].append((okey, key, snapshot(syst)))
+    conns = []
+    children = []
+    for shard in range(shards):
+        (parent, child) = multiprocessing.Pipe()
+        w = multiprocessing.Process(target=explore_shard,
+            args=(child, shard, shards, procs, prob, applications, seed, reduce))
+        w.start()
+        conns.append(parent)
+        children.append(w)
+    level = 0
+    pending = True
+    while pending:
+        level += 1
+        for (conn, inbox) in zip(conns, inboxes):
+            conn.send(('expand', inbox))
+        inboxes = [ [] for _ in range(shards) ]
+        pending = False
+        for conn in conns:
+            (outgoing, left) = conn.recv()
+            pending = pending or left > 0
+            for (owner, batch) in enumerate(outgoing):
+                inboxes[owner] += batch
+        pending = pending or any(inboxes)
+        print "level={} sent={}".format(level, sum(map(len, inboxes)))
+    counter = TransitionCounter()
+    states = 0
+    for conn in conns:
+        conn.send(('finish', None))
+        (wc, n) = conn.recv()
+        counter.merge(wc)
+        states += n
+    for w in children:
+        w.join()
+    print "states={}".format(states)
+    o = counter.observe()
+    pretty(o)
+    pretty(counter.chainify())
+    return (o, counter.likely_observe())
+
+# GM fields a round can leave in any state, for the exact chain
+FULL = ['leader', 'group', 'groupid', 'coordinators', 'pending', 'pendingid',
+        'pendingldr', 'sawayc', 'maintain', 'expected', 'step', 'fallback',
+        'splitting']
+# Nothing ever compares ids or acts on a fallback without an ECN, so
+# configurations differing only in these behave the same.
+IGNORED = set(['groupid', 'pendingid', 'fallback', 'fallback2'])
+
+PHASES = ['check', None, 'merge', None, 'ready', None, 'cleanup']
+
+# Fields nothing reads before it overwrites them, at each point of a round:
+# before PHASES[i] runs, or while the messages it sent are delivered. The
+# exact chain has no ECNs, so maintain stays 0 and merge always resets
+# pending and expected.
+DEAD = [
+    set(),
+    set(['pending']),
+    set(['pending', 'step']),
+    set(),
+    set(['coordinators']),
+    set(['coordinators', 'pending']),
+    set(['coordinators', 'pending', 'pendingldr', 'step']),
+    set(),
+]
+# merge sorts these before it looks at them
+UNORDERED = set(['coordinators', 'expected'])
+MERGE = PHASES.index('merge')
+
+def freeze(v, ignore=()):
+    """
+    A hashable copy of a message or GM field. Lists only ever hold uuids.
+    """
+    t = type(v)
+    if t is list:
+        return ('l', tuple(v))
+    if t is dict:
+        return ('d', tuple(sorted([ (k, freeze(x)) for (k, x) in v.iteritems()
+                                    if k not in ignore ])))
+    return v
+
+def thaw(v):
+    if type(v) is tuple:
+        if v[0] == 'l':
+            return list(v[1])
+        return dict([ (k, thaw(x)) for (k, x) in v[1] ])
+    return v
+
+def capture(syst, cursor=(False, 0, None), point=0, gms=None, changed=None):
+    """
+    Everything about syst mid-round: the GMs, the queued GM messages and
+    where readuntilempty is up to. Returns it with the key configurations
+    are merged by, which leaves out what's dead at point. Given the GMs of
+    a configuration, only the one that changed is captured again.
+    """
+    oqueues = syst[0].connmgr.oqueues
+    dead = IGNORED | DEAD[point]
+    if gms is None:
+        gms = [ tuple([ freeze(getattr(p, f)) for f in FULL ]) for p in syst ]
+    elif changed is not None:
+        gms = list(gms)
+        gms[changed] = tuple([ freeze(getattr(syst[changed], f)) for f in FULL ])
+    gkeys = []
+    for g in gms:
+        gkey = [ None if f in dead else v for (f, v) in zip(FULL, g) ]
+        if point == MERGE:
+            gkey = [ ('l', tuple(sorted(v[1]))) if f in UNORDERED else v for (f, v) in zip(FULL, gkey) ]
+        gkeys.append(tuple(gkey))
+    queues = []
+    qkeys = []
+    for p in syst:
+        q = [ (t, msg) for (t, msg) in oqueues.get(p.uuid, ()) if msg['module'] == 'gm' ]
+        queues.append(tuple([ (t, freeze(msg)) for (t, msg) in q ]))
+        qkeys.append(tuple([ (t, freeze(msg, IGNORED)) for (t, msg) in q ]))
+    (busy, i, cur) = cursor
+    ckey = (cur[0], cur[1], freeze(thaw(cur[2]), IGNORED)) if cur else None
+    config = (tuple(gms), tuple(queues), cursor)
+    return config, (tuple(gkeys), tuple(qkeys), (busy, i, ckey))
+
+def put(syst, config, only=None):
+    """
+    Puts syst into config, or just the queues and the GM numbered only.
+    """
+    (gms, queues, cursor) = config
+    oqueues = syst[0].connmgr.oqueues
+    for (p, g, q) in zip(syst, gms, queues):
+        if only is None or p.uuid == only:
+            for (f, v) in zip(FULL, g):
+                setattr(p, f, thaw(v))
+        oqueues[p.uuid] = deque([ (t, thaw(m)) for (t, m) in q ])
+    syst[0].connmgr.troll_queues.clear()
+    return cursor
+
+def next_delivery(syst, cursor):
+    """
+    Walks readuntilempty's loops from cursor up to its next coin flip.
+    Returns the cursor at that flip, or None when everything's delivered.
+    """
+    (busy, i, cur) = cursor
+    oqueues = syst[0].connmgr.oqueues
+    while not cur:
+        oqueue = oqueues.get(syst[i].uuid)
+        if oqueue:
+            busy = True
+            (t, msg) = oqueue.popleft()
+            if msg['module'] != 'gm':
+                continue
+            cur = (syst[i].uuid, t if type(t) is tuple else (t,), freeze(msg))
+            continue
+        i += 1
+        if i == len(syst):
+            if not busy:
+                return None
+            (busy, i) = (False, 0)
+    return (busy, i, cur)
+
+def _add(d, key, config, prob):
+    try:
+        d[key][1] += prob
+    except KeyError:
+        d[key] = [config, prob]
+
+def deliver_all(syst, configs, point=0):
+    """
+    readuntilempty over a distribution of configurations, taking both
+    sides of every coin flip and merging configurations that meet again.
+    point is where in PHASES the messages come from.
+    """
+    done = {}
+    active = {}
+    for (config, prob) in configs.itervalues():
+        put(syst, config)
+        cursor = next_delivery(syst, config[2])
+        (config, key) = capture(syst, cursor or (False, 0, None), point if cursor else point + 1)
+        _add(done if cursor is None else active, key, config, prob)
+    while active:
+        level = {}
+        for (config, prob) in active.itervalues():
+            (busy, i, (sender, dests, msg)) = config[2]
+            d = dests[0]
+            rest = (sender, dests[1:], msg) if len(dests) > 1 else None
+            p = syst[d].p
+            for (delivered, q) in ((True, p), (False, 1.0-p)):
+                if not q:
+                    continue
+                # Receiving only changes d and the queues
+                put(syst, config, d)
+                if delivered:
+                    syst[d].receive(sender, thaw(msg))
+                cursor = next_delivery(syst, (busy, i, rest))
+                (c, key) = capture(syst, cursor or (False, 0, None), point if cursor else point + 1,
+                                   config[0], d if delivered else None)
+                _add(done if cursor is None else level, key, c, prob*q)
+        active = level
+    return done
+
+def round_key(syst):
+    return canonical(syst)
+
+def round_outcomes(syst, start):
+    """
+    Every way one applyonce from snapshot start can end, as round_key ->
+    [snapshot, probability].
+    """
+    restore(syst, start)
+    (config, key) = capture(syst)
+    configs = {key: [config, 1.0]}
+    for (point, phase) in enumerate(PHASES):
+        if phase is None:
+            configs = deliver_all(syst, configs, point)
+            continue
+        after = {}
+        for (config, prob) in configs.itervalues():
+            put(syst, config)
+            for p in syst:
+                getattr(p, phase)()
+            (c, key) = capture(syst, point=point + 1)
+            _add(after, key, c, prob)
+        configs = after
+    outcomes = {}
+    for (config, prob) in configs.itervalues():
+        put(syst, config)
+        _add(outcomes, round_key(syst), snapshot(syst), prob)
+    return outcomes
+
+def stationary(P):
+    """
+    The stationary distribution of an irreducible sparse chain.
+    """
+    n = P.shape[0]
+    A = (P.T - sparse.identity(n)).tolil()
+    A[0, :] = np.ones(n)
+    b = np.zeros(n)
+    b[0] = 1.0
+    if n == 1:
+        return b
+    return spsolve(A.tocsc(), b)
+
+def project(P, sizes, weights):
+    """
+    The group size chain seen when the system's states are weighted by
+    weights, as chainify's dict.
+    """
+    P = P.tocoo()
+    flow = {}
+    for (i, j, v) in zip(P.row, P.col, P.data):
+        if weights[i] > 0:
+            k = (sizes[i], sizes[j])
+            flow[k] = flow.get(k, 0.0) + weights[i]*v
+    tot = {}
+    for ((a, _), v) in flow.iteritems():
+        tot[a] = tot.get(a, 0.0) + v
+    return dict([ (k, v/tot[k[0]]) for (k, v) in flow.iteritems() ])
+
+def together(syst):
+    """
+    Whether every process is in one group, as its leader sees it too.
+    """
+    leader = syst[0].leader
+    if any([ p.leader != leader for p in syst ]):
+        return False
+    return sorted(syst[leader].group) == [ p.uuid for p in syst if p.uuid != leader ]
+
+def hitting_times(P, target):
+    """
+    The expected number of steps from every state until one of target, or
+    inf where there's a chance of never getting there.
+    """
+    n = P.shape[0]
+    # Whatever can't get to target, then whatever can get to one of those
+    # without passing through target first
+    reach = target.copy()
+    while True:
+        more = reach | (np.asarray(P[:, reach].sum(axis=1)).ravel() > 0)
+        if (more == reach).all():
+            break
+        reach = more
+    stuck = ~reach
+    while True:
+        more = stuck | ((np.asarray(P[:, stuck].sum(axis=1)).ravel() > 0) & ~target)
+        if (more == stuck).all():
+            break
+        stuck = more
+    h = np.zeros(n)
+    h[stuck] = np.inf
+    rest = np.nonzero(~stuck & ~target)[0]
+    if len(rest):
+        A = (sparse.identity(len(rest)) - P[rest][:, rest]).tocsc()
+        h[rest] = spsolve(A, np.ones(len(rest))) if len(rest) > 1 else 1.0 / A[0, 0]
+    return h
+
+def exact_chain(procs, prob):
+    """
+    The exact Markov chain of applyonce over every reachable system state,
+    message losses included, instead of make_chain's estimate. Returns
+    the sparse transition matrix P, each state's mkv_state and whether
+    every process is in one group, the closed classes with their
+    stationary distributions, the expected number of rounds from every
+    state until all the processes are in one group, and the group size
+    chain projected from where the system ends up in the long run.
+
+    Within a round every coin flip is taken both ways, and a round from
+    all alone has 2**(procs*(procs-1)) ways for the AreYouCoordinators and
+    their answers to go. Four processes take minutes; five are out of
+    reach.
+    """
+    syst = make_system(procs, prob)
+    index = {round_key(syst): 0}
+    snaps = [snapshot(syst)]
+    sizes = [mkv_state(syst)]
+    joined = [together(syst)]
+    rows = []
+    cols = []
+    vals = []
+    i = 0
+    while i < len(snaps):
+        for (key, (snap, p)) in round_outcomes(syst, snaps[i]).iteritems():
+            j = index.get(key)
+            if j is None:
+                j = index[key] = len(snaps)
+                snaps.append(snap)
+                restore(syst, snap)
+                sizes.append(mkv_state(syst))
+                joined.append(together(syst))
+            rows.append(i)
+            cols.append(j)
+            vals.append(p)
+        i += 1
+        if i % 100 == 0:
+            print "states={} done={}".format(len(snaps), i)
+    n = len(snaps)
+    P = sparse.csr_matrix((vals, (rows, cols)), shape=(n, n))
+
+    (ncomp, labels) = connected_components(P, directed=True, connection='strong')
+    leaves = np.zeros(ncomp, dtype=bool)
+    coo = P.tocoo()
+    leaves[labels[coo.row[labels[coo.row] != labels[coo.col]]]] = True
+    closed = [ np.nonzero(labels == c)[0] for c in range(ncomp) if not leaves[c] ]
+    classes = [ (members, stationary(P[members][:, members])) for members in closed ]
+
+    recurrent = np.zeros(n, dtype=bool)
+    for (members, _) in classes:
+        recurrent[members] = True
+    transient = np.nonzero(~recurrent)[0]
+    long_run = np.zeros(n)
+    if len(transient):
+        IQ = (sparse.identity(len(transient)) - P[transient][:, transient]).tocsc()
+    for (members, pi) in classes:
+        if recurrent[0]:
+            w = 1.0 if 0 in members else 0.0
+        else:
+            into = np.asarray(P[transient][:, members].sum(axis=1)).ravel()
+            w = spsolve(IQ, into)[list(transient).index(0)]
+        long_run[members] += w * pi
+
+    joined = np.array(joined)
+    hitting = hitting_times(P, joined)
+    chain = project(P, sizes, long_run)
+    pretty(chain)
+    return {
+        'P': P,
+        'sizes': np.array(sizes),
+        'together': joined,
+        'classes': classes,
+        'hitting': hitting,
+        'convergence': hitting[0],
+        'long_run': long_run,
+        'chain': chain,
+    }
+
+def make_chain(procs,prob,sets=1,iters=10000):
+    counter = TransitionCounter()
+    for _ in range(sets):
+        syst = make_system(procs, prob)
+        counter.add(1)
+        for __ in range(iters):
+            logging.info(str(syst))
+            applyonce(syst)
+            ob = len(syst[0].group)+1
+            # if ob == 2 and True:
+                # with open('scenario.pickle','w+') as cfp:
+                    # pickle.dump(syst, cfp)
+                # exit()
+            counter.add(ob)
+        logging.info(str(syst))
+        counter.add('X')
+
+
+    o = counter.observe()
+    pretty(o)
+    pretty(counter.chainify())
+    return (o, counter.likely_observe())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    make_chain(5,0.75)
@@ -1,39 +1,176 @@
+"""
+Collects a simulation run into datasets/datasetN.
+
+Every file is kept once, in datasets/objects under the hash of what's in
+it, gzipped unless it's compressed already. datasetN/manifest.json says
+which object each of the dataset's files is, and the queue data made from
+csma.tr sits next to it. Files are hashed and compressed a piece at a time
+in parallel; the pieces of a file are gzip members that concatenate into
+one gzip file, and its hash is the hash of the hashes of its pieces.
+
+    python mkdataset.py
+    python mkdataset.py checkout N [file...]
+
+checkout writes the files of datasetN back out into it, for the notebook.
+"""
+
 import os
+import re
 import sys
+import gzip
+import json
 import shutil
+import hashlib
+import multiprocessing
 
-from util.csma_queueing import do as do_csma
+from cStringIO import StringIO
+
+from util.csma_queueing import do as do_csma, DECOMPRESSORS
+
+DATASETS = "./datasets"
+STORE = os.path.join(DATASETS, "objects")
+
+PIECE = 16 << 20
 
 def dataset_path(i):
-    return "./datasets/dataset{}".format(i)
+    return os.path.join(DATASETS, "dataset{}".format(i))
 
 def free_dataset():
-    for i in range(1,1000):
-        if not os.path.exists(dataset_path(i)):
-            return i
-    raise IndexError("You've made too many datasets, you goose!")
+    """
+    One past the highest numbered dataset.
+    """
+    taken = [ int(m.group(1)) for m in map(re.compile(r"^dataset(\d+)$").match, os.listdir(DATASETS)) if m ]
+    return max(taken) + 1 if taken else 1
+
+# The trace as ns-3 writes it, or compressed; the first one found is used
+TRACES = [
+    "../ns-3.23/csma.tr.zst",
+    "../ns-3.23/csma.tr.xz",
+    "../ns-3.23/csma.tr.gz",
+    "../ns-3.23/csma.tr",
+]
 
-def collect_file(dataset, filepath):
-    shutil.copy(filepath,dataset_path(dataset))
+def find_trace():
+    for path in TRACES:
+        if os.path.isfile(path):
+            return path
+    raise IOError("No csma.tr to collect")
 
-def generate_queue_data(dataset):
+def pieces(path):
+    """
+    The (path, start, end, compress) jobs covering path. Files that are
+    compressed already aren't compressed again.
+    """
+    size = os.path.getsize(path)
+    compress = os.path.splitext(path)[1] not in DECOMPRESSORS
+    return [ (path, start, min(start + PIECE, size), compress) for start in range(0, max(size, 1), PIECE) ]
+
+def store_piece(job):
+    """
+    The SHA-256 of a piece of a file and, if it's to be compressed, the
+    piece as a gzip member.
+    """
+    (path, start, end, compress) = job
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    digest = hashlib.sha256(data).digest()
+    if not compress:
+        return (digest, None)
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as gz:
+        gz.write(data)
+    return (digest, buf.getvalue())
+
+def store(paths, processes=None):
+    """
+    Puts every file in paths in the store, unless it's there already.
+    Returns their manifest entries.
+    """
+    if not os.path.isdir(STORE):
+        os.makedirs(STORE)
+    jobs = [ pieces(path) for path in paths ]
+    tmp = os.path.join(STORE, "tmp-{}".format(os.getpid()))
+    entries = []
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.imap(store_piece, [ job for file_jobs in jobs for job in file_jobs ])
+        for (path, file_jobs) in zip(paths, jobs):
+            compress = file_jobs[0][3]
+            digests = []
+            with open(tmp, "wb") as fp:
+                for _ in file_jobs:
+                    (digest, data) = results.next()
+                    digests.append(digest)
+                    if compress:
+                        fp.write(data)
+            digest = hashlib.sha256("".join(digests)).hexdigest()
+            name = os.path.join(digest[:2], digest[2:] + (".gz" if compress else os.path.splitext(path)[1]))
+            target = os.path.join(STORE, name)
+            if os.path.exists(target):
+                os.remove(tmp)
+            else:
+                if not compress:
+                    shutil.copyfile(path, tmp)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.mkdir(os.path.dirname(target))
+                os.rename(tmp, target)
+            entries.append({
+                'name': os.path.basename(path),
+                'size': os.path.getsize(path),
+                'object': name,
+                'gzipped': compress,
+            })
+    finally:
+        pool.close()
+        pool.join()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return entries
+
+def write_manifest(dataset, entries):
+    with open(os.path.join(dataset_path(dataset), "manifest.json"), "w+") as fp:
+        json.dump({'files': entries}, fp, indent=1, sort_keys=True)
+
+def read_manifest(dataset):
+    with open(os.path.join(dataset_path(dataset), "manifest.json")) as fp:
+        return json.load(fp)
+
+def checkout(dataset, names=None):
+    """
+    Writes the dataset's files, or just those in names, into its directory.
+    """
+    for entry in read_manifest(dataset)['files']:
+        if names and entry['name'] not in names:
+            continue
+        src = os.path.join(STORE, entry['object'])
+        with (gzip.open(src, "rb") if entry['gzipped'] else open(src, "rb")) as fp:
+            with open(os.path.join(dataset_path(dataset), entry['name']), "wb") as out:
+                shutil.copyfileobj(fp, out, 1 << 20)
+
+def generate_queue_data(dataset, trace):
     store = os.getcwd()
+    trace = os.path.abspath(trace)
     os.chdir(dataset_path(dataset))
-    do_csma("csma.tr")
+    do_csma(trace, output="columns")
     os.chdir(store)
 
 def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "checkout":
+        checkout(int(sys.argv[2]), sys.argv[3:])
+        return
     # Find a free dataset slot to use
     slot = free_dataset()
+    trace = find_trace()
     # Collect files
-    os.mkdir(dataset_path(slot))
     collect = [
-        "../ns-3.23/csma.tr",
+        trace,
         "../ns-3.23/simulationinfo.json",
         "network.layout",
         "schedule.dat",
         "gm.log",
         "lb.log",
+        "protocol.trace",
         "analysis.ipynb",
         "mod_labels.dat",
         "migrations.dat",
@@ -46,8 +183,11 @@ def main():
         "../ns-3.23/router_top_queue.dat",
         "../ns-3.23/router_bottom_queue.dat",
     ]
-    map(lambda x: collect_file(slot,x), collect)
-    generate_queue_data(slot)
+    entries = store(collect)
+    os.mkdir(dataset_path(slot))
+    write_manifest(slot, entries)
+    generate_queue_data(slot, trace)
+    print dataset_path(slot)
 
 if __name__ == "__main__":
     main()
@@ -196,12 +196,12 @@ EcnAnnounce::HandleRead (Ptr<Socket> socket)
     std::cout<<packet_contents<<std::endl;
     delete [] contents;
     std::stringstream pstream(packet_contents);
-    
-    boost::property_tree::read_json(pstream, content);
     std::set<std::string> minions;
    
     try
     {
+      // DGI broadcasts reach us too; they aren't json, so they get ignored.
+      boost::property_tree::read_json(pstream, content);
       std::string overlord = content.get<std::string>("leader");
       
       announce_destinations[overlord] = overlord;
@@ -30,6 +30,8 @@
 #include "ns3/socket-factory.h"
 #include "ns3/packet.h"
 #include "ns3/uinteger.h"
+#include "ns3/boolean.h"
+#include "ns3/string.h"
 
 #include <boost/asio.hpp>
 #include <boost/property_tree/ptree.hpp>
@@ -38,8 +40,12 @@
 #include <boost/archive/iterators/binary_from_base64.hpp>
 #include <boost/archive/iterators/transform_width.hpp>
 
+#include <algorithm>
+#include <cstdlib>
+#include <map>
 #include <sstream>
 #include <stdexcept>
+#include <vector>
 
 #include "udp-py.h"
 
@@ -51,6 +57,10 @@ NS_OBJECT_ENSURE_REGISTERED (UdpPy);
 
 static unsigned int rpc_id_counter = 0;
 
+// Every running UdpPy by node id. A timer wheel event fired on one node can
+// carry sends for any other node, which must leave from that node's socket.
+static std::map<uint32_t, Ptr<Socket> > udppy_sockets;
+
 const std::string base64_padding[] = {"", "==","="};
 std::string base64_encode(const std::string& s) {
   namespace bai = boost::archive::iterators;
@@ -102,6 +112,14 @@ UdpPy::GetTypeId (void)
                    UintegerValue (9),
                    MakeUintegerAccessor (&UdpPy::m_port),
                    MakeUintegerChecker<uint16_t> ())
+    .AddAttribute ("RpcFramed", "Talk to the RPC server with length-prefixed json frames instead of HTTP.",
+                   BooleanValue (false),
+                   MakeBooleanAccessor (&UdpPy::m_rpcFramed),
+                   MakeBooleanChecker ())
+    .AddAttribute ("RpcSocket", "Unix domain socket of a framed RPC server. Empty means loopback TCP.",
+                   StringValue (""),
+                   MakeStringAccessor (&UdpPy::m_rpcSocket),
+                   MakeStringChecker ())
   ;
   return tid;
 }
@@ -149,6 +167,10 @@ UdpPy::StartApplication (void)
   Ipv4Address multi("224.1.1.1");
   Ptr<UdpSocket> udpSocket = DynamicCast<UdpSocket> (m_socket);
   udpSocket->MulticastJoinGroup (0, multi);
+  // DGI broadcasts (see BROADCAST_GROUP in connectionmanager.py)
+  Ipv4Address dgi_multi("224.1.1.2");
+  udpSocket->MulticastJoinGroup (0, dgi_multi);
+  m_socket->SetAllowBroadcast (true);
   
   if (addressUtils::IsMulticast (m_local))
   {
@@ -180,6 +202,8 @@ UdpPy::StartApplication (void)
     }
   }
 
+  udppy_sockets[GetNode()->GetId()] = m_socket;
+
   m_socket->SetRecvCallback (MakeCallback (&UdpPy::HandleRead, this));
   m_socket6->SetRecvCallback (MakeCallback (&UdpPy::HandleRead, this));
 
@@ -220,6 +244,8 @@ UdpPy::StopApplication ()
 {
   NS_LOG_FUNCTION (this);
 
+  udppy_sockets.erase(GetNode()->GetId());
+
   if (m_socket != 0)
     {
       m_socket->Close ();
@@ -238,6 +264,7 @@ UdpPy::HandleRead (Ptr<Socket> socket)
   NS_LOG_FUNCTION (this << socket);
   Ptr<Packet> packet;
   Address from;
+  std::vector<boost::property_tree::ptree> batch;
   while ((packet = socket->RecvFrom (from)))
   {
     boost::property_tree::ptree outgoing;
@@ -274,56 +301,85 @@ UdpPy::HandleRead (Ptr<Socket> socket)
 
     outgoing.add_child("params", pinfo);
 
-    boost::property_tree::ptree response = MakeRPCRequest(outgoing);
-
     //packet->RemoveAllPacketTags ();
     //packet->RemoveAllByteTags ();
 
-    HandleRPCResponse(response, socket);
+    batch.push_back(outgoing);
+  }
+
+  if (batch.empty())
+    return;
+
+  // Every datagram waiting on the socket goes to the server in one call.
+  if (batch.size() == 1)
+  {
+    HandleRPCResponse(MakeRPCRequest(batch[0]), socket);
+    return;
+  }
+  std::vector<boost::property_tree::ptree> responses = MakeRPCBatch(batch);
+  for(size_t i=0; i < responses.size(); i++)
+  {
+    HandleRPCResponse(responses[i], socket);
   }
 }
 
-boost::property_tree::ptree UdpPy::MakeRPCRequest(boost::property_tree::ptree rpc_call)
+/*
+ * The RPC server is shared by every UdpPy instance in the simulation, so we
+ * keep a single HTTP/1.1 keep-alive connection open to it instead of paying
+ * for a TCP handshake on every packet and timer.
+ */
+static boost::asio::io_service rpc_io_service;
+static boost::asio::ip::tcp::socket rpc_socket(rpc_io_service);
+static boost::asio::local::stream_protocol::socket rpc_local_socket(rpc_io_service);
+
+static void RPCConnect(void)
 {
     using boost::asio::ip::tcp;
-    using namespace std;
-    namespace pt = boost::property_tree;
-    boost::asio::io_service io_service;
-
-    rpc_call.put("id", rpc_id_counter++);
-    rpc_call.put("node_id", GetNode()->GetId());
-    rpc_call.put("simulation_time", Simulator::Now().GetSeconds());
 
     std::string host = "127.0.0.1";
-    std::string path = "/";
     std::string port = "5000";
 
+    if (rpc_socket.is_open())
+    {
+      boost::system::error_code ignored;
+      rpc_socket.close(ignored);
+    }
+
     // Get a list of endpoints corresponding to the server name.
-    tcp::resolver resolver(io_service);
+    tcp::resolver resolver(rpc_io_service);
     tcp::resolver::query query(host, port);
     tcp::resolver::iterator endpoint_iterator = resolver.resolve(query);
-    //boost::asio::ip::tcp::endpoint ep(boost::asio::ip::tcp::v4(), 5000);
-
 
     // Try each endpoint until we successfully establish a connection.
-    tcp::socket socket(io_service);
-    boost::asio::connect(socket, endpoint_iterator);
+    boost::asio::connect(rpc_socket, endpoint_iterator);
+    rpc_socket.set_option(tcp::no_delay(true));
+}
 
-    // Convert the ptree to json
-    stringstream call_buf;
-    string call;
-    pt::write_json(call_buf, rpc_call);
-    call = call_buf.str();
+/*
+ * A reused keep-alive connection the server had already closed. Nothing of
+ * the request reached it, so it's safe to send again on a new connection.
+ */
+class StaleConnection : public std::runtime_error
+{
+public:
+  StaleConnection() : std::runtime_error("RPC -- Stale connection.") {}
+};
+
+static std::string RPCExchange(const std::string& call, bool reused)
+{
+    using namespace std;
 
-    // Form the request. We specify the "Connection: close" header so that the
-    // server will close the socket after transmitting the response. This will
-    // allow us to treat all data up until the EOF as the content.
+    std::string host = "127.0.0.1";
+    std::string path = "/";
+
+    // Form the request. The connection is kept alive between calls, so the
+    // response body is delimited by its Content-length header.
     boost::asio::streambuf request;
     std::ostream request_stream(&request);
-    request_stream << "PUT " << path << " HTTP/1.0\r\n";
+    request_stream << "PUT " << path << " HTTP/1.1\r\n";
     request_stream << "Host: " << host << "\r\n";
     request_stream << "Accept: */*\r\n";
-    request_stream << "Connection: close\r\n";
+    request_stream << "Connection: keep-alive\r\n";
     request_stream << "Content-type: application/json\r\n";
     request_stream << "Content-length: "<<call.size()<<"\r\n";
     request_stream << "\r\n";
@@ -331,13 +387,29 @@ boost::property_tree::ptree UdpPy::MakeRPCRequest(boost::property_tree::ptree rp
     request_stream << call;
 
     // Send the request.
-    boost::asio::write(socket, request);
+    boost::system::error_code error;
+    boost::asio::write(rpc_socket, request, error);
+    if (error)
+    {
+      if (reused)
+        throw StaleConnection();
+      throw boost::system::system_error(error);
+    }
 
-    // Read the response status line. The response streambuf will automatically
-    // grow to accommodate the entire line. The growth may be limited by passing
-    // a maximum size to the streambuf constructor.
+    // Read the response status line and headers, which are terminated by a
+    // blank line. The streambuf may also hold part of the body afterwards.
+    // If the server closed the connection before we wrote, the write may
+    // still succeed and the read gets nothing at all.
     boost::asio::streambuf response;
-    boost::asio::read_until(socket, response, "\r\n");
+    boost::asio::read_until(rpc_socket, response, "\r\n\r\n", error);
+    if (error)
+    {
+      if (reused && response.size() == 0 &&
+          (error == boost::asio::error::eof ||
+           error == boost::asio::error::connection_reset))
+        throw StaleConnection();
+      throw boost::system::system_error(error);
+    }
 
     // Check that response is OK.
     std::istream response_stream(&response);
@@ -358,33 +430,180 @@ boost::property_tree::ptree UdpPy::MakeRPCRequest(boost::property_tree::ptree rp
       throw runtime_error("RPC -- Invalid status code.");
     }
 
-    // Read the response headers, which are terminated by a blank line.
-    boost::asio::read_until(socket, response, "\r\n\r\n");
-
     // Process the response headers.
     std::string header;
-    while (std::getline(response_stream, header) && header != "\r");
+    size_t content_length = 0;
+    bool has_length = false;
+    bool server_closes = (http_version == "HTTP/1.0");
+    while (std::getline(response_stream, header) && header != "\r")
+    {
+      std::string lower = header;
+      std::transform(lower.begin(), lower.end(), lower.begin(), ::tolower);
+      if (lower.find("content-length:") == 0)
+      {
+        content_length = strtoul(lower.c_str() + 15, NULL, 10);
+        has_length = true;
+      }
+      else if (lower.find("connection:") == 0)
+      {
+        server_closes = (lower.find("close") != std::string::npos);
+      }
+    }
 
     stringstream ss;
-    // Write whatever content we already have to output.
-    if (response.size() > 0)
+    if (has_length)
+    {
+      if (response.size() < content_length)
+        boost::asio::read(rpc_socket, response,
+            boost::asio::transfer_exactly(content_length - response.size()));
       ss << &response;
+    }
+    else
+    {
+      // No length given; the server will close the socket at the end.
+      if (response.size() > 0)
+        ss << &response;
+      while (boost::asio::read(rpc_socket, response,
+            boost::asio::transfer_at_least(1), error))
+        ss << &response;
+      if (error != boost::asio::error::eof)
+        throw boost::system::system_error(error);
+      server_closes = true;
+    }
 
-    // Read until EOF, writing data to output as we go.
-    boost::system::error_code error;
-    while (boost::asio::read(socket, response,
-          boost::asio::transfer_at_least(1), error))
-      ss << &response;
-    if (error != boost::asio::error::eof)
-      throw boost::system::system_error(error);
+    if (server_closes)
+      rpc_socket.close(error);
+
+    return ss.str();
+}
+
+static std::string RPCTransact(const std::string& call)
+{
+    bool reused = rpc_socket.is_open();
+    if (!reused)
+      RPCConnect();
+    try
+    {
+      return RPCExchange(call, reused);
+    }
+    catch (StaleConnection& e)
+    {
+      // The server dropped the idle keep-alive connection before it saw
+      // the request; send it once more on a fresh one. Any other failure
+      // may come after the server ran the call, and running a recv or
+      // event twice isn't safe, so those are raised.
+      RPCConnect();
+      return RPCExchange(call, false);
+    }
+}
+
+/*
+ * The framed transport skips HTTP entirely. Every message in either
+ * direction is a 4 byte big-endian length followed by that many bytes of
+ * json. See framed.py for the server side.
+ */
+template <typename SyncStream>
+static std::string FramedExchange(SyncStream& stream, const std::string& call)
+{
+    uint32_t length = call.size();
+    uint8_t header[4] = {
+      (uint8_t)(length >> 24), (uint8_t)(length >> 16),
+      (uint8_t)(length >> 8), (uint8_t)(length)
+    };
+    std::vector<boost::asio::const_buffer> request;
+    request.push_back(boost::asio::buffer(header, 4));
+    request.push_back(boost::asio::buffer(call));
+    boost::asio::write(stream, request);
+
+    boost::asio::read(stream, boost::asio::buffer(header, 4));
+    length = ((uint32_t)header[0] << 24) | ((uint32_t)header[1] << 16) |
+             ((uint32_t)header[2] << 8) | (uint32_t)header[3];
+    std::string response(length, '\0');
+    if (length > 0)
+      boost::asio::read(stream, boost::asio::buffer(&response[0], length));
+    return response;
+}
+
+static std::string FramedTransact(const std::string& socket_path, const std::string& call)
+{
+    if (socket_path.empty())
+    {
+      if (!rpc_socket.is_open())
+        RPCConnect();
+      return FramedExchange(rpc_socket, call);
+    }
+    if (!rpc_local_socket.is_open())
+    {
+      rpc_local_socket.connect(boost::asio::local::stream_protocol::endpoint(socket_path));
+    }
+    return FramedExchange(rpc_local_socket, call);
+}
+
+std::string UdpPy::RPCCall(const std::string& call)
+{
+    if (m_rpcFramed || !m_rpcSocket.empty())
+      return FramedTransact(m_rpcSocket, call);
+    return RPCTransact(call);
+}
+
+boost::property_tree::ptree UdpPy::StampRPCCall(boost::property_tree::ptree rpc_call)
+{
+    rpc_call.put("id", rpc_id_counter++);
+    rpc_call.put("node_id", GetNode()->GetId());
+    rpc_call.put("simulation_time", Simulator::Now().GetSeconds());
+    return rpc_call;
+}
+
+boost::property_tree::ptree UdpPy::MakeRPCRequest(boost::property_tree::ptree rpc_call)
+{
+    using namespace std;
+    namespace pt = boost::property_tree;
+
+    // Convert the ptree to json
+    stringstream call_buf;
+    pt::write_json(call_buf, StampRPCCall(rpc_call));
 
     // Now ss is full of yummy json (Hopefully!)
+    stringstream ss(RPCCall(call_buf.str()));
     pt::ptree rpc_response;
     pt::read_json(ss, rpc_response);
     //std::cout<<ss.str()<<std::endl;
     return rpc_response;
 }
 
+std::vector<boost::property_tree::ptree>
+UdpPy::MakeRPCBatch(const std::vector<boost::property_tree::ptree>& rpc_calls)
+{
+    using namespace std;
+    namespace pt = boost::property_tree;
+
+    // A batch is a json array of calls; the server answers with an array of
+    // responses in the same order.
+    pt::ptree batch;
+    for(size_t i=0; i < rpc_calls.size(); i++)
+    {
+      batch.push_back(std::make_pair("", StampRPCCall(rpc_calls[i])));
+    }
+    stringstream call_buf;
+    pt::write_json(call_buf, batch);
+
+    stringstream ss(RPCCall(call_buf.str()));
+    pt::ptree rpc_responses;
+    pt::read_json(ss, rpc_responses);
+
+    std::vector<pt::ptree> responses;
+    for(pt::ptree::iterator it=rpc_responses.begin(); it != rpc_responses.end(); it++)
+    {
+      responses.push_back(it->second);
+    }
+    if (responses.size() != rpc_calls.size())
+    {
+      std::cerr << "ERROR: batch of "<<rpc_calls.size()<<" calls got "<<responses.size()<<" responses."<<std::endl;
+      throw runtime_error("RPC -- Batch response size mismatch.");
+    }
+    return responses;
+}
+
 int UdpPy::HandleRPCResponse(boost::property_tree::ptree response, Ptr<Socket> socket)
 {
   namespace pt = boost::property_tree;
@@ -402,28 +621,42 @@ int UdpPy::HandleRPCResponse(boost::property_tree::ptree response, Ptr<Socket> s
   {
     boost::property_tree::ptree command = it->second;
     std::string action = command.get<std::string>("action");
-    if(action == "send")
+    if(action == "send" || action == "broadcast")
     {
+      // A broadcast is a single datagram to a group address; the receivers
+      // work out whether it was meant for them.
       /// TODO: Support ipv6
       std::string host = command.get<std::string>("destination_ipv4");
       uint16_t port = command.get<uint16_t>("destination_port");
       uint32_t flags = command.get<uint32_t>("flags",0);
+      uint32_t node_id = command.get<uint32_t>("node_id", GetNode()->GetId());
+      Ptr<Socket> from_socket = socket;
+      if(node_id != GetNode()->GetId())
+      {
+        std::map<uint32_t, Ptr<Socket> >::iterator found = udppy_sockets.find(node_id);
+        if(found == udppy_sockets.end())
+        {
+          NS_LOG_INFO (""<<Simulator::Now ().GetSeconds ()<<": Node"<<node_id<<" is not running, dropping send");
+          continue;
+        }
+        from_socket = found->second;
+      }
       Ipv4Address ipv4addr(host.c_str());
       Address to = InetSocketAddress(ipv4addr,port);
       std::string contents = base64_decode(command.get<std::string>("packet"));
       Ptr<Packet> packet = new Packet((uint8_t *) contents.c_str(), contents.size());
 
-      socket->SendTo(packet, flags, to);
+      from_socket->SendTo(packet, flags, to);
       if (InetSocketAddress::IsMatchingType (to))
       {
-        NS_LOG_INFO ("" << Simulator::Now ().GetSeconds () << ": Node"<<GetNode()->GetId()<<" sent "<<packet<<
+        NS_LOG_INFO ("" << Simulator::Now ().GetSeconds () << ": Node"<<node_id<<" sent "<<packet<<
                      " of "<< packet->GetSize () << " bytes to " <<
                      InetSocketAddress::ConvertFrom (to).GetIpv4 () << " port " <<
                      InetSocketAddress::ConvertFrom (to).GetPort ());
       }
       else if (Inet6SocketAddress::IsMatchingType (to))
       {
-        NS_LOG_INFO (""<<Simulator::Now ().GetSeconds ()<<": Node"<<GetNode()->GetId()<<" sent "<< packet->GetSize () << " bytes to " <<
+        NS_LOG_INFO (""<<Simulator::Now ().GetSeconds ()<<": Node"<<node_id<<" sent "<< packet->GetSize () << " bytes to " <<
                      Inet6SocketAddress::ConvertFrom (to).GetIpv6 () << " port " <<
                      Inet6SocketAddress::ConvertFrom (to).GetPort ());
       }
@@ -465,7 +698,12 @@ int UdpPy::HandleRPCResponse(boost::property_tree::ptree response, Ptr<Socket> s
     else if(action == "cancel")
     {
         uint32_t eventid = command.get<uint32_t>("id");
-        m_eventtable[eventid].Cancel();
+        eventtable_type::iterator event = m_eventtable.find(eventid);
+        if(event != m_eventtable.end())
+        {
+          event->second.Cancel();
+          m_eventtable.erase(event);
+        }
         NS_LOG_INFO (""<<Simulator::Now ().GetSeconds ()<<": Node"<<GetNode()->GetId()<<" cancelled event "<<eventid);
     }
   }
@@ -474,6 +712,7 @@ int UdpPy::HandleRPCResponse(boost::property_tree::ptree response, Ptr<Socket> s
 void UdpPy::DoEvent(uint32_t eventid)
 {
     NS_LOG_INFO (""<<Simulator::Now ().GetSeconds ()<<": Node"<<GetNode()->GetId()<<" fires event "<<eventid);
+    m_eventtable.erase(eventid);
     namespace pt = boost::property_tree;
     pt::ptree event;
     pt::ptree child;
@@ -27,6 +27,8 @@
 #include <boost/property_tree/ptree.hpp>
 
 #include <map>
+#include <string>
+#include <vector>
 
 namespace ns3 {
 
@@ -61,7 +63,10 @@ protected:
 
 private:
 
+  std::string RPCCall(const std::string& call);
+  boost::property_tree::ptree StampRPCCall(boost::property_tree::ptree rpc_call);
   boost::property_tree::ptree MakeRPCRequest(boost::property_tree::ptree rpc_call);
+  std::vector<boost::property_tree::ptree> MakeRPCBatch(const std::vector<boost::property_tree::ptree>& rpc_calls);
   int HandleRPCResponse(boost::property_tree::ptree response, Ptr<Socket> socket);
   void DoEvent(uint32_t eventid);
 
@@ -83,6 +88,8 @@ private:
   Address m_local; //!< local multicast address
   typedef std::map<uint32_t,EventId> eventtable_type;
   eventtable_type m_eventtable;
+  bool m_rpcFramed; //!< Use length-prefixed json frames instead of HTTP.
+  std::string m_rpcSocket; //!< Unix domain socket of the framed RPC server.
 };
 
 std::string base64_encode(const std::string& s);
@@ -163,6 +163,11 @@ main (int argc, char *argv[])
     const uint64_t ns3LD = 500000;
     TimeValue LINK_DELAY = TimeValue(NanoSeconds(ns3LD));
 
+    // Talk to framed.py instead of the Flask server in main.py. An empty
+    // socket path means loopback TCP on the usual port.
+    const bool RPC_FRAMED = false;
+    const std::string RPC_SOCKET = "";
+
     const bool ENABLE_TRAFFIC = true;
     const bool ENABLE_TROLLS = true;
     const bool USE_RED = true;
@@ -197,6 +202,7 @@ main (int argc, char *argv[])
     sim_info.put("link_delay", ns3LD);
     sim_info.put("enable_traffic", ENABLE_TRAFFIC);
     sim_info.put("enable_trolls", ENABLE_TROLLS);
+    sim_info.put("rpc_framed", RPC_FRAMED);
     sim_info.put("gm_start_time", GM_ST);
     sim_info.put("gm_end_time", GM_ET);
     sim_info.put("troll_start_time", TROLL_ST);
@@ -219,6 +225,9 @@ main (int argc, char *argv[])
     sim_info.put("trafficm_data_rate", JERKM_DATA_RATE);
     sim_info.put("trafficm_udp", JERKM_UDP);
 
+    Config::SetDefault ("ns3::UdpPy::RpcFramed", BooleanValue (RPC_FRAMED));
+    Config::SetDefault ("ns3::UdpPy::RpcSocket", StringValue (RPC_SOCKET));
+
     NS_LOG_INFO ("Set RED params");
     Config::SetDefault ("ns3::RedQueueEcn::Mode", StringValue ("QUEUE_MODE_PACKETS"));
     Config::SetDefault ("ns3::RedQueueEcn::MeanPktSize", UintegerValue (100));
@@ -436,6 +445,12 @@ main (int argc, char *argv[])
     {
         multicast.SetDefaultMulticastRoute(nodes_m.Get(i), nodes_m.Get(i)->GetDevice(0));
     }
+    // Forward DGI broadcasts (224.1.1.2) between the two LANs. ECN
+    // announcements on 224.1.1.1 stay on their own LAN.
+    multicast.AddMulticastRoute(router, Ipv4Address::GetAny(), Ipv4Address("224.1.1.2"),
+        router->GetDevice(0), NetDeviceContainer(router->GetDevice(1)));
+    multicast.AddMulticastRoute(router, Ipv4Address::GetAny(), Ipv4Address("224.1.1.2"),
+        router->GetDevice(1), NetDeviceContainer(router->GetDevice(0)));
     multicast.SetDefaultMulticastRoute(troll1, troll1->GetDevice(0));
     multicast.SetDefaultMulticastRoute(troll2, troll2->GetDevice(0));
     multicast.SetDefaultMulticastRoute(troll3, troll3->GetDevice(0));
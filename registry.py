@@ -0,0 +1,63 @@
+"""
+Bookkeeping for the ns-3 nodes that talk to us.
+
+ns-3 identifies a node by its node id and the packets it delivers by the
+sender's IPv4 address, while the DGIs only know each other by uuid. The
+registry keeps all three mappings as dicts so every lookup is constant
+time, and knows which addresses belong to the ECN trolls.
+"""
+
+PEER = 'peer'
+TROLL = 'troll'
+
+class NodeRegistry(object):
+    def __init__(self, uuids):
+        """
+        uuids[nid] is the uuid of the DGI running on ns-3 node nid. Shuffle
+        it before building the registry to break the nid == uuid pairing.
+        """
+        self.nid2uuid = dict(enumerate(uuids))
+        self.uuid2nid = dict([ (u, n) for (n, u) in self.nid2uuid.iteritems() ])
+        self.nodes = {}
+        self.ip2nid = {}
+        self.uuid2ip = {}
+        self.trolls = set()
+
+    def add(self, node):
+        self.nodes[node.nid] = node
+        self.ip2nid[node.ip] = node.nid
+        uuid = self.uuid(node.nid)
+        if uuid is not None:
+            self.uuid2ip[uuid] = node.ip
+
+    def add_troll(self, ip):
+        self.trolls.add(ip)
+
+    def uuid(self, nid):
+        return self.nid2uuid.get(nid)
+
+    def nid(self, uuid):
+        return self.uuid2nid[uuid]
+
+    def ip(self, uuid):
+        return self.uuid2ip[uuid]
+
+    def uuid_of_ip(self, ip):
+        return self.nid2uuid[self.ip2nid[ip]]
+
+    def classify(self, ip):
+        """
+        Says whether a datagram from ip is protocol traffic from another DGI
+        (PEER) or an ECN notification from a troll (TROLL).
+        """
+        if ip in self.ip2nid:
+            return PEER
+        if ip in self.trolls:
+            return TROLL
+        raise KeyError("Datagram from unknown sender {}".format(ip))
+
+    def __getitem__(self, nid):
+        return self.nodes[nid]
+
+    def __contains__(self, nid):
+        return nid in self.nodes
@@ -1,6 +1,9 @@
 class ScheduleCommand(object):
     scheduled = {}
     sid_counter = 10000
+    # (when, sid, function name, owner uuid) of every absolute command
+    # handed out to run
+    log = []
 
     @staticmethod
     def new_id():
@@ -18,13 +21,16 @@ class ScheduleCommand(object):
         return sid
 
     @staticmethod
-    def summarize():
-        l = ScheduleCommand.scheduled.values()
-        l = filter(lambda x: x.when_is_absolute, l)
-        l.sort(key=lambda x: x.when)
+    def summarize(describe=None):
+        """
+        One line per logged command. describe(name, uuid) gives its label;
+        without it the label is name@uuid.
+        """
+        l = sorted(ScheduleCommand.log)
         r = []
-        for obj in l:
-            r.append("{}\t{}\t{}".format(obj.when, obj.fn, obj.sid))
+        for (when, sid, name, uuid) in l:
+            label = describe(name, uuid) if describe else "{}@{}".format(name, uuid)
+            r.append("{}\t{}\t{}".format(when, label, sid))
         return "\n".join(r)
 
     def __init__(self, when, when_is_absolute, fn, obj=None):
@@ -34,7 +40,15 @@ class ScheduleCommand(object):
         self.sid = ScheduleCommand.put(self)
         self.obj = obj
 
+    def record(self):
+        # Only what it takes to label the command later, so the log holds
+        # no live objects and costs nothing to build.
+        if self.when_is_absolute:
+            uuid = getattr(self.obj, 'uuid', None)
+            ScheduleCommand.log.append((self.when, self.sid, self.fn.__name__, uuid))
+
     def to_rpc(self):
+        self.record()
         cmd = {
             u'action': u'schedule',
             u'when': self.when,
@@ -45,6 +59,29 @@ class ScheduleCommand(object):
 
     def adjust(self, amount):
         self.when += amount
-        
+
+    def cancel(self):
+        """
+        Forgets this command. Returns the command that tells ns-3 to drop
+        the pending event. Commands that went through the timer wheel never
+        reached ns-3 under this sid, so there the cancel is a no-op and the
+        command is just skipped when its bucket fires.
+        """
+        ScheduleCommand.scheduled.pop(self.sid, None)
+        return CancelCommand(self.sid)
+
     def do(self):
+        # Commands only fire once, so there's no reason to keep them around.
+        del ScheduleCommand.scheduled[self.sid]
         return self.fn()
+
+class CancelCommand(object):
+    def __init__(self, sid):
+        self.sid = sid
+
+    def to_rpc(self):
+        cmd = {
+            u'action': u'cancel',
+            u'id': self.sid,
+        }
+        return cmd
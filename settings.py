@@ -6,3 +6,8 @@ MIN_POWER = -300
 MAX_POWER = 300
 SEED = 101061988
 CONGESTION_ADJUST = 1.5
+ENABLE_TRACING = True
+# Width in ms of the timer wheel buckets. Wide enough for the nodes' phases
+# to share a bucket at SCHEDULING_SIGMA up to 10; every command fires up to
+# one bucket late. 0 only merges identical fire times.
+TIMER_BUCKET = 100.0
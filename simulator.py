@@ -0,0 +1,434 @@
+"""
+Runs the DGIs without ns-3.
+
+Events sit in a heap and are handed to main.dispatch exactly the way UdpPy
+would, so the DGIs, their ScheduleCommands, the timer wheel and the
+ConnectionManager all behave as they do under ns-3, and the run leaves the
+same groupsizes.dat and migrations.dat behind. The network stands in for
+the one ns3/simulations/py.cc builds: the two LANs from network.layout,
+every node on its own link to its LAN's bridge, and a router between the
+bridges. Each link has a propagation delay, a bandwidth, a drop-tail queue
+and optional random loss. The queues leaving a bridge mark packets the way
+RedQueueEcn does, and the LAN's troll turns those marks into ECN
+announcements for the group it was told about.
+
+The jerks' OnOff traffic isn't simulated packet by packet: while they're
+on it arrives at the bridge to bridge queues as a fluid, which backs up
+when it's more than the link can carry, delays the DGI packets behind it
+and feeds the RED average as the packets it stands for would. py.cc's
+jerks only send 2Mbps over 100Mbps links, which never queues; OnOff with
+more rate, or with on and off times, is what it takes to congest.
+
+    python simulator.py [seconds]
+"""
+
+import sys
+import ast
+import json
+import heapq
+import base64
+import random
+
+from collections import deque
+
+import main as rpc
+import settings
+from connectionmanager import BROADCAST_GROUP
+
+# These mirror the constants at the top of ns3/simulations/py.cc
+LINK_BANDWIDTH = 100e6
+LINK_DELAY = 0.0005
+GM_ST = 0.5
+GM_ET = 300.0
+TRAFFIC_ST = 80.0
+TRAFFIC_ET = 300.0
+# Four 0.5Mbps jerks on each LAN talk to the other LAN through the router,
+# on for 5s and off for none, which is on all the time
+JERKS = 4
+JERK_RATE = 0.5e6
+JERK_ON = 5.0
+JERK_OFF = 0.0
+RED_MIN_TH = 90
+RED_MAX_TH = 130
+RED_QUEUE_LIMIT = 1000
+RED_QW = 0.002
+# EcnAnnounce's m_spam_interval
+SPAM_INTERVAL = 0.250
+
+ECN_GROUP = "224.1.1.1"
+DGI_PORT = 9
+# Ethernet, IPv4 and UDP headers on top of the payload
+OVERHEAD = 18 + 20 + 8
+# OnOffApplication's default PacketSize, as it goes on the wire
+JERK_PACKET = 512 + OVERHEAD
+
+# RedQueueEcn's marks, as handed to EcnAnnounce::Announcement
+NO_MARK = 0
+HARD = 1
+SOFT = 2
+MODES = {HARD: 'hard', SOFT: 'soft'}
+
+def lan_ip(lan, host):
+    return "10.1.{}.{}".format(lan+1, host)
+
+def read_layout(path='network.layout'):
+    """
+    The uuids on each LAN, as written by main.save_net_layout.
+    """
+    with open(path) as fp:
+        return [ ast.literal_eval(line) for line in fp if line.strip() ]
+
+class Datagram(object):
+    __slots__ = ['src', 'dest', 'data', 'size', 'lans']
+
+    def __init__(self, src, dest, data):
+        self.src = src
+        self.dest = dest
+        self.data = data
+        self.size = len(data) + OVERHEAD
+        # The LANs a multicast has already been flooded on
+        self.lans = set()
+
+class Link(object):
+    def __init__(self, delay=LINK_DELAY, bandwidth=LINK_BANDWIDTH, loss=0.0,
+                 queue=RED_QUEUE_LIMIT, red=False):
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.queue = queue
+        self.red = red
+        # Bits per second offered by traffic that isn't simulated packet
+        # by packet, and how many bits of it are queued as of self.t
+        self.offered = 0.0
+        self.backlog = 0.0
+        self.t = 0.0
+        # When each packet still in the queue finishes transmitting
+        self.departures = deque()
+        self.avg = 0.0
+
+    def advance(self, now):
+        """
+        Brings the background backlog, and the RED average its packets
+        would have moved, up to now. What doesn't fit in the queue is
+        dropped.
+        """
+        dt = now - self.t
+        if dt <= 0:
+            return
+        self.t = now
+        if not self.offered and not self.backlog:
+            return
+        bits = JERK_PACKET * 8.0
+        arrived = self.offered * dt
+        self.backlog = min(max(self.backlog + arrived - self.bandwidth * dt, 0.0), self.queue * bits)
+        if self.red and arrived:
+            qlen = len(self.departures) + self.backlog / bits
+            self.avg = qlen + (self.avg - qlen) * (1 - RED_QW) ** (arrived / bits)
+
+    def offer(self, now, bps):
+        self.advance(now)
+        self.offered = bps
+
+    def transmit(self, now, size, rng):
+        """
+        Queues size bytes at now. Returns when they reach the far end, or
+        None if they were dropped, and how RED marked them.
+        """
+        self.advance(now)
+        departures = self.departures
+        while departures and departures[0] <= now:
+            departures.popleft()
+        qlen = len(departures) + int(self.backlog / (JERK_PACKET * 8.0))
+        mark = NO_MARK
+        if self.red:
+            self.avg += RED_QW * (qlen - self.avg)
+            if self.avg >= RED_MAX_TH:
+                mark = HARD
+            elif self.avg >= RED_MIN_TH:
+                mark = SOFT
+        if qlen >= self.queue:
+            return None, mark
+        if self.loss and rng.random() < self.loss:
+            return None, mark
+        # Behind whatever background traffic is queued already
+        start = max(departures[-1] if departures else now, now + self.backlog / self.bandwidth)
+        done = start + size * 8.0 / self.bandwidth
+        departures.append(done)
+        return done + self.delay, mark
+
+class Troll(object):
+    """
+    EcnAnnounce: learns group membership from the leaders and announces
+    congestion to the LAN when a member's packet gets marked.
+    """
+    def __init__(self, ip, lan):
+        self.ip = ip
+        self.lan = lan
+        self.destinations = {}
+        self.next_announcement = 0.0
+        self.last_was_hard = False
+
+    def notify(self, data):
+        try:
+            config = json.loads(data)
+        except ValueError:
+            # DGI broadcasts reach us too
+            return
+        leader = config['leader']
+        minions = set(config['group'])
+        self.destinations[leader] = leader
+        for minion in minions:
+            self.destinations[minion] = leader
+        for (ip, overlord) in self.destinations.items():
+            if overlord == leader and ip != leader and ip not in minions:
+                del self.destinations[ip]
+
+    def announce(self, now, source, mode):
+        """
+        Whether a packet from source marked with mode makes us announce.
+        """
+        if source not in self.destinations:
+            return False
+        if self.next_announcement <= now or (mode == HARD and not self.last_was_hard):
+            self.next_announcement = now + SPAM_INTERVAL
+            self.last_was_hard = (mode == HARD)
+            return True
+        return False
+
+class Network(object):
+    def __init__(self, lans, loss=0.0, **link_args):
+        """
+        lans is the node ids on each LAN. loss and link_args apply to every
+        link.
+        """
+        self.lans = lans
+        self.lan = {}
+        self.ip = {}
+        self.ip2nid = {}
+        self.up = {}
+        self.down = {}
+        for (l, nids) in enumerate(lans):
+            for (i, nid) in enumerate(nids):
+                self.lan[nid] = l
+                self.ip[nid] = lan_ip(l, i+3)
+                self.ip2nid[self.ip[nid]] = nid
+                self.up[nid] = Link(loss=loss, **link_args)
+                self.down[nid] = Link(loss=loss, red=True, **link_args)
+        # Bridge to bridge through the router, two hops of delay
+        trunk_args = dict(link_args)
+        trunk_args['delay'] = 2 * link_args.get('delay', LINK_DELAY)
+        self.trunks = {}
+        for a in range(len(lans)):
+            for b in range(len(lans)):
+                if a != b:
+                    self.trunks[(a, b)] = Link(loss=loss, red=True, **trunk_args)
+        self.trolls = [ Troll(lan_ip(l, 2), l) for l in range(len(lans)) ]
+        self.troll_ips = dict([ (t.ip, t) for t in self.trolls ])
+
+class OnOff(object):
+    """
+    The jerks' OnOffApplications: jerks on every LAN, each sending rate
+    bits per second to its twin on the next LAN while it's on. Times on
+    and off are exponential with means on and off; with off 0 a jerk
+    never stops. They send from start until stop.
+    """
+    def __init__(self, jerks=JERKS, rate=JERK_RATE, on=JERK_ON, off=JERK_OFF,
+                 start=TRAFFIC_ST, stop=TRAFFIC_ET):
+        self.jerks = jerks
+        self.rate = rate
+        self.on = on
+        self.off = off
+        self.start = start
+        self.stop = stop
+
+TRAFFIC = OnOff()
+# Three jerks on at once is more than a trunk carries
+CONGESTED = OnOff(rate=40e6, on=1.0, off=1.0)
+
+class Simulator(object):
+    def __init__(self, network, end=GM_ET, seed=None, traffic=TRAFFIC):
+        self.network = network
+        self.end = end
+        self.traffic = traffic
+        self.now = 0.0
+        self.events = []
+        self.seq = 0
+        self.rid = 0
+        # The network has its own generator so loss doesn't disturb the
+        # random numbers the DGIs draw.
+        self.rng = random.Random(settings.SEED if seed is None else seed)
+        # (nid, eventid) of every pending event, like UdpPy's m_eventtable
+        self.pending = set()
+        self.stats = {'rpc': 0, 'event': 0, 'recv': 0, 'sent': 0, 'dropped': 0, 'ecn': 0}
+        # How many jerks are on behind each trunk
+        self.jerking = {}
+
+    def at(self, when, fn, *args):
+        self.seq += 1
+        heapq.heappush(self.events, (when, self.seq, fn, args))
+
+    def run(self):
+        for nid in sorted(self.network.lan):
+            self.at(GM_ST, self.start, nid)
+        nlans = len(self.network.lans)
+        if self.traffic and nlans > 1:
+            for lan in range(nlans):
+                trunk = self.network.trunks[(lan, (lan + 1) % nlans)]
+                for _ in range(self.traffic.jerks):
+                    self.at(self.traffic.start, self.jerk, trunk, True)
+            self.at(self.traffic.stop, self.quiet)
+        events = self.events
+        while events:
+            (when, _, fn, args) = heapq.heappop(events)
+            if when > self.end:
+                break
+            self.now = when
+            fn(*args)
+        return self.stats
+
+    def jerk(self, trunk, on):
+        """
+        A jerk sending over trunk turns on or off, and picks when it'll
+        switch again.
+        """
+        traffic = self.traffic
+        if self.now >= traffic.stop:
+            return
+        self.jerking[trunk] = self.jerking.get(trunk, 0) + (1 if on else -1)
+        trunk.offer(self.now, self.jerking[trunk] * traffic.rate)
+        if traffic.off:
+            mean = traffic.on if on else traffic.off
+            self.at(self.now + self.rng.expovariate(1.0 / mean), self.jerk, trunk, not on)
+
+    def quiet(self):
+        for trunk in self.jerking:
+            trunk.offer(self.now, 0.0)
+        self.jerking = {}
+
+    def call(self, nid, method, params):
+        self.rid += 1
+        self.stats['rpc'] += 1
+        resp = rpc.dispatch({
+            u'id': self.rid,
+            u'node_id': nid,
+            u'simulation_time': self.now,
+            u'method': method,
+            u'params': params,
+        })
+        self.execute(nid, resp[u'commands'])
+
+    def execute(self, nid, commands):
+        for command in commands:
+            action = command[u'action']
+            if action == u'send' or action == u'broadcast':
+                sender = int(command.get(u'node_id', nid))
+                data = base64.b64decode(command[u'packet'])
+                self.send(sender, command[u'destination_ipv4'], data)
+            elif action == u'schedule':
+                eid = int(command[u'eventid'])
+                when = float(command[u'when']) / 1000.0
+                if not command.get(u'when_is_absolute', False):
+                    when += self.now
+                self.pending.add((nid, eid))
+                self.at(max(when, self.now), self.fire, nid, eid)
+            elif action == u'cancel':
+                self.pending.discard((nid, int(command[u'id'])))
+
+    def start(self, nid):
+        ip = self.network.ip[nid]
+        address = "m_local={}; m_mask=255.255.255.0; m_broadcast={}; m_scope=2; m_secondary=0".format(
+            ip, ip.rsplit('.', 1)[0] + ".255")
+        self.call(nid, u'start', {u'ipv4': {u'addresses': [address]}})
+
+    def fire(self, nid, eid):
+        if (nid, eid) not in self.pending:
+            return
+        self.pending.remove((nid, eid))
+        self.stats['event'] += 1
+        self.call(nid, u'event', {u'eventid': eid})
+
+    def send(self, nid, dest, data):
+        self.stats['sent'] += 1
+        self.hop(self.network.up[nid], Datagram(self.network.ip[nid], dest, data),
+                 self.at_bridge, self.network.lan[nid])
+
+    def hop(self, link, dgram, then, where, lan=None):
+        """
+        Puts dgram on link and calls then(where, dgram) when it arrives. lan
+        is the LAN whose bridge owns the queue, if any, so its troll hears
+        about marks.
+        """
+        arrival, mark = link.transmit(self.now, dgram.size, self.rng)
+        if mark and lan is not None:
+            troll = self.network.trolls[lan]
+            if troll.announce(self.now, dgram.src, mark):
+                self.announce(troll, mark)
+        if arrival is None:
+            self.stats['dropped'] += 1
+            return
+        self.at(arrival, then, where, dgram)
+
+    def announce(self, troll, mode):
+        self.stats['ecn'] += 1
+        msg = json.dumps({'msg': 'ecn', 'mode': MODES[mode], 'origin': troll.lan})
+        dgram = Datagram(troll.ip, ECN_GROUP, msg)
+        self.at(self.now + LINK_DELAY, self.at_bridge, troll.lan, dgram)
+
+    def at_bridge(self, lan, dgram):
+        net = self.network
+        dest = dgram.dest
+        if dest in net.ip2nid:
+            nid = net.ip2nid[dest]
+            if net.lan[nid] == lan:
+                self.hop(net.down[nid], dgram, self.deliver, nid, lan)
+            else:
+                self.hop(net.trunks[(lan, net.lan[nid])], dgram, self.at_bridge, net.lan[nid], lan)
+        elif dest in net.troll_ips:
+            troll = net.troll_ips[dest]
+            if troll.lan == lan:
+                troll.notify(dgram.data)
+            else:
+                self.hop(net.trunks[(lan, troll.lan)], dgram, self.at_bridge, troll.lan, lan)
+        elif dest == BROADCAST_GROUP:
+            # The router forwards DGI broadcasts to every LAN
+            dgram.lans.add(lan)
+            self.flood(lan, dgram)
+            for other in range(len(net.lans)):
+                if other not in dgram.lans:
+                    dgram.lans.add(other)
+                    self.hop(net.trunks[(lan, other)], dgram, self.flood, other, lan)
+        elif dest == ECN_GROUP:
+            # Announcements stay on their own LAN
+            self.flood(lan, dgram)
+        # Anything else is for the router's troll, whose announcements
+        # never reach a DGI.
+
+    def flood(self, lan, dgram):
+        for nid in self.network.lans[lan]:
+            if self.network.ip[nid] != dgram.src:
+                self.hop(self.network.down[nid], dgram, self.deliver, nid, lan)
+
+    def deliver(self, nid, dgram):
+        self.stats['recv'] += 1
+        self.call(nid, u'recv', {
+            u'packet': base64.b64encode(dgram.data),
+            u'sender_ipv4': dgram.src,
+            u'sender_port': DGI_PORT,
+        })
+
+def simulate(end=GM_ET, traffic=TRAFFIC, **network_args):
+    """
+    Runs the DGIs in main on the layout main saves, with the jerks sending
+    as traffic says. Returns the run's stats.
+    """
+    rpc.save_net_layout()
+    lans = [ [ rpc.REG.nid(uuid) for uuid in uuids ] for uuids in read_layout() ]
+    return Simulator(Network(lans, **network_args), end, traffic=traffic).run()
+
+def main():
+    end = float(sys.argv[1]) if len(sys.argv) > 1 else GM_ET
+    rpc.setup_logging()
+    print simulate(end)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Runs the in-process simulator over a grid of settings.
+
+Every combination of the values in GRID gets its own SimulationContext,
+fanned out over a process pool. Each run leaves its .dat files in
+sweep/<run>/ and a summary row in sweep.dat. The jerks send as TRAFFIC
+says: py.cc's own traffic never congests the trunks, so with it the ECN
+settings and CONGESTION_ADJUST would change nothing.
+
+    python sweep.py [processes] [seconds]
+"""
+
+import os
+import sys
+import time
+import itertools
+import multiprocessing
+
+import gm
+import lb
+import simulator
+
+from context import SimulationContext
+
+GRID = [
+    ('SCHEDULING_SIGMA', [0.0, 5.0, 10.0]),
+    ('CONGESTION_ADJUST', [1.0, 1.5, 2.0]),
+    ('ENABLE_SOFT_ECN', [True, False]),
+    ('ENABLE_HARD_ECN', [False, True]),
+    ('MESSAGE_DELIVERY_GAP', [500, 1000]),
+]
+
+TRAFFIC = simulator.CONGESTED
+
+OUTPUT = "sweep"
+
+COLUMNS = ['groups', 'mean_group', 'migrations', 'losses', 'ecns', 'rpcs', 'wall']
+
+def jobs(grid, seconds):
+    names = [ name for (name, _) in grid ]
+    for (i, values) in enumerate(itertools.product(*[ v for (_, v) in grid ])):
+        yield (i, dict(zip(names, values)), seconds)
+
+def summarize(stats):
+    """
+    One row of results from the traces of the active context.
+    """
+    final = {}
+    for (uuid, sizes) in gm.GlobalGMTrace.sizes.iteritems():
+        final[uuid] = sizes[max(sizes)]
+    leaders = [ s for s in final.itervalues() if s > 0 ]
+    migrations = 0
+    for trace in lb.GlobalLBTrace.traces.itervalues():
+        migrations += len([ t for t in trace if t > 0 ])
+    losses = 0
+    for lost in lb.GlobalLBTrace.losses.itervalues():
+        if lost:
+            losses += lost[max(lost)]
+    return {
+        'groups': len(leaders),
+        'mean_group': float(sum(leaders))/len(leaders) if leaders else 0.0,
+        'migrations': migrations,
+        'losses': losses,
+        'ecns': sum([ len(e) for e in gm.GlobalGMTrace.ecns.itervalues() ]),
+        'rpcs': stats['rpc'],
+    }
+
+def run(job):
+    (index, params, seconds) = job
+    path = os.path.abspath(os.path.join(OUTPUT, str(index)))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    cwd = os.getcwd()
+    # The traces are written to the working directory
+    os.chdir(path)
+    try:
+        start = time.time()
+        with SimulationContext(**params):
+            stats = simulator.simulate(seconds, TRAFFIC)
+            gm.GlobalGMTrace.plot_output()
+            lb.GlobalLBTrace.plot_output()
+            row = summarize(stats)
+        row['wall'] = time.time() - start
+    finally:
+        os.chdir(cwd)
+    return (index, params, row)
+
+def sweep(grid=GRID, seconds=simulator.GM_ET, processes=None):
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(run, list(jobs(grid, seconds)), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return sorted(results)
+
+def write_table(results, grid=GRID, path="sweep.dat"):
+    names = [ name for (name, _) in grid ]
+    with open(path, "w+") as fp:
+        fp.write("#run\t" + "\t".join(names + COLUMNS) + "\n")
+        for (index, params, row) in results:
+            vals = [ params[n] for n in names ] + [ row[c] for c in COLUMNS ]
+            fp.write("{}\t".format(index) + "\t".join([ str(v) for v in vals ]) + "\n")
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else simulator.GM_ET
+    write_table(sweep(seconds=seconds, processes=processes))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import random
+import unittest
+
+import codec
+
+SAMPLES = {
+    'u8': [0, 7, 255],
+    'u16': [0, 29, 65535],
+    'u32': [0, 1234567, 2**32 - 1],
+    'f64': [0.0, -1.5, 299000.125],
+    'bool': [False, True],
+    'uuids': [[], [3], range(30)],
+    'fallback': [None, {'leader': 2, 'group': [4, 9], 'groupid': 77},
+                 {'leader': 0, 'group': [], 'groupid': 0}],
+}
+
+def messages(rand):
+    """
+    A message of every type and module, with sample field values.
+    """
+    for (tag, name, fields) in codec.MESSAGES:
+        for module in codec.MODULES:
+            msg = {'msg': name, 'module': module}
+            for (f, kind) in fields:
+                msg[f] = rand.choice(SAMPLES[kind])
+            yield msg
+
+class RoundTripTest(unittest.TestCase):
+    def test_messages(self):
+        rand = random.Random(1)
+        for _ in range(5):
+            for msg in messages(rand):
+                self.assertEqual(codec.decode(codec.encode(msg)), msg)
+
+    def test_constant_messages(self):
+        for module in codec.MODULES:
+            msg = {'msg': 'AreYouCoordinator', 'module': module}
+            self.assertEqual(codec.encode(msg), codec.encode(dict(msg)))
+            self.assertEqual(codec.decode(codec.encode(msg)), msg)
+
+    def test_envelope(self):
+        msgs = list(messages(random.Random(2)))
+        data = codec.encode_envelope(msgs)
+        self.assertEqual(codec.decode(data), {'msg': 'Envelope', 'module': 'all', 'messages': msgs})
+        # One message goes without an envelope
+        self.assertEqual(codec.encode_envelope(msgs[:1]), codec.encode(msgs[0]))
+
+    def test_broadcast(self):
+        msg = {'msg': 'Peerlist', 'module': 'gm', 'members': [1, 2, 5], 'leader': 1, 'congestion': 0}
+        data = codec.encode_broadcast([2, 5], msg)
+        self.assertEqual(codec.decode(data), {'msg': 'Broadcast', 'module': 'all', 'to': [2, 5], 'message': msg})
+
+    def test_decode_from(self):
+        msgs = list(messages(random.Random(3)))[:10]
+        data = "".join(map(codec.encode, msgs))
+        off = 0
+        for msg in msgs:
+            (got, off) = codec.decode_from(data, off)
+            self.assertEqual(got, msg)
+        self.assertEqual(off, len(data))
+
+if __name__ == "__main__":
+    unittest.main()
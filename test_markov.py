@@ -0,0 +1,61 @@
+import random
+import unittest
+
+import markov
+
+class SmallCounter(markov.TransitionCounter):
+    # Small buffers so runs, pairs and triples span several flushes
+    CHUNK = 7
+
+def sequence(rand, n, states=5, gaps=0.1):
+    return [ 'X' if rand.random() < gaps else rand.randrange(states) for _ in range(n) ]
+
+def add(d, other):
+    for k in other:
+        d[k] = d.get(k, 0) + other[k]
+    return d
+
+class TransitionCounterTest(unittest.TestCase):
+    def count(self, obs, cls=SmallCounter):
+        counter = cls()
+        counter.extend(obs)
+        return counter
+
+    def test_observe(self):
+        rand = random.Random(1)
+        for n in [2, 3, 7, 8, 50, 500]:
+            obs = sequence(rand, n)
+            counter = self.count(obs)
+            self.assertEqual(counter.observe(), markov.observe(obs))
+            self.assertEqual(counter.likely_observe(), markov.likely_observe(obs))
+            # observe2nd counts across an 'X'; the counter doesn't
+            second = markov.observe2nd(obs)
+            self.assertEqual(counter.observe2nd(),
+                             dict([ (k, v) for (k, v) in second.items() if 'X' not in k[0] + (k[1],) ]))
+
+    def test_chunks(self):
+        obs = sequence(random.Random(2), 3000, states=8)
+        (small, big) = (self.count(obs), self.count(obs, markov.TransitionCounter))
+        self.assertEqual(small.observe(), big.observe())
+        self.assertEqual(small.observe2nd(), big.observe2nd())
+        self.assertEqual(small.likely_observe(), big.likely_observe())
+
+    def test_merge(self):
+        rand = random.Random(3)
+        (obs1, obs2) = (sequence(rand, 200, states=4), sequence(rand, 300, states=6))
+        merged = self.count(obs1)
+        merged.merge(self.count(obs2))
+        self.assertEqual(merged.observe(), add(markov.observe(obs1), markov.observe(obs2)))
+        self.assertEqual(merged.likely_observe(),
+                         add(markov.likely_observe(obs1), markov.likely_observe(obs2)))
+
+    def test_chainify(self):
+        obs = sequence(random.Random(4), 1000)
+        got = self.count(obs).chainify()
+        want = markov.chainify(markov.observe(obs))
+        self.assertEqual(sorted(got), sorted(want))
+        for k in want:
+            self.assertAlmostEqual(got[k], want[k])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import gzip
+import shutil
+import random
+import tempfile
+import unittest
+
+import mkdataset
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        os.mkdir("datasets")
+        self.piece = mkdataset.PIECE
+        # Small pieces so files come in several
+        mkdataset.PIECE = 1000
+
+    def tearDown(self):
+        mkdataset.PIECE = self.piece
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        with open(name, "wb") as fp:
+            fp.write(data)
+        return name
+
+    def files(self):
+        rand = random.Random(1)
+        trace = "".join([ "+ {:.6f} /NodeList/{}/DeviceList/0\n".format(i * 0.001, rand.randrange(9))
+                          for i in range(400) ])
+        with gzip.open("csma.tr.gz", "wb") as fp:
+            fp.write(trace)
+        return {
+            'csma.tr': trace,
+            'csma.tr.gz': open("csma.tr.gz", "rb").read(),
+            'empty.dat': "",
+            'one.dat': "x",
+            'noise.bin': "".join([ chr(rand.randrange(256)) for _ in range(2500) ]),
+        }
+
+    def test_round_trip(self):
+        files = self.files()
+        paths = [ self.write(name, data) for (name, data) in sorted(files.items()) ]
+        entries = mkdataset.store(paths, processes=2)
+        self.assertEqual([ e['name'] for e in entries ], sorted(files))
+        for e in entries:
+            self.assertEqual(e['size'], len(files[e['name']]))
+            # Compressed already, so stored as it is
+            self.assertEqual(e['gzipped'], e['name'] != 'csma.tr.gz')
+        os.mkdir(mkdataset.dataset_path(1))
+        mkdataset.write_manifest(1, entries)
+        mkdataset.checkout(1)
+        for (name, data) in files.items():
+            with open(os.path.join(mkdataset.dataset_path(1), name), "rb") as fp:
+                self.assertEqual(fp.read(), data)
+
+    def test_dedup(self):
+        data = "".join([ str(i) for i in range(2000) ])
+        first = mkdataset.store([self.write("a.dat", data)])
+        again = mkdataset.store([self.write("b.dat", data), self.write("c.dat", data + "!")])
+        self.assertEqual(first[0]['object'], again[0]['object'])
+        self.assertNotEqual(again[0]['object'], again[1]['object'])
+        objects = [ name for (_, _, names) in os.walk(mkdataset.STORE) for name in names ]
+        self.assertEqual(len(objects), 2)
+        self.assertFalse([ name for name in objects if name.startswith("tmp-") ])
+
+    def test_checkout_names(self):
+        entries = mkdataset.store([self.write("a.dat", "a" * 3000), self.write("b.dat", "b")])
+        os.mkdir(mkdataset.dataset_path(2))
+        mkdataset.write_manifest(2, entries)
+        mkdataset.checkout(2, ["b.dat"])
+        self.assertEqual(sorted(os.listdir(mkdataset.dataset_path(2))), ["b.dat", "manifest.json"])
+        self.assertEqual(mkdataset.free_dataset(), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+import main as rpc
+
+from context import SimulationContext
+from schedule import ScheduleCommand
+
+class ScheduleCommandTest(unittest.TestCase):
+    def test_summarize(self):
+        with SimulationContext():
+            gm = rpc.DGIs[3].modules['gm']
+            cmds = [ ScheduleCommand(2000, True, gm.merge, gm),
+                     ScheduleCommand(1000, True, gm.check, gm),
+                     ScheduleCommand(500, False, gm.ready, gm),
+                     ScheduleCommand(3000, True, lambda: []) ]
+            rpc.schedule_rpcs(3, cmds, 0.0)
+            self.assertEqual(ScheduleCommand.summarize().split("\n"),
+                             ["1000\tcheck@3\t{}".format(cmds[1].sid),
+                              "2000\tmerge@3\t{}".format(cmds[0].sid),
+                              "3000\t<lambda>@None\t{}".format(cmds[3].sid)])
+            # Labelled as the function looks when it's written out
+            gm.leader = 7
+            line = ScheduleCommand.summarize(rpc.describe).split("\n")[0]
+            self.assertEqual(line, "1000\t{}\t{}".format(gm.check, cmds[1].sid))
+            self.assertTrue("L: 7" in line)
+
+    def test_cancel(self):
+        with SimulationContext():
+            ran = []
+            cmds = [ ScheduleCommand(1000, True, lambda i=i: ran.append(i) or [])
+                     for i in range(3) ]
+            events = rpc.schedule_rpcs(1, cmds, 0.0)
+            self.assertEqual(len(events), 1)
+            cancel = cmds[1].cancel().to_rpc()
+            self.assertEqual(cancel, {u'action': u'cancel', u'id': cmds[1].sid})
+            self.assertFalse(cmds[1].sid in ScheduleCommand.scheduled)
+            rpc.fire_bucket(ScheduleCommand.get(events[0][u'eventid']), 1.0)
+            self.assertEqual(ran, [0, 2])
+            self.assertFalse([ c for c in cmds if c.sid in ScheduleCommand.scheduled ])
+
+if __name__ == "__main__":
+    unittest.main()
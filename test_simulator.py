@@ -0,0 +1,64 @@
+import os
+import shutil
+import random
+import tempfile
+import unittest
+
+import gm
+import simulator
+
+from context import SimulationContext
+
+class LinkTest(unittest.TestCase):
+    def test_backlog(self):
+        rng = random.Random(1)
+        link = simulator.Link(bandwidth=10e6, red=True)
+        (idle, _) = link.transmit(0.0, 1000, rng)
+        link.offer(0.0, 20e6)
+        # 10Mbps more than the link carries for 50ms
+        (late, mark) = link.transmit(0.05, 1000, rng)
+        self.assertAlmostEqual(link.backlog, 0.5e6)
+        self.assertAlmostEqual(late - 0.05, idle + 0.05)
+        self.assertTrue(link.avg > 0)
+        self.assertEqual(mark, simulator.NO_MARK)
+        # Long enough to fill the queue and push the average past both thresholds
+        (dropped, mark) = link.transmit(5.0, 1000, rng)
+        self.assertEqual(dropped, None)
+        self.assertEqual(mark, simulator.HARD)
+        link.offer(5.0, 0.0)
+        link.transmit(10.0, 1000, rng)
+        self.assertEqual(link.backlog, 0.0)
+
+class SimulateTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def run_with(self, traffic, **overrides):
+        with SimulationContext(ENABLE_HARD_ECN=True, **overrides):
+            stats = simulator.simulate(30.0, traffic)
+            kinds = set([ e['kind'] for evs in gm.GlobalGMTrace.ecns.values() for e in evs ])
+        return (stats, kinds)
+
+    def test_overload(self):
+        traffic = simulator.OnOff(rate=40e6, on=1.0, off=1.0, start=5.0, stop=30.0)
+        (stats, kinds) = self.run_with(traffic)
+        self.assertTrue(stats['ecn'] > 0)
+        self.assertTrue(stats['dropped'] > 0)
+        self.assertEqual(kinds, set(['soft', 'hard']))
+
+    def test_light(self):
+        traffic = simulator.OnOff(start=5.0, stop=30.0)
+        # Every node's phase in one wheel bucket sends in one burst, which
+        # can get marked with no traffic behind it
+        (stats, kinds) = self.run_with(traffic, TIMER_BUCKET=0.0)
+        self.assertEqual((stats['ecn'], stats['dropped']), (0, 0))
+        self.assertEqual(kinds, set())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import random
+import tempfile
+import unittest
+
+import settings
+import simulator
+import sweep
+
+BASE = {'SCHEDULING_SIGMA': 5.0, 'CONGESTION_ADJUST': 1.5, 'ENABLE_SOFT_ECN': True,
+        'ENABLE_HARD_ECN': False, 'MESSAGE_DELIVERY_GAP': 1000}
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.traffic = sweep.TRAFFIC
+        # Congested from early on, so short runs see it
+        sweep.TRAFFIC = simulator.OnOff(rate=40e6, on=1.0, off=1.0, start=5.0, stop=60.0)
+
+    def tearDown(self):
+        sweep.TRAFFIC = self.traffic
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def row(self, index, **params):
+        job = dict(BASE)
+        job.update(params)
+        (_, _, row) = sweep.run((index, job, 60.0))
+        del row['wall']
+        return row
+
+    def test_repeatable(self):
+        before = dict([ (name, getattr(settings, name)) for name in BASE ])
+        random.seed(7)
+        state = random.getstate()
+        first = self.row(0)
+        other = self.row(1, SCHEDULING_SIGMA=0.0, MESSAGE_DELIVERY_GAP=500)
+        again = self.row(2)
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, other)
+        self.assertEqual(dict([ (name, getattr(settings, name)) for name in BASE ]), before)
+        self.assertEqual(random.getstate(), state)
+
+    def test_ecn_axes(self):
+        rows = [ self.row(0),
+                 self.row(1, ENABLE_HARD_ECN=True),
+                 self.row(2, CONGESTION_ADJUST=2.0) ]
+        self.assertTrue(min([ r['ecns'] for r in rows ]) > 0)
+        self.assertNotEqual(rows[0], rows[1])
+        self.assertNotEqual(rows[0], rows[2])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import random
+import unittest
+
+import dgi
+import settings
+import connectionmanager as cm
+
+from context import SimulationContext
+from timerwheel import TimerWheel
+
+class TimerWheelTest(unittest.TestCase):
+    def events(self, sigma, bucket=settings.TIMER_BUCKET, nodes=30):
+        """
+        The ns-3 events nodes' schedules turn into, the wheel holding
+        them, and how many phases each node has.
+        """
+        with SimulationContext(SCHEDULING_SIGMA=sigma):
+            connmgr = cm.ConnectionManager()
+            dgis = [ dgi.DGI(uuid, connmgr) for uuid in range(nodes) ]
+            wheel = TimerWheel(bucket)
+            events = []
+            for d in dgis:
+                scheds = d.schedule(1000, 12, scheduling_sigma=sigma)
+                for cmd in scheds:
+                    wcmd = wheel.add(d.uuid, cmd, 0.0)
+                    if wcmd is not None:
+                        events.append(wcmd)
+        return (events, wheel, len(scheds))
+
+    def test_phases(self):
+        for sigma in [settings.SCHEDULING_SIGMA, 10.0]:
+            (events, wheel, phases) = self.events(sigma)
+            self.assertEqual(len(events), phases)
+            for wcmd in events:
+                cmds = wheel.buckets[wcmd.when]
+                self.assertEqual(len(cmds), 30)
+                # Never early, and late by at most a bucket
+                for (_, cmd) in cmds:
+                    self.assertTrue(0 <= wcmd.when - cmd.when < settings.TIMER_BUCKET)
+
+    def test_no_bucket(self):
+        (events, _, phases) = self.events(settings.SCHEDULING_SIGMA, 0.0)
+        self.assertEqual(len(events), phases * 30)
+
+    def test_key(self):
+        wheel = TimerWheel(100.0)
+        self.assertEqual(wheel.key(1000.0), 1050.0)
+        self.assertEqual(wheel.key(950.5), 1050.0)
+        self.assertEqual(wheel.key(950.0), 950.0)
+        self.assertEqual(TimerWheel().key(950.25), 950.25)
+
+if __name__ == "__main__":
+    unittest.main()
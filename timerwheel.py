@@ -0,0 +1,66 @@
+"""
+Coalesces ScheduleCommands from every node that fall due at the same time.
+
+Every DGI schedules its GM and LB phases at nearly the same absolute times,
+and left alone ns-3 fires one event RPC per node per command. The wheel
+instead keeps the commands itself, bucketed by fire time, and only hands
+ns-3 one event per bucket. When that event fires, every command in the
+bucket runs in the same RPC.
+"""
+
+import math
+
+from schedule import ScheduleCommand
+
+class WheelCommand(ScheduleCommand):
+    """
+    The ns-3 event standing in for one bucket of the wheel.
+    """
+    def __init__(self, when):
+        super(WheelCommand, self).__init__(when, True, None)
+
+    def record(self):
+        # The commands in the bucket are logged as they're added.
+        pass
+
+class TimerWheel(object):
+    def __init__(self, bucket=0.0):
+        """
+        bucket is the width of a bucket in ms. Buckets are centred on the
+        multiples of the width, where the phases fall before each node's
+        gauss offset, so a phase stays in one bucket unless the offset is
+        more than half a bucket. Commands are delayed to the end of their
+        bucket, by up to a whole bucket; with a width of 0 only commands
+        with identical fire times share an event.
+        """
+        self.bucket = bucket
+        self.buckets = {}
+
+    def key(self, when):
+        if not self.bucket:
+            return when
+        half = self.bucket / 2.0
+        return math.ceil((when - half) / self.bucket) * self.bucket + half
+
+    def add(self, nid, cmd, sim_time):
+        """
+        Files cmd, to be run for node nid, under its fire time. Returns the
+        WheelCommand to hand to ns-3 if this opened a new bucket, else None.
+        """
+        when = cmd.when if cmd.when_is_absolute else sim_time*1000 + cmd.when
+        cmd.record()
+        k = self.key(when)
+        try:
+            self.buckets[k].append((nid, cmd))
+            return None
+        except KeyError:
+            self.buckets[k] = [(nid, cmd)]
+            return WheelCommand(k)
+
+    def pop(self, wcmd):
+        """
+        Everything due when wcmd fires, as (nid, ScheduleCommand) in the
+        order it was added.
+        """
+        ScheduleCommand.scheduled.pop(wcmd.sid, None)
+        return self.buckets.pop(wcmd.when, [])
@@ -0,0 +1,145 @@
+"""
+Cheap tracing of every protocol message sent or received.
+
+Each event is a fixed size binary record: the simulation time, what
+happened (SEND, RECV or BCAST), the module and codec tag of the message,
+who it was from and to, and up to two key fields of the message. Records
+go into a preallocated buffer. With a file open the buffer is written out
+in one go whenever it fills up; without one it is a ring that keeps the
+most recent events. Nothing is formatted until someone asks:
+
+    python tracing.py protocol.trace gm > gm-protocol.log
+"""
+
+import sys
+import struct
+
+import codec
+
+RECORD = struct.Struct("!dBBBHHdd")
+
+SEND = 0
+RECV = 1
+BCAST = 2
+KINDS = ['SEND', 'RECV', 'BCAST']
+
+# Stands in for the destination of a broadcast.
+EVERYONE = 0xFFFF
+
+# The fields worth keeping for each message type, at most two.
+KEYS = {
+    'AYCResponse': ('resp', 'leader'),
+    'AreYouThere': ('groupid',),
+    'AYTResponse': ('resp', 'groupid'),
+    'Invite': ('pendingid', 'leader'),
+    'Ready': ('groupid', 'leader'),
+    'ReadyAck': ('groupid',),
+    'Peerlist': ('leader', 'congestion'),
+    'StateChange': ('state',),
+    'DraftRequest': ('counter',),
+    'DraftAge': ('age', 'counter'),
+    'DraftSelect': ('step', 'counter'),
+    'DraftAccept': ('counter',),
+    'TooLate': ('counter',),
+}
+
+class ProtocolTrace(object):
+    enabled = False
+    capacity = 0
+    buf = None
+    count = 0
+    wrapped = False
+    fp = None
+
+    @staticmethod
+    def open(path=None, capacity=1 << 16):
+        """
+        Starts tracing. With a path, full buffers are appended to that file;
+        without one only the last capacity events are kept.
+        """
+        ProtocolTrace.close()
+        ProtocolTrace.capacity = capacity
+        ProtocolTrace.buf = bytearray(capacity * RECORD.size)
+        ProtocolTrace.count = 0
+        ProtocolTrace.wrapped = False
+        ProtocolTrace.fp = open(path, "wb") if path else None
+        ProtocolTrace.enabled = True
+
+    @staticmethod
+    def record(kind, sim_time, sender, dest, msg):
+        name = msg['msg']
+        keys = KEYS.get(name, ())
+        k1 = float(msg[keys[0]]) if keys else 0.0
+        k2 = float(msg[keys[1]]) if len(keys) > 1 else 0.0
+        RECORD.pack_into(ProtocolTrace.buf, ProtocolTrace.count * RECORD.size,
+            sim_time, kind, codec.MODULE_TAGS[msg['module']], codec.TAGS[name],
+            sender, dest, k1, k2)
+        ProtocolTrace.count += 1
+        if ProtocolTrace.count == ProtocolTrace.capacity:
+            ProtocolTrace.flush()
+
+    @staticmethod
+    def flush():
+        if ProtocolTrace.fp:
+            ProtocolTrace.fp.write(buffer(ProtocolTrace.buf, 0, ProtocolTrace.count * RECORD.size))
+        elif ProtocolTrace.count == ProtocolTrace.capacity:
+            ProtocolTrace.wrapped = True
+        else:
+            return
+        ProtocolTrace.count = 0
+
+    @staticmethod
+    def close():
+        if ProtocolTrace.fp:
+            ProtocolTrace.flush()
+            ProtocolTrace.fp.close()
+            ProtocolTrace.fp = None
+        ProtocolTrace.enabled = False
+
+    @staticmethod
+    def recent():
+        """
+        The buffered records, oldest first, as a string of packed records.
+        """
+        used = ProtocolTrace.count * RECORD.size
+        if ProtocolTrace.wrapped:
+            return str(ProtocolTrace.buf[used:] + ProtocolTrace.buf[:used])
+        return str(ProtocolTrace.buf[:used])
+
+def records(data):
+    for off in xrange(0, len(data) - RECORD.size + 1, RECORD.size):
+        yield RECORD.unpack_from(data, off)
+
+def format_record(rec):
+    (t, kind, mod, tag, sender, dest, k1, k2) = rec
+    name = codec.NAMES[tag]
+    fields = dict(codec.LAYOUTS[tag])
+    msg = ["'msg': '{}'".format(name)]
+    for (key, v) in zip(KEYS.get(name, ()), (k1, k2)):
+        if fields[key] == 'bool':
+            v = bool(v)
+        elif fields[key] != 'f64':
+            v = int(v)
+        msg.append("'{}': {}".format(key, v))
+    dest = "*" if dest == EVERYONE else dest
+    return "{}s: {} F: {} T: {} -- {{{}}}".format(t, KINDS[kind], sender, dest, ", ".join(msg))
+
+def render(data, module=None):
+    """
+    Yields the gm.log/lb.log style line for every record, optionally only
+    those of one module.
+    """
+    mod = codec.MODULE_TAGS[module] if module else None
+    for rec in records(data):
+        if mod is None or rec[2] == mod:
+            yield format_record(rec)
+
+def main():
+    with open(sys.argv[1], "rb") as fp:
+        data = fp.read()
+    module = sys.argv[2] if len(sys.argv) > 2 else None
+    for line in render(data, module):
+        print line
+
+if __name__ == "__main__":
+    main()
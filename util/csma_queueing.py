@@ -1,16 +1,57 @@
+"""
+Queue sizes over time at every CSMA device, from the ns-3 ASCII trace.
+
+The trace gets to gigabytes, so it is read through mmap in line aligned
+chunks, several at a time, and only the event, time and trace path of each
+line are looked at. Every chunk comes back as times and event kinds per
+location; the queue counts are carried from one chunk to the next when
+they're written out, as queue-<location>.dat and drops-<location>.dat or
+as a columnar store the notebook can map straight in:
+
+    python csma_queueing.py csma.tr [processes] [text|columns|stats|packets|flows]
+
+stats only keeps a summary of every location's queue per time bucket.
+packets and flows decode every header of every line as well: packets
+keeps them all as a record array, flows totals them per flow and per kind
+of traffic.
+
+A trace compressed with gzip, xz or zstd (.gz, .xz or .zst), a named pipe
+or - for stdin is read front to back instead, in blocks that are handed
+out the same way, so the trace never has to be on disk uncompressed. ns-3
+writes csma.tr into a pipe made with mkfifo as happily as into a file, and
+the outputs then fill in while the simulation runs.
+"""
+
+import os
+import re
 import sys
-import itertools
+import json
+import mmap
+import stat
+import subprocess
+import collections
+import multiprocessing
+
+import numpy as np
 
 class CSMATraceEntry(object):
     def __init__(self, inp):
         """
         + 0.984 /NodeList/9/DeviceList/0/$ns3::CsmaNetDevice/TxQueue/Enqueue ns3::EthernetHeader ( length/type=0x800, source=00:00:00:00:00:1b, destination=00:00:00:00:00:15) ns3::Ipv4Header (tos 0x0 DSCP Default ECN Not-ECT ttl 64 id 0 protocol 17 offset (bytes) 0 flags [none] length: 72 10.1.2.4 > 10.1.1.4) ns3::UdpHeader (length: 52 9 > 9) Payload (size=44) ns3::EthernetTrailer (fcs=0)
+
+        Headers the packet doesn't have leave their fields as None.
         """
-        tokens = inp.split()
-        self.event_type = tokens[0]
-        self.time = float(tokens[1])
-        self.location = NS3TracePath(tokens[2])
-        # I'll add more later... don't care right now.
+        (event_type, t, path, self.eth_src, self.eth_dst, tos, ecn, proto,
+         self.ip_src, self.ip_dst, sport, dport, size) = PACKET_LINE.match(inp).groups()
+        self.event_type = event_type
+        self.time = float(t)
+        self.location = NS3TracePath(path)
+        self.tos = int(tos, 16) if tos else None
+        self.ecn = ECN_CODEPOINTS[ecn] if ecn else None
+        self.protocol = int(proto) if proto else None
+        self.sport = int(sport) if sport else None
+        self.dport = int(dport) if dport else None
+        self.size = int(size) if size else None
 
 class NS3TracePath(object):
     def __init__(self, path):
@@ -42,65 +83,699 @@ class NS3TracePath(object):
         else:
             return "N{}-D{}".format(self.node, self.device)
 
-def dataset_queue_size(entries):
+# The event, time and trace path at the start of the lines that touch a
+# queue. Receives ("r") don't.
+EVENT = re.compile(r"^([-+d]) (\S+) (\S+)", re.M)
+
+ENQUEUE = ord("+")
+DEQUEUE = ord("-")
+DROP = ord("d")
+
+CHUNK = 64 << 20
+
+def chunks(path, size=CHUNK):
+    """
+    (start, end) byte ranges covering path, each ending at the end of a line.
+    """
+    total = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as fp:
+        start = 0
+        while start < total:
+            end = min(start + size, total)
+            if end < total:
+                fp.seek(end - 1)
+                fp.readline()
+                end = fp.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+# Programs that decompress a trace to stdout, by suffix
+DECOMPRESSORS = {
+    '.gz': ['gzip', '-dc'],
+    '.xz': ['xz', '-dc'],
+    '.zst': ['zstd', '-dc'],
+}
+
+BLOCK = 8 << 20
+
+def is_stream(path):
+    """
+    Whether path can only be read front to back: - for stdin, a named pipe
+    or a compressed trace.
+    """
+    if path == "-" or os.path.splitext(path)[1] in DECOMPRESSORS:
+        return True
+    return stat.S_ISFIFO(os.stat(path).st_mode)
+
+def blocks(path, size=BLOCK):
+    """
+    The text of path in blocks of about size bytes, each ending at the end
+    of a line, as it arrives. A compressed trace goes through its
+    decompressor, a pipe is read until whatever writes it closes it.
+    """
+    command = DECOMPRESSORS.get(os.path.splitext(path)[1])
+    proc = None
+    if path == "-":
+        fp = sys.stdin
+    elif command:
+        proc = subprocess.Popen(command + [path], stdout=subprocess.PIPE)
+        fp = proc.stdout
+    else:
+        fp = open(path, "rb")
+    fd = fp.fileno()
+    pieces = []
+    held = 0
+    done = False
+    try:
+        while True:
+            data = os.read(fd, min(size, 1 << 20))
+            if data:
+                pieces.append(data)
+                held += len(data)
+                if held < size:
+                    continue
+            text = "".join(pieces)
+            cut = len(text) if not data else text.rfind("\n") + 1
+            if cut:
+                yield text[:cut]
+            pieces = [text[cut:]] if cut < len(text) else []
+            held = len(text) - cut
+            if not data:
+                break
+        done = True
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+        if proc:
+            if not done and proc.poll() is None:
+                proc.kill()
+            if proc.wait() and done:
+                raise IOError("{} failed on {}".format(command[0], path))
+
+def pooled(fn, jobs, processes=None):
+    """
+    fn of every job, in order. Unless processes is 1 the jobs go to a pool a
+    few at a time, so a stream isn't read much further than it's parsed.
+    """
+    if processes == 1:
+        for job in jobs:
+            yield fn(job)
+        return
+    pool = multiprocessing.Pool(processes)
+    ahead = 2 * (processes or multiprocessing.cpu_count())
+    pending = collections.deque()
+    try:
+        for job in jobs:
+            pending.append(pool.apply_async(fn, (job,)))
+            if len(pending) >= ahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+
+def parse_events(buf, start, end):
+    """
+    The queue events on the lines of buf between start and end, as times
+    and kinds (ENQUEUE, DEQUEUE or DROP) in trace order per location key.
+    """
+    keys = {}
+    events = {}
+    for m in EVENT.finditer(buf, start, end):
+        (kind, t, trace) = m.groups()
+        try:
+            loc = keys[trace]
+        except KeyError:
+            loc = keys[trace] = intern(NS3TracePath(trace).askey())
+        try:
+            (times, kinds) = events[loc]
+        except KeyError:
+            (times, kinds) = events[loc] = ([], [])
+        times.append(t)
+        kinds.append(kind)
+    return dict([ (loc, (np.array(times).astype(np.float64), np.frombuffer("".join(kinds), np.uint8)))
+                  for (loc, (times, kinds)) in events.iteritems() ])
+
+def parse_chunk(job):
+    (path, start, end) = job
+    with open(path, "rb") as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return parse_events(mm, start, end)
+        finally:
+            mm.close()
+
+def parse_block(block):
+    return parse_events(block, 0, len(block))
+
+def parsed(path, processes=None, chunk=parse_chunk, block=parse_block):
+    """
+    chunk of every (path, start, end) chunk of path, or block of every block
+    of it if it's a stream, in trace order.
+    """
+    if is_stream(path):
+        return pooled(block, blocks(path), processes)
+    jobs = [ (path, start, end) for (start, end) in chunks(path) ]
+    return pooled(chunk, jobs, 1 if len(jobs) < 2 else processes)
+
+def write_points(fp, times, counts):
+    fp.write("".join([ "{}\t{}\n".format(t, n) for (t, n) in zip(times.tolist(), counts.tolist()) ]))
+
+class TextQueues(object):
+    """
+    queue-<location>.dat and drops-<location>.dat: a time and queue count
+    per line.
+    """
+    def __init__(self):
+        self.queue_fps = {}
+        self.drop_fps = {}
+
+    def add(self, loc, times, counts, kinds):
+        if loc not in self.queue_fps:
+            self.queue_fps[loc] = open("queue-{}.dat".format(loc), "w+")
+            self.drop_fps[loc] = open("drops-{}.dat".format(loc), "w+")
+        dropped = kinds == DROP
+        write_points(self.queue_fps[loc], times[~dropped], counts[~dropped])
+        write_points(self.drop_fps[loc], times[dropped], counts[dropped])
+
+    def close(self):
+        for loc in self.queue_fps:
+            self.queue_fps[loc].close()
+            self.drop_fps[loc].close()
+
+# The columns of a ColumnQueues store
+COLUMNS = [('time', '<f8'), ('count', '<i4'), ('kind', 'u1')]
+
+class ColumnQueues(object):
+    """
+    One directory of .npy columns for every event of every location, each
+    location's events together in trace order, and index.json saying
+    where each location starts and stops. load_queues() maps it back in.
+
+    Columns are written in arrival order to temporary files first and put
+    in location order by close(), a piece at a time.
+    """
+    def __init__(self, path="queues"):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.tmp = dict([ (name, open(self.column(name, ".tmp"), "wb")) for (name, _) in COLUMNS ])
+        self.ids = {}
+        self.sizes = []
+        # (location id, offset, length) of every add
+        self.pieces = []
+        self.written = 0
+
+    def column(self, name, ext=".npy"):
+        return os.path.join(self.path, name + ext)
+
+    def add(self, loc, times, counts, kinds):
+        if loc not in self.ids:
+            self.ids[loc] = len(self.sizes)
+            self.sizes.append(0)
+        lid = self.ids[loc]
+        for (name, dtype) in COLUMNS:
+            np.asarray({'time': times, 'count': counts, 'kind': kinds}[name], dtype).tofile(self.tmp[name])
+        self.pieces.append((lid, self.written, len(times)))
+        self.sizes[lid] += len(times)
+        self.written += len(times)
+
+    def close(self):
+        for fp in self.tmp.itervalues():
+            fp.close()
+        starts = [0]
+        for n in self.sizes:
+            starts.append(starts[-1] + n)
+        for (name, dtype) in COLUMNS:
+            if not self.written:
+                np.save(self.column(name), np.zeros(0, dtype))
+            else:
+                src = np.memmap(self.column(name, ".tmp"), dtype, "r")
+                dst = np.lib.format.open_memmap(self.column(name), "w+", dtype, (self.written,))
+                cursor = list(starts)
+                for (lid, offset, n) in self.pieces:
+                    dst[cursor[lid]:cursor[lid] + n] = src[offset:offset + n]
+                    cursor[lid] += n
+                dst.flush()
+                del src, dst
+            os.remove(self.column(name, ".tmp"))
+        index = {
+            'columns': [ name for (name, _) in COLUMNS ],
+            'kinds': {'enqueue': ENQUEUE, 'dequeue': DEQUEUE, 'drop': DROP},
+            'locations': dict([ (loc, [starts[lid], starts[lid + 1]]) for (loc, lid) in self.ids.iteritems() ]),
+        }
+        with open(os.path.join(self.path, "index.json"), "w+") as fp:
+            json.dump(index, fp, indent=1, sort_keys=True)
+
+# Default width of a QueueStats bucket, in seconds
+BUCKET_WIDTH = 0.1
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+# Depth bins for the quantiles: exact up to 8, then half an octave wide.
+DEPTH_EDGES = np.unique(np.concatenate((np.arange(8), np.round(2 ** np.arange(3, 16.5, 0.5))))).astype(np.int64)
+
+def _grow(arr, n):
+    if len(arr) >= n:
+        return arr
+    out = np.zeros((max(n, 2 * len(arr)),) + arr.shape[1:], dtype=arr.dtype)
+    out[:len(arr)] = arr
+    return out
+
+class BucketSummary(object):
+    """
+    One location's queue depth, bucket by bucket: how long it spent at
+    every depth bin, how deep it got either way, and the drops. The depth
+    holds from one event to the next, starting empty at time 0.
+    """
+    def __init__(self, width):
+        self.width = width
+        self.last_time = 0.0
+        self.last_count = 0
+        self.buckets = 0
+        self.low = np.zeros(0, np.int64)
+        self.high = np.zeros(0, np.int64)
+        self.drops = np.zeros(0, np.int64)
+        self.covered = np.zeros(0)
+        self.area = np.zeros(0)
+        self.spent = np.zeros((0, len(DEPTH_EDGES)))
+
+    def add(self, times, counts, dropped):
+        """
+        Events after the last ones added: their times, the depths they left
+        and which were drops. An event stamped earlier than the one before
+        it is taken to happen at the same time.
+        """
+        w = self.width
+        times = np.maximum.accumulate(np.maximum(times, self.last_time))
+        first = int(self.last_time // w) + 1
+        last = int(times[-1] // w)
+        # The depth at every bucket boundary crossed starts a piece too
+        bounds = np.arange(first, last + 1)
+        prior = np.concatenate(([self.last_count], counts))
+        at_bounds = prior[np.searchsorted(times, bounds * w, side='right')]
+        event_buckets = (times // w).astype(np.int64)
+        starts = np.concatenate(([self.last_time], times, bounds * w))
+        order = np.argsort(starts, kind='mergesort')
+        starts = starts[order]
+        depths = np.concatenate(([self.last_count], counts, at_bounds))[order]
+        buckets = np.concatenate(([int(self.last_time // w)], event_buckets, bounds))[order]
+        durations = np.diff(np.append(starts, times[-1]))
+
+        n = int(buckets.max()) + 1
+        if n > self.buckets:
+            for name in ('low', 'high', 'drops', 'covered', 'area', 'spent'):
+                setattr(self, name, _grow(getattr(self, name), n))
+            self.low[self.buckets:] = np.iinfo(np.int64).max
+            self.high[self.buckets:] = np.iinfo(np.int64).min
+            self.buckets = n
+        np.minimum.at(self.low, buckets, depths)
+        np.maximum.at(self.high, buckets, depths)
+        self.drops[:n] += np.bincount(event_buckets[dropped], minlength=n)
+        self.covered[:n] += np.bincount(buckets, durations, minlength=n)
+        self.area[:n] += np.bincount(buckets, depths * durations, minlength=n)
+        bins = np.searchsorted(DEPTH_EDGES, depths, side='right') - 1
+        nbins = len(DEPTH_EDGES)
+        self.spent[:n] += np.bincount(buckets * nbins + bins, durations, minlength=n * nbins).reshape(n, nbins)
+
+        self.last_time = float(times[-1])
+        self.last_count = int(counts[-1])
+
+    def finish(self, end):
+        """
+        Holds the last depth until end.
+        """
+        if end > self.last_time:
+            self.add(np.array([end]), np.array([self.last_count]), np.array([False]))
+
+    def quantiles(self, qs):
+        """
+        Time weighted quantiles of depth per bucket, as the lower edge of
+        the bin they fall in.
+        """
+        spent = self.spent[:self.buckets]
+        cum = np.cumsum(spent, axis=1)
+        total = cum[:, -1:]
+        out = []
+        for q in qs:
+            first = np.argmax(cum >= q * total - 1e-12, axis=1)
+            out.append(DEPTH_EDGES[first])
+        return out
+
+    def rows(self):
+        n = self.buckets
+        covered = self.covered[:n]
+        mean = np.where(covered > 0, self.area[:n] / np.where(covered > 0, covered, 1), self.low[:n])
+        return zip(*([ (np.arange(n) * self.width).tolist(), self.low[:n].tolist(), self.high[:n].tolist(),
+                       mean.tolist(), self.drops[:n].tolist() ] + [ q.tolist() for q in self.quantiles(QUANTILES) ]))
+
+class QueueStats(object):
+    """
+    stats-<location>.dat: a line per bucket of width seconds with the
+    least, greatest and time weighted mean queue depth, the drops and
+    approximate depth quantiles. Memory goes with the number of buckets,
+    not events. Every location is summarised up to the last event at any
+    of them.
+    """
+    def __init__(self, width=BUCKET_WIDTH):
+        self.width = float(width)
+        self.summaries = {}
+        self.end = 0.0
+
+    def add(self, loc, times, counts, kinds):
+        if loc not in self.summaries:
+            self.summaries[loc] = BucketSummary(self.width)
+        self.summaries[loc].add(times, counts, kinds == DROP)
+        self.end = max(self.end, float(times[-1]))
+
+    def close(self):
+        header = "#start\tmin\tmax\tmean\tdrops\t" + "\t".join([ "p{:g}".format(100 * q) for q in QUANTILES ]) + "\n"
+        for (loc, summary) in self.summaries.iteritems():
+            summary.finish(self.end)
+            with open("stats-{}.dat".format(loc), "w+") as fp:
+                fp.write(header)
+                for row in summary.rows():
+                    fp.write("\t".join([ str(v) for v in row ]) + "\n")
+
+OUTPUTS = {
+    'text': TextQueues,
+    'columns': ColumnQueues,
+    'stats': QueueStats,
+}
+
+def load_queues(path="queues"):
+    """
+    {location: {column: array}} for a ColumnQueues store, memory mapped.
+    """
+    with open(os.path.join(path, "index.json")) as fp:
+        index = json.load(fp)
+    columns = [ (name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r")) for name in index['columns'] ]
+    return dict([ (loc, dict([ (name, col[start:stop]) for (name, col) in columns ]))
+                  for (loc, (start, stop)) in index['locations'].iteritems() ])
+
+def dataset_queue_size(batches, outputs=None):
+    """
+    batches are parse_chunk's results in trace order. Every output is
+    handed each location's events with their queue counts as they come.
+    """
+    if outputs is None:
+        outputs = [TextQueues()]
     queue_tracker = {}
-    #data_points = {}
-    #drop_events = {}
-    queue_fps = {}
-    drop_fps = {}
-    for e in entries:
-        loc = e.location.askey()
-        t = e.time
-        
-        if e.event_type == "r":
-            # We don't care about this.
-            continue
-
-        if loc not in queue_tracker:
-            queue_tracker[loc] = 0
-            queue_fps[loc] = open("queue-{}.dat".format(loc), "w+")
-            drop_fps[loc] = open("drops-{}.dat".format(loc), "w+")
-            #data_points[loc] = []
-            #drop_events[loc] = []
-        
-        qc = True
-        if e.event_type == "+":
-            queue_tracker[loc] += 1
-        elif e.event_type == "-":
-            queue_tracker[loc] -= 1
+    for batch in batches:
+        for (loc, (times, kinds)) in batch.iteritems():
+            step = (kinds == ENQUEUE).astype(np.int64) - (kinds == DEQUEUE)
+            counts = queue_tracker.get(loc, 0) + np.cumsum(step)
+            queue_tracker[loc] = int(counts[-1])
+            for out in outputs:
+                out.add(loc, times, counts, kinds)
+    for out in outputs:
+        out.close()
+
+# Every field of a line, for decode(). The headers after the trace path
+# are each optional: ARP has no IPv4 header, TCP segments no payload size.
+PACKET_LINE = re.compile(
+    r"^([-+dr]) (\S+) (\S+)"
+    r"(?: ns3::EthernetHeader \( length/type=0x[0-9a-f]+, source=([0-9a-f:]+), destination=([0-9a-f:]+)\))?"
+    r"(?: ns3::Ipv4Header \(tos 0x([0-9a-f]+) DSCP \S+ ECN (Not-ECT|ECT \(0\)|ECT \(1\)|CE) ttl \d+ id \d+"
+    r" protocol (\d+) offset \(bytes\) \d+ flags \[[^\]]*\] length: \d+ ([\d.]+) > ([\d.]+)\))?"
+    r"(?: ns3::(?:Udp|Tcp)Header \((?:length: \d+ )?(\d+) > (\d+))?"
+    r"(?:.*? Payload \(size=(\d+)\))?", re.M)
+
+RECEIVE = ord("r")
+
+ECN_CODEPOINTS = {'Not-ECT': 0, 'ECT (1)': 1, 'ECT (0)': 2, 'CE': 3}
+CE = 3
+
+# One record per line of the trace. Addresses are integers; fields of
+# headers a packet doesn't have are 0. loc indexes the location keys
+# decode() hands out with the records.
+PACKET = np.dtype([
+    ('time', '<f8'),
+    ('event', 'u1'),
+    ('loc', '<u2'),
+    ('eth_src', '<u8'),
+    ('eth_dst', '<u8'),
+    ('tos', 'u1'),
+    ('ecn', 'u1'),
+    ('proto', 'u1'),
+    ('ip_src', '<u4'),
+    ('ip_dst', '<u4'),
+    ('sport', '<u2'),
+    ('dport', '<u2'),
+    ('size', '<u2'),
+    ('traffic', 'u1'),
+])
+
+# What the traffic field means. GM and LB share the DGIs' port, and one
+# datagram can carry both, so they're DGI traffic together.
+TRAFFIC = ['other', 'dgi', 'troll', 'background']
+(OTHER, DGI, TROLL, BACKGROUND) = range(len(TRAFFIC))
+
+# These mirror main.py and ns3/simulations/py.cc
+DGI_PORT = 9
+BACKGROUND_PORT = 22
+TROLL_IPS = ["10.1.1.2", "10.1.2.2", "10.1.3.2", "224.1.1.1"]
+
+def ip_number(ip):
+    a = [ int(x) for x in ip.split(".") ]
+    return (a[0] << 24) | (a[1] << 16) | (a[2] << 8) | a[3]
+
+def ip_string(n):
+    return ".".join([ str((int(n) >> s) & 0xff) for s in (24, 16, 8, 0) ])
+
+TROLL_NUMBERS = np.array([ ip_number(ip) for ip in TROLL_IPS ], np.uint32)
+
+class Cache(dict):
+    """
+    Remembers convert(s) for every s it has seen; the same addresses and
+    ports turn up on almost every line.
+    """
+    def __init__(self, convert):
+        dict.__init__(self)
+        self.convert = convert
+
+    def __missing__(self, s):
+        v = self[s] = self.convert(s) if s else 0
+        return v
+
+def classify(records):
+    ports = (records['sport'], records['dport'])
+    troll = np.in1d(records['ip_src'], TROLL_NUMBERS) | np.in1d(records['ip_dst'], TROLL_NUMBERS)
+    dgi = (ports[0] == DGI_PORT) | (ports[1] == DGI_PORT)
+    traffic = np.zeros(len(records), np.uint8)
+    traffic[dgi] = DGI
+    traffic[dgi & troll] = TROLL
+    traffic[(ports[0] == BACKGROUND_PORT) | (ports[1] == BACKGROUND_PORT)] = BACKGROUND
+    return traffic
+
+def decode_lines(buf, start, end):
+    """
+    Every line of buf between start and end as a PACKET record, and the
+    location keys their loc fields index.
+    """
+    locs = []
+    loc_ids = {}
+    def loc_id(trace):
+        key = NS3TracePath(trace).askey()
+        if key not in loc_ids:
+            loc_ids[key] = len(locs)
+            locs.append(key)
+        return loc_ids[key]
+    traces = Cache(loc_id)
+    macs = Cache(lambda s: int(s.replace(":", ""), 16))
+    ips = Cache(ip_number)
+    numbers = Cache(int)
+    hexes = Cache(lambda s: int(s, 16))
+    rows = []
+    for m in PACKET_LINE.finditer(buf, start, end):
+        (kind, t, trace, esrc, edst, tos, ecn, proto, isrc, idst, sport, dport, size) = m.groups()
+        rows.append((float(t), ord(kind), traces[trace], macs[esrc], macs[edst], hexes[tos],
+                     ECN_CODEPOINTS.get(ecn, 0), numbers[proto], ips[isrc], ips[idst],
+                     numbers[sport], numbers[dport], numbers[size], OTHER))
+    records = np.array(rows, PACKET)
+    records['traffic'] = classify(records)
+    return (locs, records)
+
+def decode_chunk(job):
+    (path, start, end) = job
+    with open(path, "rb") as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return decode_lines(mm, start, end)
+        finally:
+            mm.close()
+
+def decode_block(block):
+    return decode_lines(block, 0, len(block))
+
+def packet_batches(path, processes=None):
+    """
+    Yields every chunk of path as PACKET records, with the location keys
+    found so far; loc indexes those.
+    """
+    locations = []
+    ids = {}
+    for (locs, records) in parsed(path, processes, decode_chunk, decode_block):
+        for loc in locs:
+            if loc not in ids:
+                ids[loc] = len(locations)
+                locations.append(loc)
+        if len(records):
+            records['loc'] = np.array([ ids[loc] for loc in locs ], np.uint16)[records['loc']]
+        yield (records, locations)
+
+def queue_batch(records, locations):
+    """
+    records as parse_chunk would have returned them.
+    """
+    records = records[records['event'] != RECEIVE]
+    records = records[np.argsort(records['loc'], kind='mergesort')]
+    bounds = np.flatnonzero(np.diff(records['loc'])) + 1
+    batch = {}
+    for group in np.split(records, bounds):
+        if len(group):
+            batch[locations[group['loc'][0]]] = (group['time'], group['event'])
+    return batch
+
+class PacketRecords(object):
+    """
+    packets.npy, every PACKET record in trace order, and packets.json,
+    which says what the loc and traffic fields mean. load_packets() maps
+    them back in.
+    """
+    def __init__(self, path="packets"):
+        self.path = path
+        self.tmp = open(path + ".tmp", "wb")
+        self.count = 0
+
+    def add(self, records, locations):
+        records.tofile(self.tmp)
+        self.count += len(records)
+
+    def close(self, locations):
+        self.tmp.close()
+        if self.count:
+            src = np.memmap(self.path + ".tmp", PACKET, "r")
+            dst = np.lib.format.open_memmap(self.path + ".npy", "w+", PACKET, (self.count,))
+            for i in xrange(0, self.count, 1 << 20):
+                dst[i:i + (1 << 20)] = src[i:i + (1 << 20)]
+            dst.flush()
+            del src, dst
         else:
-            qc = False
-        if qc:
-            queue_fps[loc].write("{}\t{}\n".format(t,queue_tracker[loc]))
-            #data_points[loc].append((t, queue_tracker[loc]))
-
-        if e.event_type == "d":
-            drop_fps[loc].write("{}\t{}\n".format(t,queue_tracker[loc]))
-            #drop_events[loc].append((t, queue_tracker[loc]))
-    
-    for loc in queue_fps:
-        queue_fps[loc].close()
-        drop_fps[loc].close()
-    
+            np.save(self.path + ".npy", np.zeros(0, PACKET))
+        os.remove(self.path + ".tmp")
+        with open(self.path + ".json", "w+") as fp:
+            json.dump({'locations': locations, 'traffic': TRAFFIC, 'ecn': ECN_CODEPOINTS}, fp, indent=1, sort_keys=True)
+
+def load_packets(path="packets"):
+    """
+    The records and what their fields mean, memory mapped.
+    """
+    with open(path + ".json") as fp:
+        meta = json.load(fp)
+    return (np.load(path + ".npy", mmap_mode="r"), meta)
+
+# What FlowStats counts for every flow
+FLOW_COLUMNS = ['enqueued', 'bytes', 'marked', 'dequeued', 'dropped', 'received']
+
+class FlowStats(object):
+    """
+    Per flow (source and destination address and port) and per kind of
+    traffic: how often its packets were queued, their payload bytes and
+    how many of those were CE marked, and how often they left a queue,
+    were dropped and were received. A packet counts once per hop.
+    flows.dat has a line per flow, traffic.dat one per kind of traffic.
     """
-    for loc in queue_tracker:
-        safename = loc
-        with open("queue-{}.dat".format(safename), "w+") as fp:
-            for t,v in data_points[loc]:
-                fp.write("{}\t{}\n".format(t,v))
-        with open("drops-{}.dat".format(safename), "w+") as fp:
-            for t,v in drop_events[loc]:
-                fp.write("{}\t{}\n".format(t,v))
-    """
-                
-def do(path):
-    with open(path) as fp:
-        #contents = list(fp)
-        entries = itertools.imap(CSMATraceEntry, fp)
-        dataset_queue_size(entries)
+    def __init__(self, path="flows.dat", traffic_path="traffic.dat"):
+        self.path = path
+        self.traffic_path = traffic_path
+        self.flows = {}
+        self.traffic = dict([ (name, [0] * len(FLOW_COLUMNS)) for name in TRAFFIC ])
+
+    def add(self, records, locations):
+        if not len(records):
+            return
+        event = records['event']
+        enqueued = event == ENQUEUE
+        columns = [
+            enqueued,
+            np.where(enqueued, records['size'], 0),
+            enqueued & (records['ecn'] == CE),
+            event == DEQUEUE,
+            event == DROP,
+            event == RECEIVE,
+        ]
+        hi = (records['ip_src'].astype(np.uint64) << 32) | records['ip_dst']
+        lo = ((records['sport'].astype(np.uint64) << 16) | records['dport']) << 8 | records['traffic']
+        order = np.lexsort((lo, hi))
+        (hi, lo) = (hi[order], lo[order])
+        starts = np.concatenate(([0], np.flatnonzero((np.diff(hi) != 0) | (np.diff(lo) != 0)) + 1))
+        sums = [ np.add.reduceat(c[order].astype(np.int64), starts).tolist() for c in columns ]
+        for (j, s) in enumerate(starts.tolist()):
+            (h, l) = (int(hi[s]), int(lo[s]))
+            key = (h >> 32, h & 0xffffffff, l >> 24, (l >> 8) & 0xffff, l & 0xff)
+            counts = self.flows.setdefault(key, [0] * len(FLOW_COLUMNS))
+            totals = self.traffic[TRAFFIC[key[4]]]
+            for (c, column) in enumerate(sums):
+                counts[c] += column[j]
+                totals[c] += column[j]
+
+    def close(self, locations):
+        with open(self.path, "w+") as fp:
+            fp.write("#traffic\tsrc\tdst\tsport\tdport\t" + "\t".join(FLOW_COLUMNS) + "\n")
+            for key in sorted(self.flows):
+                (src, dst, sport, dport, traffic) = key
+                vals = [TRAFFIC[traffic], ip_string(src), ip_string(dst), sport, dport] + self.flows[key]
+                fp.write("\t".join([ str(v) for v in vals ]) + "\n")
+        with open(self.traffic_path, "w+") as fp:
+            fp.write("#traffic\t" + "\t".join(FLOW_COLUMNS) + "\n")
+            for name in TRAFFIC:
+                fp.write("\t".join([name] + [ str(v) for v in self.traffic[name] ]) + "\n")
+
+PACKET_OUTPUTS = {
+    'packets': PacketRecords,
+    'flows': FlowStats,
+}
+
+def do(path, processes=None, output="text"):
+    """
+    output is one or more of OUTPUTS and PACKET_OUTPUTS, separated by
+    commas, each optionally with an argument after a colon: stats:0.5 is
+    half second buckets. Packet outputs need every field decoded; the
+    queue outputs are fed from the same pass.
+    """
+    queues = []
+    packets = []
+    for spec in output.split(","):
+        (name, _, arg) = spec.partition(":")
+        if name in OUTPUTS:
+            outputs = (OUTPUTS, queues)
+        elif name in PACKET_OUTPUTS:
+            outputs = (PACKET_OUTPUTS, packets)
+        else:
+            raise ValueError("no output called {}".format(name))
+        outputs[1].append(outputs[0][name](arg) if arg else outputs[0][name]())
+    if not packets:
+        dataset_queue_size(parsed(path, processes), queues)
+        return
+    locations = []
+    def batches():
+        for (records, found) in packet_batches(path, processes):
+            locations[:] = found
+            for out in packets:
+                out.add(records, locations)
+            yield queue_batch(records, locations)
+    dataset_queue_size(batches(), queues)
+    for out in packets:
+        out.close(locations)
 
 def main():
-    do(sys.argv[1])
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    output = sys.argv[3] if len(sys.argv) > 3 else "text"
+    do(sys.argv[1], processes, output)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+from util import csma_queueing as cq
+
+def events(rand, n, start=0.0):
+    """
+    Times and kinds of n queue events that never dequeue from an empty
+    queue. Some share a time and a few are stamped before the one ahead.
+    """
+    (times, kinds) = ([], [])
+    (t, depth) = (start, 0)
+    for _ in range(n):
+        r = rand.random()
+        t += 0 if r < 0.1 else (-0.01 if r < 0.13 else rand.expovariate(40))
+        if depth and rand.random() < 0.45:
+            (kind, depth) = (cq.DEQUEUE, depth - 1)
+        elif rand.random() < 0.1:
+            kind = cq.DROP
+        else:
+            (kind, depth) = (cq.ENQUEUE, depth + 1)
+        times.append(max(t, 0.0))
+        kinds.append(kind)
+    return (np.array(times), np.array(kinds, np.uint8))
+
+def summarise(times, kinds, end, width):
+    """
+    stats rows worked out piece by piece, for comparison.
+    """
+    times = np.maximum.accumulate(times).tolist()
+    counts = np.cumsum((kinds == cq.ENQUEUE).astype(int) - (kinds == cq.DEQUEUE)).tolist()
+    n = int(end // width) + 1
+    low = [None] * n
+    high = [None] * n
+    drops = [0] * n
+    spent = [ {} for _ in range(n) ]
+    def seen(b, d):
+        low[b] = d if low[b] is None else min(low[b], d)
+        high[b] = d if high[b] is None else max(high[b], d)
+    points = [(0.0, 0)] + zip(times, counts) + [(end, counts[-1])]
+    for (t, d) in points:
+        seen(int(t // width), d)
+    for (t, kind) in zip(times, kinds):
+        if kind == cq.DROP:
+            drops[int(t // width)] += 1
+    for ((s, d), (e, _)) in zip(points, points[1:]):
+        cuts = [s] + [ k * width for k in range(int(s // width) + 1, int(e // width) + 1) ] + [e]
+        for (a, b) in zip(cuts, cuts[1:]):
+            bucket = int(s // width) if a == s else int(round(a / width))
+            seen(bucket, d)
+            spent[bucket][d] = spent[bucket].get(d, 0.0) + (b - a)
+    rows = []
+    for b in range(n):
+        covered = sum(spent[b].values())
+        mean = sum([ d * t for (d, t) in spent[b].items() ]) / covered if covered > 0 else low[b]
+        bins = np.zeros(len(cq.DEPTH_EDGES))
+        for (d, t) in spent[b].items():
+            bins[np.searchsorted(cq.DEPTH_EDGES, d, side='right') - 1] += t
+        cum = np.cumsum(bins)
+        qs = [ cq.DEPTH_EDGES[np.argmax(cum >= q * cum[-1] - 1e-12)] for q in cq.QUANTILES ]
+        rows.append([b * width, low[b], high[b], mean, drops[b]] + qs)
+    return rows
+
+class QueueStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def read(self, loc):
+        with open("stats-{}.dat".format(loc)) as fp:
+            self.assertTrue(fp.readline().startswith("#start"))
+            return [ map(float, line.split("\t")) for line in fp ]
+
+    def test_against_pieces(self):
+        rand = random.Random(1)
+        traces = {'a': events(rand, 3000), 'b': events(rand, 500)}
+        # Handed out in uneven batches, as parsed chunks would be
+        batches = []
+        for (loc, (times, kinds)) in sorted(traces.items()):
+            cuts = sorted(rand.sample(range(1, len(times)), 6))
+            for (i, (s, e)) in enumerate(zip([0] + cuts, cuts + [len(times)])):
+                if len(batches) <= i:
+                    batches.append({})
+                batches[i][loc] = (times[s:e], kinds[s:e])
+        stats = cq.QueueStats(width=0.25)
+        cq.dataset_queue_size(batches, [stats])
+        end = max([ times.max() for (times, _) in traces.values() ])
+        for (loc, (times, kinds)) in traces.items():
+            got = self.read(loc)
+            want = summarise(times, kinds, end, 0.25)
+            self.assertEqual(len(got), len(want))
+            for (g, w) in zip(got, want):
+                self.assertAlmostEqual(g[0], w[0])
+                self.assertEqual(g[1:3], w[1:3])
+                self.assertAlmostEqual(g[3], w[3])
+                self.assertEqual(g[4:], w[4:])
+
+    def test_drops_only(self):
+        times = np.array([0.05, 0.35, 0.36])
+        kinds = np.array([cq.DROP] * 3, np.uint8)
+        stats = cq.QueueStats(width=0.1)
+        cq.dataset_queue_size([{'x': (times, kinds)}], [stats])
+        rows = self.read('x')
+        self.assertEqual([ r[4] for r in rows ], [1, 0, 0, 2])
+        self.assertEqual(set([ r[2] for r in rows ]), set([0]))
+
+if __name__ == "__main__":
+    unittest.main()